@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Benchmarks of the search and handler hot paths.
+
+Generates synthetic catalogs with Zipf-distributed expressions, loads them
+in the bot through each storage backend and replays synthetic inline queries
+and `/wat` commands through the real handlers. Requests to Telegram are
+recorded by a stub bot instead of being sent.
+
+Every catalog is benchmarked in its own process, so that the peak memory
+reported belongs to that catalog only. Results are printed as JSON.
+
+Usage:
+
+    python3 nekowatbench.py [--sizes 1000,10000] [--backends tinydb,sqlite]
+        [--requests 2000] [--output results.json]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import telebot
+
+from nekowatbot.storage import BACKENDS
+from nekowatbot.supervisor import SupervisedTeleBot
+
+
+# Fake IDs of the user sending the traffic
+USER_ID = 1000
+OWNER_ID = 1
+
+# Number of WATs inserted in each batch while generating catalogs
+BATCH_SIZE = 10000
+
+
+class StubTeleBot(SupervisedTeleBot):
+    """Bot that records requests instead of sending them to Telegram.
+
+    Updates are processed synchronously, in the calling thread.
+
+    Attributes:
+
+    calls (dict): Number of requests recorded by API method.
+    inline_bytes (int): Size of the serialized inline results.
+    """
+
+    def __init__(self, token):
+        super(StubTeleBot, self).__init__(token, threaded=False)
+        self.calls = {}
+        self.inline_bytes = 0
+
+    def _record(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._record('sendMessage')
+
+    def reply_to(self, message, text, **kwargs):
+        self._record('sendMessage')
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        self._record('sendPhoto')
+
+    def answer_inline_query(self, inline_query_id, results, **kwargs):
+        # Serialize the results as the real bot would
+        self.inline_bytes += len(','.join(r.to_json() for r in results)) + 2
+        self._record('answerInlineQuery')
+
+
+def zipf_weights(count, exponent):
+    """Probabilities of a Zipf distribution over `count` ranks."""
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+    return weights / weights.sum()
+
+
+def vocabulary(size):
+    """Expressions of a catalog of the given size."""
+    return ['expr%d' % i for i in range(max(size // 10, 10))]
+
+
+def generate_catalog(backend, path, size, exponent, rng):
+    """Create a synthetic catalog.
+
+    Each WAT has between one and three expressions drawn from a Zipf
+    distribution, so a few expressions match many WATs and most match few.
+
+    Returns:
+        Seconds taken to generate the catalog.
+    """
+    start = time.perf_counter()
+    words = vocabulary(size)
+    weights = zipf_weights(len(words), exponent)
+
+    if backend == 'tinydb':
+        # Write the file once at the end rather than on every batch
+        storage = BACKENDS[backend](path, write_behind=True)
+
+    else:
+        storage = BACKENDS[backend](path)
+
+    for first in range(0, size, BATCH_SIZE):
+        count = min(BATCH_SIZE, size - first)
+        picks = rng.choice(len(words), size=(count, 3), p=weights)
+        lengths = rng.integers(1, 4, size=count)
+
+        storage.insert_many(
+            {
+                'name': 'wat%d' % (first + i),
+                'file_ids': ['small%d' % (first + i), 'big%d' % (first + i)],
+                'expressions': sorted(
+                    set(words[w] for w in picks[i][:lengths[i]])
+                )
+            }
+            for i in range(count)
+        )
+
+    storage.flush()
+    storage.close()
+
+    return time.perf_counter() - start
+
+
+def generate_traffic(size, count, exponent, rng):
+    """Create synthetic updates.
+
+    Half of the updates are inline queries and half are `/wat` commands.
+    Expressions follow the same Zipf distribution as the catalog; some
+    inline queries are incomplete (as sent while typing) or ask for the next
+    page of results.
+
+    Returns:
+        Lists of inline query updates and of message updates.
+    """
+    words = vocabulary(size)
+    picks = rng.choice(len(words), size=count, p=zipf_weights(len(words),
+                                                              exponent))
+    user = {'id': USER_ID, 'is_bot': False, 'first_name': 'bench'}
+    chat = {'id': USER_ID, 'type': 'private'}
+    inline = []
+    messages = []
+
+    for i, pick in enumerate(picks):
+        expression = words[pick]
+
+        if i % 2 == 0:
+            roll = rng.random()
+
+            if roll < 0.2:
+                expression = expression[:rng.integers(1, len(expression))]
+
+            inline.append(telebot.types.Update.de_json({
+                'update_id': i + 1,
+                'inline_query': {
+                    'id': str(i),
+                    'from': user,
+                    'query': expression,
+                    'offset': '50' if roll > 0.9 else ''
+                }
+            }))
+
+        else:
+            messages.append(telebot.types.Update.de_json({
+                'update_id': i + 1,
+                'message': {
+                    'message_id': i,
+                    'from': user,
+                    'chat': chat,
+                    'date': 0,
+                    'text': '/wat %s' % expression,
+                    'entities': [{
+                        'type': 'bot_command',
+                        'offset': 0,
+                        'length': 4
+                    }]
+                }
+            }))
+
+    return inline, messages
+
+
+def measure(name, func, items):
+    """Time `func` on each item.
+
+    Returns:
+        Dict with the number of operations, throughput and latencies.
+    """
+    latencies = []
+    start = time.perf_counter()
+
+    for item in items:
+        call_start = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - call_start)
+
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+
+    return {
+        'operation': name,
+        'count': len(items),
+        'throughput': len(items) / elapsed if elapsed else None,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99))
+    }
+
+
+def run_case(args):
+    """Benchmark a single catalog in the current process."""
+    from nekowatbot import nekowat
+
+    rng = np.random.default_rng(args.seed)
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix='nekowatbench')
+
+    try:
+        db_path = os.path.join(workdir, 'wats.db')
+        generation = generate_catalog(
+            args.backend,
+            db_path,
+            args.size,
+            args.zipf,
+            rng
+        )
+
+        conf_path = os.path.join(workdir, 'conf.json')
+
+        with open(conf_path, 'w') as f:
+            json.dump({
+                'tg': {
+                    'token': '0:bench',
+                    'owner': OWNER_ID,
+                    'use_whitelist': False,
+                    'whitelist': {}
+                },
+                'db': {'backend': args.backend, 'path': db_path}
+            }, f)
+
+        start = time.perf_counter()
+
+        # Keep the messages of the bot out of the JSON output
+        with contextlib.redirect_stdout(sys.stderr):
+            nekowat.init_bot(conf_path, level='WARNING')
+
+        startup = time.perf_counter() - start
+
+        # Handlers are registered on the stub and requests go straight to it
+        stub = StubTeleBot(nekowat.token)
+        nekowat.bot = stub
+        nekowat.sender = None
+
+        import nekowatbot.handler
+
+        inline, messages = generate_traffic(
+            args.size,
+            args.requests,
+            args.zipf,
+            rng
+        )
+        words = vocabulary(args.size)
+        expressions = [
+            words[i] for i in rng.choice(len(words), size=args.requests // 2,
+                                         p=zipf_weights(len(words), args.zipf))
+        ]
+
+        results = [
+            measure(
+                'get_wats_by_expression',
+                nekowat.get_wats_by_expression,
+                expressions
+            ),
+            measure(
+                'get_all_wats',
+                lambda _: nekowat.get_all_wats(),
+                range(args.full_scans)
+            ),
+            measure(
+                'handle_inline',
+                lambda u: stub.process_new_updates([u]),
+                inline
+            ),
+            measure(
+                'handle_wat',
+                lambda u: stub.process_new_updates([u]),
+                messages
+            )
+        ]
+
+        return {
+            'backend': args.backend,
+            'size': args.size,
+            'generation_s': generation,
+            'startup_s': startup,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'calls': stub.calls,
+            'inline_bytes': stub.inline_bytes,
+            'results': results
+        }
+
+    finally:
+        nekowat.db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_all(args):
+    """Benchmark every catalog, each one in a new process."""
+    cases = []
+
+    for backend in args.backends.split(','):
+        for size in args.sizes.split(','):
+            command = [
+                sys.executable, os.path.abspath(__file__),
+                '--case',
+                '--backend', backend,
+                '--size', size,
+                '--requests', str(args.requests),
+                '--full-scans', str(args.full_scans),
+                '--zipf', str(args.zipf),
+                '--seed', str(args.seed)
+            ]
+
+            print('Benchmarking %s with %s WATs' % (backend, size),
+                  file=sys.stderr)
+
+            output = subprocess.run(
+                command,
+                stdout=subprocess.PIPE,
+                check=True
+            ).stdout
+            cases.append(json.loads(output.decode('utf-8')))
+
+    return {
+        'python': sys.version.split()[0],
+        'requests': args.requests,
+        'zipf': args.zipf,
+        'seed': args.seed,
+        'cases': cases
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the search and handler hot paths'
+    )
+    parser.add_argument(
+        '--sizes',
+        default='1000,10000,100000',
+        help='Comma separated catalog sizes'
+    )
+    parser.add_argument(
+        '--backends',
+        default=','.join(sorted(BACKENDS)),
+        help='Comma separated storage backends'
+    )
+    parser.add_argument(
+        '--requests',
+        type=int,
+        default=2000,
+        help='Updates replayed for each catalog'
+    )
+    parser.add_argument(
+        '--full-scans',
+        type=int,
+        default=5,
+        help='Calls to get_all_wats() for each catalog'
+    )
+    parser.add_argument(
+        '--zipf',
+        type=float,
+        default=1.1,
+        help='Exponent of the Zipf distribution of expressions'
+    )
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--output', help='File to write the results to')
+
+    # Internal options used to run a single catalog
+    parser.add_argument('--case', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--backend', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.case:
+        result = run_case(args)
+
+    else:
+        result = run_all(args)
+
+    output = json.dumps(result, indent=2)
+
+    if args.output and not args.case:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    else:
+        print(output)
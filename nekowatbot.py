@@ -29,35 +29,25 @@
 
 import signal
 import sys
-import time
-import traceback
 
 from nekowatbot import nekowat
+from nekowatbot.supervisor import Supervisor
+
+
+supervisor = Supervisor(nekowat.start, nekowat.stop)
 
 
 def sigint_handler(signal, frame):
-    nekowat.stop()
+    supervisor.shutdown()
     sys.exit(0)
 
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, sigint_handler)
+    signal.signal(signal.SIGTERM, sigint_handler)
     print('Press Control+C to exit')
 
     print('Initializing bot')
     nekowat.init_bot()
     from nekowatbot import handler
 
-    while True:
-        try:
-            nekowat.start()
-
-        except Exception as e:
-            traceback.print_exc()
-
-            print('Start sleep')
-            time.sleep(20)
-            print('Ended sleep')
-
-            pass
-
-        nekowat.stop()
+    supervisor.run()
@@ -27,15 +27,39 @@
 
 """Bot implementation."""
 
+import contextlib
 import logging
-import json
 import os
+import random
 import sys
+import time
 
 import telebot
 
-from tinydb import TinyDB, Query
-from tinydb_smartcache import SmartCacheTable
+from tinydb.database import Document
+
+from nekowatbot.acl import AccessList
+from nekowatbot.cache import LRUCache
+from nekowatbot.config import ConfigFile
+from nekowatbot.conversation import open_conversations
+from nekowatbot.executor import HandlerExecutor
+from nekowatbot.index import WatIndex, normalize
+from nekowatbot.inline import InlineTracker
+from nekowatbot.metrics import (
+    DB_LATENCY, QUEUE_DEPTH, REGISTRY, RESIDENT_MEMORY, MetricsServer,
+    instrument_handler, resident_memory, timed
+)
+from nekowatbot.popularity import Popularity
+from nekowatbot.query import Query
+from nekowatbot.sender import (
+    PRIORITY_ADMIN, PRIORITY_INLINE, PRIORITY_USER, RateLimiter, SendScheduler
+)
+from nekowatbot.storage import SnapshotStorage, open_storage
+from nekowatbot.supervisor import (
+    SupervisedTeleBot, UpdateLedger, UpdateOffsetStore, set_api_url
+)
+from nekowatbot.webhook import AsyncWebhookServer, WebhookServer
+from nekowatbot.workers import WorkerPool
 
 
 class Nekowat(object):
@@ -43,6 +67,8 @@ class Nekowat(object):
 
     _conf_path (str): Path to the configuration file.
     _conf (dict): Parsed configuration
+    config (ConfigFile): Configuration file, written in the background and
+        reloaded when edited externally.
     token (str): Telegram bot token
     owner (int): ID of the bot owner. The owner can do certain special actions
         such as adding or removing users from whitelist.
@@ -56,9 +82,50 @@ class Nekowat(object):
                 'user2': 123456788
             }
 
-    bot (TeleBot): TeleBot instance.
-    db (TinyDB): Database instance.
-    wat (Query): TinyDB query.
+    acl (AccessList): Reverse index of the whitelist, used to check users.
+
+    engine (str): Bot engine in use, either 'threaded' (SupervisedTeleBot
+        running handlers in a thread pool) or 'asyncio' (AsyncTeleBot running
+        handlers on an event loop).
+    bot (SupervisedTeleBot|AsyncTeleBot): Bot instance.
+    sender (SendScheduler): Scheduler of outbound requests when using the
+        threaded engine, which sends them respecting Telegram's rate limits.
+    executor (HandlerExecutor): Lanes running the handlers of inline
+        queries, users and the owner separately when using the threaded
+        engine.
+    worker_count (int): Number of worker processes handling updates, or 0
+        to handle them in this process only.
+    workers (WorkerPool): Worker processes, while running. Only set in the
+        primary process.
+    mode (str): How updates are received, either 'polling' or 'webhook'.
+    webhook_conf (dict): Configuration of the webhook server.
+    webhook (WebhookServer|AsyncWebhookServer): Webhook server, while running.
+    metrics (MetricsServer): Server exposing the metrics of the bot, if
+        enabled in the configuration.
+    db (TinyDBStorage|SQLiteStorage): Storage of the WATs.
+    index (WatIndex): In-memory expression index of the database.
+    conversations (ConversationStore|SQLiteConversationStore): State of the
+        multi-step conversations (e.g. `/add`) of each chat.
+    weighted_random (bool): Whether random WATs are chosen according to their
+        weights (see `set_wat_weight()`) or uniformly.
+    inline_page_size (int): Maximum number of results sent in each answer to
+        an inline query. Telegram does not accept more than 50.
+    search_cache (LRUCache): Ordered search results indexed by expression,
+        so that every page of an inline query is served from the same list.
+    inline_cache (LRUCache): Prebuilt inline answers indexed by expression,
+        offset and whether the user is allowed to use the bot.
+    inline_cache_time (int): Seconds Telegram may cache inline answers.
+    inline_is_personal (bool): Whether Telegram should cache inline answers
+        per user. This is always the case when using a whitelist, so that
+        results are not shared with users outside of it.
+    inline_tracker (InlineTracker): Latest inline query of each user, used
+        to drop the queries superseded while the user is typing.
+    popularity (Popularity): Counters of the WATs chosen from inline
+        results, used to sort search results.
+    publish_interval (float): Minimum seconds between republications of
+        the catalog to the workers caused only by changes of the rankings.
+        0 disables them.
+    _published (float): Time of the last republication to the workers.
     """
 
     def init_bot(self, config_path=None, level='INFO'):
@@ -79,57 +146,595 @@ class Nekowat(object):
 
         self._conf_path = config_path
 
-        with open(config_path) as f:
-            self._conf = json.load(f)
+        # Configuration file (see nekowatbot.config)
+        self.config = ConfigFile(config_path)
+        self._conf = self.config.data
+        self.config.save_delay = self._conf.get('config', {}).get(
+            'save_delay',
+            1
+        )
 
         # Bot settings
         self.token = self._conf['tg']['token']
         self.owner = self._conf['tg']['owner']
         self.use_whitelist = self._conf['tg']['use_whitelist']
-        self.whitelist = self._conf['tg']['whitelist']
-
-        # TinyDB
-        #
-        # Row structure:
-        #
-        # - name (str): Name of the file
-        # - file_ids (list): List of file IDs ordered by size
-        # - expressions (list): List of expressions that match the image
-        self.db = TinyDB(self._conf['db'])
-        self.db.table_class = SmartCacheTable
-        self.wat = Query()
+        self.acl = AccessList(
+            self._conf['tg']['whitelist'],
+            self.owner,
+            self.config.lock
+        )
+
+        # Database (see nekowatbot.storage for the row structure)
+        start = time.monotonic()
+        self.db = open_storage(self._conf['db'])
+
+        # Expression index, built once and kept up to date on writes
+        self.index = WatIndex()
+
+        if isinstance(self.db, SnapshotStorage):
+            self.index.load(self.db.snapshot)
+
+        else:
+            self.index.build(self.db.all())
+
+        print('Loaded %d WATs in %.2fs (%.1f MB resident)' % (
+            len(self.index),
+            time.monotonic() - start,
+            resident_memory() / 2.0 ** 20
+        ))
+
+        self.weighted_random = self._conf.get('weighted_random', False)
+
+        # Conversations (see nekowatbot.conversation)
+        self.conversations = open_conversations(
+            self._conf.get('conversations', {})
+        )
+
+        # Inline settings
+        inline_conf = self._conf.get('inline', {})
+        self.inline_page_size = min(inline_conf.get('page_size', 50), 50)
+        self.search_cache = LRUCache(
+            inline_conf.get('search_cache_size', 256),
+            name='search'
+        )
+        self.inline_cache = LRUCache(
+            inline_conf.get('answer_cache_size', 1024),
+            inline_conf.get('answer_cache_ttl', 600),
+            name='inline'
+        )
+        self.inline_cache_time = inline_conf.get('cache_time', 300)
+        self.inline_is_personal = inline_conf.get('is_personal', False)
+        self.inline_tracker = InlineTracker(
+            inline_conf.get('coalesce_window', 0)
+        )
+
+        # Popularity of the WATs (see nekowatbot.popularity)
+        popularity_conf = self._conf.get('popularity', {})
+        self.popularity = Popularity(
+            popularity_conf.get('path'),
+            half_life=popularity_conf.get('half_life', 7 * 86400),
+            flush_interval=popularity_conf.get('flush_interval', 60),
+            max_pairs=popularity_conf.get('max_pairs', 100000)
+        )
+        self.publish_interval = popularity_conf.get('publish_interval', 3600)
+        self._published = time.monotonic()
 
         # Bot initialization
         telebot.logger.setLevel(level)
-        self.bot = telebot.TeleBot(
-            self.token,
-            threaded=True,
-            skip_pending=True
+        self.engine = self._conf['tg'].get('engine', 'threaded')
+
+        # Worker processes (see nekowatbot.workers)
+        self.worker_count = self._conf['tg'].get('workers', 0)
+        self.workers = None
+
+        if self.worker_count and self.engine != 'threaded':
+            sys.exit('Worker processes require the threaded engine')
+
+        if self.inline_tracker.window and self.engine != 'threaded':
+            sys.exit('Inline coalescing requires the threaded engine')
+
+        sender_conf = self._conf.get('sender', {})
+        self.sender = None
+        self.executor = None
+
+        # Resume from the last update processed if it is being persisted,
+        # otherwise skip the updates received while the bot was down
+        state_file = self._conf['tg'].get('state_file')
+        offset_store = UpdateOffsetStore(state_file) if state_file else None
+
+        # Base URL of the Bot API, which may be a local server for testing
+        api_url = '%s/bot{0}/{1}' % self._conf['tg'].get(
+            'api_url',
+            'https://api.telegram.org'
+        ).rstrip('/')
+
+        if self.engine == 'asyncio':
+            try:
+                from nekowatbot.aio import AsyncTeleBot
+
+            except ImportError:
+                sys.exit('The asyncio engine requires aiohttp')
+
+            self.bot = AsyncTeleBot(
+                self.token,
+                skip_pending=offset_store is None,
+                api_url=api_url,
+                connection_limit=self._conf['tg'].get('connection_limit', 100),
+                limiter=self._new_limiter(),
+                max_retries=sender_conf.get('max_retries', 3)
+            )
+
+        elif self.engine == 'threaded':
+            set_api_url(api_url)
+            self.bot = SupervisedTeleBot(
+                self.token,
+                threaded=True,
+                skip_pending=offset_store is None
+            )
+
+            # The asyncio engine applies the rate limits itself
+            self.sender = self._new_sender()
+            self.executor = self._new_executor()
+            self.bot.executor = self.executor
+
+        else:
+            sys.exit('Unknown bot engine: %s' % self.engine)
+
+        self.bot.inline_tracker = self.inline_tracker
+
+        if offset_store:
+            self.bot.offset_store = offset_store
+            self.bot.last_update_id = offset_store.load()
+
+        self.mode = self._conf['tg'].get('mode', 'polling')
+        self.webhook_conf = self._conf['tg'].get('webhook', {})
+        self.webhook = None
+
+        if self.mode not in ('polling', 'webhook'):
+            sys.exit('Unknown bot mode: %s' % self.mode)
+
+        self._init_metrics(self._conf.get('metrics'))
+
+        reload_interval = self._conf.get('config', {}).get(
+            'reload_interval',
+            5
+        )
+
+        if reload_interval:
+            self.config.watch(reload_interval, self._conf_reloaded)
+
+        # Cached search results are sorted by popularity
+        self.popularity.start(self._rankings_changed)
+
+    @property
+    def whitelist(self):
+        """Users allowed to interact with the bot, indexed by name."""
+        return self.acl.names
+
+    def _conf_reloaded(self, conf):
+        """Apply the settings of a configuration edited externally.
+
+        Only the whitelist settings are applied, the rest of the settings
+        require restarting the bot.
+        """
+        self._conf = conf
+        self.use_whitelist = conf['tg']['use_whitelist']
+        self.acl.replace(conf['tg']['whitelist'])
+
+        print('Configuration reloaded')
+        self._publish()
+
+    def _init_metrics(self, conf):
+        """Register the gauges of the bot and start the metrics server.
+
+        Args:
+            conf (dict): Configuration of the metrics server. If not provided,
+                metrics are still recorded but not exposed.
+        """
+        # The sender and the executor are replaced when the bot restarts
+        if self.sender is not None:
+            QUEUE_DEPTH.set_function(
+                lambda: len(self.sender) if self.sender else 0,
+                'sender'
+            )
+
+        if self.executor is not None:
+            for name in self.executor.lanes:
+                QUEUE_DEPTH.set_function(
+                    lambda n=name: (
+                        len(self.executor.lanes[n]) if self.executor else 0
+                    ),
+                    'lane_' + name
+                )
+
+        QUEUE_DEPTH.set_function(
+            lambda: self.webhook.queue.qsize() if self.webhook else 0,
+            'webhook'
+        )
+        QUEUE_DEPTH.set_function(lambda: len(self.popularity), 'popularity')
+        RESIDENT_MEMORY.set_function(resident_memory)
+
+        self.metrics = None
+
+        if not conf:
+            return
+
+        self.metrics = MetricsServer(
+            REGISTRY,
+            conf.get('listen', '127.0.0.1'),
+            conf.get('port', 9090)
+        )
+        self.metrics.start()
+
+    def _instrumented(self, register):
+        """Decorator registering a handler so that its metrics are recorded.
+
+        Args:
+            register (callable): Decorator of the bot registering handlers.
+        """
+        def decorator(handler):
+            register(instrument_handler(handler))
+            return handler
+
+        return decorator
+
+    def message_handler(self, **kwargs):
+        """Register a message handler. See `TeleBot.message_handler()`."""
+        return self._instrumented(self.bot.message_handler(**kwargs))
+
+    def inline_handler(self, func, **kwargs):
+        """Register an inline handler. See `TeleBot.inline_handler()`."""
+        return self._instrumented(self.bot.inline_handler(func, **kwargs))
+
+    def chosen_inline_handler(self, func, **kwargs):
+        """Register a chosen inline result handler.
+
+        See `TeleBot.chosen_inline_handler()`.
+        """
+        return self._instrumented(
+            self.bot.chosen_inline_handler(func, **kwargs)
+        )
+
+    def callback_query_handler(self, func, **kwargs):
+        """Register a callback query handler.
+
+        See `TeleBot.callback_query_handler()`.
+        """
+        return self._instrumented(
+            self.bot.callback_query_handler(func, **kwargs)
+        )
+
+    def register_next_step_handler(self, message, callback):
+        """Register the handler of the next message of a chat.
+
+        See `TeleBot.register_next_step_handler()`.
+        """
+        self.bot.register_next_step_handler(
+            message,
+            instrument_handler(callback, 'next_step')
+        )
+
+    def _new_limiter(self):
+        """Build the rate limiter of the outbound requests of this process.
+
+        The global limit is split evenly between the processes sending
+        requests. Chat limits are not, as every chat is handled by a single
+        process.
+        """
+        sender_conf = self._conf.get('sender', {})
+        share = 1.0 / (self.worker_count + 1)
+
+        return RateLimiter(
+            global_rate=sender_conf.get('global_rate', 30) * share,
+            chat_rate=sender_conf.get('chat_rate', 1),
+            group_rate=sender_conf.get('group_rate', 20 / 60.0),
+            global_burst=max(sender_conf.get('global_burst', 30) * share, 1),
+            chat_burst=sender_conf.get('chat_burst', 3)
+        )
+
+    def _new_sender(self):
+        """Build the scheduler of the outbound requests of this process."""
+        sender_conf = self._conf.get('sender', {})
+
+        return SendScheduler(
+            self._new_limiter(),
+            max_queue=sender_conf.get('max_queue', 1000),
+            workers=sender_conf.get('workers', 4),
+            max_retries=sender_conf.get('max_retries', 3),
+            ledger=self.bot.ledger
         )
 
-        # Inherit bot methods
-        self.answer_inline_query = self.bot.answer_inline_query
-        self.inline_handler = self.bot.inline_handler
-        self.message_handler = self.bot.message_handler
-        self.register_next_step_handler = self.bot.register_next_step_handler
-        self.reply_to = self.bot.reply_to
-        self.send_message = self.bot.send_message
-        self.send_photo = self.bot.send_photo
+    def _new_executor(self):
+        """Build the handler executor of this process."""
+        return HandlerExecutor(self._lane, self._conf.get('lanes', {}))
+
+    def _lane(self, obj, *args, **kwargs):
+        """Lane of the handler executor for an update object."""
+        if isinstance(obj, telebot.types.InlineQuery):
+            return 'inline'
+
+        user = getattr(obj, 'from_user', None)
+
+        if user is not None and self.is_owner(user.id):
+            return 'owner'
+
+        return 'user'
+
+    def _init_worker(self, index, done):
+        """Prepare a worker process forked from the primary.
+
+        The catalog and its index are inherited from the primary and only
+        read. Everything else that holds threads, locks or connections is
+        created anew.
+
+        Args:
+            index (int): Index of the worker.
+            done (callable): Function to call with the ID of each update
+                once it has been processed.
+
+        Returns:
+            Tuple of the functions processing updates and shutting down the
+            worker.
+        """
+        self.workers = None
+        self.webhook = None
+        self.metrics = None
+
+        self.index.after_fork()
+        self.db.after_fork()
+        self.conversations = open_conversations(
+            self._conf.get('conversations', {})
+        )
+        self.search_cache = LRUCache(self.search_cache.maxsize, name='search')
+        self.inline_cache = LRUCache(
+            self.inline_cache.maxsize,
+            self.inline_cache.ttl,
+            name='inline'
+        )
+
+        self.inline_tracker = InlineTracker(self.inline_tracker.window)
+        self.bot.inline_tracker = self.inline_tracker
+
+        # The primary persists the offset once the worker is done
+        self.bot.ledger = UpdateLedger(done)
+        self.sender = self._new_sender()
+        self.executor = self._new_executor()
+        self.bot.executor = self.executor
+        self.bot.router = None
+        self.bot.offset_store = None
+        self.bot.count_received = False
+
+        def shutdown():
+            # Let handlers and pending requests finish
+            self.executor.stop()
+            self.executor.join()
+            self.sender.stop()
+            self.sender.join()
+
+        return self.bot.process_new_updates, shutdown
+
+    @contextlib.contextmanager
+    def _quiesce(self):
+        """Keep the catalog from changing, e.g. while forking workers."""
+        with self.index.quiesce(), self.db.quiesce():
+            yield
+
+    def _publish(self):
+        """Make worker processes see the changes made by the primary."""
+        self._published = time.monotonic()
+
+        if self.workers is not None:
+            self.workers.republish()
 
     def _save_conf(self):
-        """Save configuration to file."""
-        with open(self._conf_path, 'w') as f:
-            json.dump(self._conf, f)
+        """Save configuration to file, in the background."""
+        self.config.save()
 
     def start(self):
-        """Bot starter."""
+        """Bot starter.
+
+        Depending on the configured mode, this either polls Telegram for
+        updates or runs a webhook server. Worker processes, if any, are
+        started as well, and the sender and handler executor are created
+        again if a previous run stopped them.
+        """
+        if self.engine == 'threaded' and self.executor is None:
+            self.sender = self._new_sender()
+            self.executor = self._new_executor()
+            self.bot.executor = self.executor
+
+        if self.worker_count and self.workers is None:
+            self.workers = WorkerPool(
+                self.worker_count,
+                self._init_worker,
+                self.is_owner,
+                self._conf['tg'].get('republish_delay', 2),
+                self.bot.ledger.release,
+                self._quiesce
+            )
+
+            print('Start %d workers' % self.worker_count)
+            self.workers.start()
+            self.bot.router = self.workers.route
+
+        if self.mode == 'webhook':
+            if self.engine == 'asyncio':
+                self.webhook = AsyncWebhookServer(self.bot, self.webhook_conf)
+
+            else:
+                self.webhook = WebhookServer(self.bot, self.webhook_conf)
+
+            print('Start webhook server')
+            self.webhook.serve_forever()
+            return
+
         print('Start polling')
         self.bot.polling(none_stop=True)
 
     def stop(self):
-        """Bot stopper."""
-        print('Stop polling')
-        self.bot.stop_polling()
+        """Bot stopper.
+
+        Updates already received are handled before returning: workers
+        handle their pending updates and exit, and then the lanes of the
+        handler executor and the send queue are drained. The offset of the
+        updates processed is persisted afterwards.
+        """
+        if self.webhook:
+            print('Stop webhook server')
+            self.webhook.shutdown()
+            self.webhook = None
+
+        else:
+            print('Stop polling')
+            self.bot.stop_polling()
+
+        if self.workers is not None:
+            print('Stop workers')
+            self.bot.router = None
+            self.workers.stop()
+            self.workers = None
+
+        # Handlers may still queue requests, so the sender is stopped last
+        if self.executor is not None:
+            self.executor.stop()
+            self.executor.join()
+            self.executor = None
+            self.bot.executor = None
+
+        if self.sender is not None:
+            self.sender.stop()
+            self.sender.join()
+            self.sender = None
+
+            # Every update received has been processed by now
+            self.bot.save_offset()
+
+        # Persist pending changes of the catalog, configuration and
+        # popularity counters, if any
+        self.db.flush()
+        self.config.flush()
+        self.popularity.flush()
+
+    def _priority(self, chat_id):
+        """Priority lane of the requests sent to a chat."""
+        if self.is_owner(chat_id):
+            return PRIORITY_ADMIN
+
+        return PRIORITY_USER
+
+    def send_message(self, chat_id, text, **kwargs):
+        """Send a text message. See `TeleBot.send_message()`.
+
+        When using the threaded engine, this waits until the message has
+        been sent by the send scheduler.
+        """
+        if self.sender is None:
+            return self.bot.send_message(chat_id, text, **kwargs)
+
+        return self.sender.call(
+            self.bot.send_message,
+            (chat_id, text),
+            kwargs,
+            chat_id=chat_id,
+            priority=self._priority(chat_id)
+        )
+
+    def reply_to(self, message, text, **kwargs):
+        """Reply to a message. See `TeleBot.reply_to()`."""
+        if self.sender is None:
+            return self.bot.reply_to(message, text, **kwargs)
+
+        return self.send_message(
+            message.chat.id,
+            text,
+            reply_to_message_id=message.message_id,
+            **kwargs
+        )
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        """Send a photo. See `TeleBot.send_photo()`.
+
+        When using the threaded engine, the photo is sent in the background
+        and a `Future` is returned.
+        """
+        if self.sender is None:
+            return self.bot.send_photo(chat_id, photo, **kwargs)
+
+        return self.sender.submit(
+            self.bot.send_photo,
+            (chat_id, photo),
+            kwargs,
+            chat_id=chat_id,
+            priority=self._priority(chat_id)
+        )
+
+    def answer_inline_query(self, inline_query_id, results, merge_key=None,
+                            **kwargs):
+        """Answer an inline query. See `TeleBot.answer_inline_query()`.
+
+        When using the threaded engine, the answer is sent in the background
+        from the most important lane and a `Future` is returned. Answers do
+        not count against the rate limits of messages.
+
+        Args:
+            merge_key: If provided, a pending answer with the same key (e.g.
+                an answer to an older query of the same user) is discarded.
+        """
+        if self.sender is None:
+            return self.bot.answer_inline_query(
+                inline_query_id,
+                results,
+                **kwargs
+            )
+
+        return self.sender.submit(
+            self.bot.answer_inline_query,
+            (inline_query_id, results),
+            kwargs,
+            priority=PRIORITY_INLINE,
+            merge_key=merge_key,
+            limited=False
+        )
+
+    def answer_callback_query(self, callback_query_id, **kwargs):
+        """Answer a callback query. See `TeleBot.answer_callback_query()`.
+
+        When using the threaded engine, the answer is sent in the background
+        from the most important lane and a `Future` is returned. Answers do
+        not count against the rate limits of messages.
+        """
+        if self.sender is None:
+            return self.bot.answer_callback_query(callback_query_id, **kwargs)
+
+        return self.sender.submit(
+            self.bot.answer_callback_query,
+            (callback_query_id,),
+            kwargs,
+            priority=PRIORITY_INLINE,
+            limited=False
+        )
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        """Edit the text of a message. See `TeleBot.edit_message_text()`.
+
+        When using the threaded engine, the message is edited in the
+        background and a `Future` is returned.
+        """
+        if self.sender is None:
+            return self.bot.edit_message_text(
+                text,
+                chat_id,
+                message_id,
+                **kwargs
+            )
+
+        return self.sender.submit(
+            self.bot.edit_message_text,
+            (text, chat_id, message_id),
+            kwargs,
+            chat_id=chat_id,
+            priority=self._priority(chat_id)
+        )
 
     def is_owner(self, user_id):
         """Checks whether a message comes from the owner."""
@@ -141,10 +746,7 @@ class Nekowat(object):
         Note that disabling the whitelist results in every user being able
         to communicate with the bot.
         """
-        if not self.use_whitelist or user_id == self.owner:
-            return True
-
-        return user_id in self.whitelist.values()
+        return not self.use_whitelist or user_id in self.acl
 
     def add_whitelist(self, name, user_id):
         """Adds a user to the whitelist.
@@ -158,14 +760,12 @@ class Nekowat(object):
         Returns:
             Boolean indicating if the user was added or not.
         """
-        if name in self.whitelist.keys():
+        if not self.acl.add(name, user_id):
             # Already exists
             return False
 
-        self.whitelist[name] = user_id
-        self._conf['tg']['whitelist'] = self.whitelist
-
         self._save_conf()
+        self._publish()
 
         return True
 
@@ -180,26 +780,47 @@ class Nekowat(object):
         Returns:
             Boolean indicating if the user was removed or not.
         """
-        if name not in self.whitelist.keys():
+        if not self.acl.remove(name):
             # Does not exist
             return False
 
-        del self.whitelist[name]
-        self._conf['tg']['whitelist'] = self.whitelist
-
         self._save_conf()
+        self._publish()
 
         return True
 
     def toggle_whitelist(self):
         """Toggle use of whitelist."""
-        new_status = not self.use_whitelist
+        with self.config.lock:
+            new_status = not self.use_whitelist
 
-        self._conf['tg']['use_whitelist'] = new_status
-        self.use_whitelist = new_status
+            self._conf['tg']['use_whitelist'] = new_status
+            self.use_whitelist = new_status
 
         self._save_conf()
+        self._publish()
+
+    def _catalog_changed(self):
+        """Invalidate cached search results after modifying the catalog."""
+        self.search_cache.invalidate()
+        self.inline_cache.invalidate()
+        self._publish()
+
+    def _rankings_changed(self):
+        """Invalidate cached search results after the rankings change.
+
+        Workers inherit the rankings when forked, so they are only forked
+        again once every `publish_interval` seconds for this reason.
+        """
+        self.search_cache.invalidate()
+        self.inline_cache.invalidate()
 
+        if (self.publish_interval
+                and time.monotonic() - self._published
+                >= self.publish_interval):
+            self._publish()
+
+    @timed(DB_LATENCY, 'create_wat')
     def create_wat(self, name, file_ids):
         """Insert a new wat record in the database.
 
@@ -207,51 +828,293 @@ class Nekowat(object):
             name (str): Name of the wat.
             file_ids (list[str]): List of file IDs in Telegram (ordered by size)
         """
-        self.db.insert({
+        doc = {
             'name': name,
             'file_ids': file_ids,
             'expressions': []
-        })
+        }
+
+        doc_id = self.db.insert(doc)
+        self.index.add(Document(doc, doc_id))
+        self._catalog_changed()
 
+    @timed(DB_LATENCY, 'get_all_wats')
     def get_all_wats(self):
         """Get all wats from the database.
 
         Returns:
-            List of tuples containing file ID and name
+            List of database rows
         """
-        return self.db.all()
+        return self.db.get_many(self.index.all())
 
+    @timed(DB_LATENCY, 'get_wats_by_expression')
     def get_wats_by_expression(self, expression):
         """Get all rows that match an expression.
 
+        This is resolved through the in-memory index rather than the database.
+
+        Returns:
+            List of database rows
+        """
+        return self.db.get_many(self.index.by_expression(expression))
+
+    @timed(DB_LATENCY, 'get_wats_by_prefix')
+    def get_wats_by_prefix(self, prefix):
+        """Get all rows with an expression or name starting with a prefix.
+
+        Returns:
+            List of database rows
+        """
+        return self.db.get_many(self.index.by_prefix(prefix))
+
+    @timed(DB_LATENCY, 'get_wats_by_similarity')
+    def get_wats_by_similarity(self, expression):
+        """Get the rows with expressions or names most similar to a text.
+
         Returns:
             List of database rows
         """
-        return self.db.search(self.wat.expressions.any([expression]))
+        return self.db.get_many(self.index.by_similarity(expression))
 
+    def _search_ids(self, expression):
+        """Search the IDs of the WATs that match an expression.
+
+        See `search_wats()`.
+        """
+        doc_ids = self.popularity.order(
+            expression,
+            self.index.by_expression(expression)
+        )
+        seen = set(doc_ids)
+        others = []
+        query = Query.parse(expression)
+
+        if query.has_operators():
+            matches = self.index.by_query(query)
+
+        else:
+            matches = self.index.by_prefix(expression)
+            matches += self.index.by_query(query)
+            text_matches = self.db.search_text(expression)
+
+            if text_matches:
+                matches += text_matches
+
+        for doc_id in matches:
+            # Full text results may not be up to date with the index
+            if doc_id not in seen and doc_id in self.index:
+                seen.add(doc_id)
+                others.append(doc_id)
+
+        doc_ids += self.popularity.order(expression, others)
+
+        if not doc_ids and not query.has_operators():
+            doc_ids = self.index.by_similarity(expression)
+
+        return doc_ids
+
+    @timed(DB_LATENCY, 'search_wats')
+    def search_wats(self, expression):
+        """Search WATs for an expression typed by a user.
+
+        Exact matches of the expression come first, followed by WATs whose
+        expressions or name start with the given text and WATs containing all
+        the words of the text (the last one possibly incomplete). Both groups
+        are sorted by popularity (see `record_chosen_wat()`). If none of
+        those match, the expression is treated as misspelled and the most
+        similar WATs are returned instead.
+
+        Expressions using `|` (or) or `-` (not) are evaluated as boolean
+        queries instead (see nekowatbot.query).
+
+        Returns:
+            List of database rows
+        """
+        return self.db.get_many(self._search_ids(expression))
+
+    def _cached_search(self, expression):
+        """Get the ordered search results of an expression from the cache.
+
+        Results are computed and stored in the cache on a miss.
+
+        Returns:
+            List of WAT IDs
+        """
+        # Read first, so that results computed while the catalog changes are
+        # not cached as current
+        generation = self.search_cache.generation
+        doc_ids = self.search_cache.get(expression)
+
+        if doc_ids is None:
+            if expression:
+                doc_ids = self._search_ids(expression)
+
+            else:
+                doc_ids = self.popularity.order('', self.index.all())
+
+            self.search_cache.put(expression, doc_ids, generation)
+
+        return doc_ids
+
+    @timed(DB_LATENCY, 'get_random_wat')
+    def get_random_wat(self, expression=None):
+        """Get a random WAT that matches an expression.
+
+        Exact matches are picked in constant time from the index. Otherwise a
+        WAT is picked from the (cached) prefix or fuzzy search results, and if
+        nothing matches at all, from the whole catalog.
+
+        Args:
+            expression (str): Normalized expression. If empty, any WAT may be
+                returned.
+
+        Returns:
+            Database row, or None if the database is empty.
+        """
+        doc_id = None
+
+        if expression:
+            doc_id = self.index.random(expression, self.weighted_random)
+
+            if doc_id is None:
+                doc_ids = self._cached_search(expression)
+
+                if doc_ids:
+                    doc_id = random.choice(doc_ids)
+
+        if doc_id is None:
+            doc_id = self.index.random(weighted=self.weighted_random)
+
+        if doc_id is None:
+            return None
+
+        return self.db.get(doc_id)
+
+    @timed(DB_LATENCY, 'get_wats_page')
+    def get_wats_page(self, expression, offset=0):
+        """Get a page of results for an inline query.
+
+        The full ordered result list of the expression is computed once and
+        cached, so every page is sliced from the same ordering.
+
+        Args:
+            expression (str): Normalized expression. If empty, all WATs are
+                returned.
+            offset (int): Position of the first result of the page.
+
+        Returns:
+            Tuple containing the list of database rows of the page and the
+            offset of the next page (or None if this is the last page).
+        """
+        doc_ids = self._cached_search(expression)
+        end = offset + self.inline_page_size
+        next_offset = end if end < len(doc_ids) else None
+
+        return self.db.get_many(doc_ids[offset:end]), next_offset
+
+    def record_chosen_wat(self, expression, doc_id):
+        """Count a WAT chosen by a user from the results of an inline query.
+
+        The choice is only queued here. Counters are updated and written in
+        the background, and the new order of the results is used once the
+        cached results are invalidated.
+
+        Args:
+            expression (str): Normalized expression of the inline query.
+            doc_id (int): ID of the chosen WAT.
+        """
+        if doc_id in self.index:
+            self.popularity.record(expression, doc_id)
+
+    @timed(DB_LATENCY, 'wat_exists')
     def wat_exists(self, name):
         """Check whether a wat exists already."""
-        wat = self.db.get(self.wat.name == name)
+        wat = self.db.get_by_name(name)
 
         if wat:
             return True
 
         return False
 
+    @timed(DB_LATENCY, 'get_wat')
     def get_wat(self, name):
         """Get a WAT by name."""
-        return self.db.get(self.wat.name == name)
+        return self.db.get_by_name(name)
+
+    @timed(DB_LATENCY, 'get_wat_by_id')
+    def get_wat_by_id(self, doc_id):
+        """Get a WAT by ID."""
+        if doc_id not in self.index:
+            return None
+
+        return self.db.get(doc_id)
+
+    @timed(DB_LATENCY, 'get_wats_by_name')
+    def get_wats_by_name(self, offset=0, limit=None):
+        """Get a slice of the WATs ordered by name.
 
-    def set_wat_expressions(self, name, expressions):
-        """Update a WAT and set the new expressions."""
-        self.db.update(
-            {'expressions': expressions},
-            self.wat.name == name
+        Only the WATs in the slice are read from the database.
+
+        Args:
+            offset (int): Position of the first WAT.
+            limit (int): Maximum number of WATs to return.
+
+        Returns:
+            Tuple containing the list of database rows and the total number
+            of WATs.
+        """
+        return (
+            self.db.get_many(self.index.by_name(offset, limit)),
+            len(self.index)
         )
 
+    def get_name_offset(self, prefix):
+        """Get the position of the first WAT whose name starts with a prefix.
+
+        See `get_wats_by_name()`. If no name starts with the prefix, this is
+        the position where such a name would be.
+        """
+        return self.index.name_position(normalize(prefix))
+
+    @timed(DB_LATENCY, 'set_wat_expressions')
+    def set_wat_expressions(self, doc_id, expressions):
+        """Update a WAT and set the new expressions.
+
+        Returns:
+            Boolean indicating if the WAT was updated or not.
+        """
+        if doc_id not in self.index:
+            return False
+
+        self.db.update(doc_id, {'expressions': expressions})
+        self.index.set_expressions(doc_id, expressions)
+        self._catalog_changed()
+
+        return True
+
+    @timed(DB_LATENCY, 'set_wat_weight')
+    def set_wat_weight(self, name, weight):
+        """Update a WAT and set its weight for random selection."""
+        wat = self.db.get_by_name(name)
+
+        if not wat:
+            return False
+
+        self.db.update(wat.doc_id, {'weight': weight})
+        self.index.set_weight(wat.doc_id, weight)
+        self._publish()
+
+        return True
+
+    @timed(DB_LATENCY, 'remove_wat')
     def remove_wat(self, doc_id):
         """Remove a WAT by ID."""
-        return self.db.remove(doc_ids=[doc_id,])
+        result = self.db.remove(doc_id)
+        self.index.remove(doc_id)
+        self.popularity.forget(doc_id)
+        self._catalog_changed()
+
+        return result
 
 
 # Bot instance
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""Access control of the bot."""
+
+import threading
+
+
+class AccessList(object):
+    """Users allowed to use the bot, indexed by ID for constant time checks.
+
+    The whitelist of the configuration maps names to user IDs, so checking a
+    user against it would mean scanning its values. Instead, a reverse index
+    counting the names of each ID is updated as names are added and removed,
+    and a check is a single lookup.
+
+    Attributes:
+
+    names (dict): User ID of each name, as stored in the configuration. The
+        dict is modified in place, so it may be shared with the configuration.
+    owner (int): ID of the owner, who is always allowed.
+    _refs (dict): Number of names of each allowed user ID. The owner has an
+        extra reference that is never removed.
+    _lock (Lock): Lock serializing changes. When the names are shared with
+        the configuration, this is the lock of the configuration, so that
+        they are not modified while being saved.
+    """
+
+    def __init__(self, names=None, owner=None, lock=None):
+        self.owner = owner
+        self._lock = lock or threading.Lock()
+        self.replace(names if names is not None else {})
+
+    def __contains__(self, user_id):
+        return user_id in self._refs
+
+    def __len__(self):
+        return len(self.names)
+
+    def _ref(self, refs, user_id):
+        refs[user_id] = refs.get(user_id, 0) + 1
+
+    def add(self, name, user_id):
+        """Allow a user under a name.
+
+        Returns:
+            Boolean indicating if the name was added or not.
+        """
+        with self._lock:
+            if name in self.names:
+                return False
+
+            self.names[name] = user_id
+            self._ref(self._refs, user_id)
+
+        return True
+
+    def remove(self, name):
+        """Remove a name, and its user if it has no other name.
+
+        Returns:
+            Boolean indicating if the name was removed or not.
+        """
+        with self._lock:
+            if name not in self.names:
+                return False
+
+            user_id = self.names.pop(name)
+            self._refs[user_id] -= 1
+
+            if not self._refs[user_id]:
+                del self._refs[user_id]
+
+        return True
+
+    def replace(self, names):
+        """Replace every name at once, e.g. after reloading the configuration.
+
+        The new index is built aside and then swapped in, so that checks
+        running meanwhile see either the old or the new list.
+        """
+        refs = {}
+
+        if self.owner is not None:
+            self._ref(refs, self.owner)
+
+        for user_id in names.values():
+            self._ref(refs, user_id)
+
+        with self._lock:
+            self.names = names
+            self._refs = refs
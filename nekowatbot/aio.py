@@ -0,0 +1,793 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""asyncio bot engine.
+
+This module implements the subset of the `TeleBot` API used by the bot on top
+of asyncio and a pooled aiohttp session, so that a single thread can handle
+many concurrent updates without blocking on HTTPS requests.
+
+Handlers are registered with the same decorators as in `TeleBot` and may be
+either plain functions or coroutine functions. Plain functions run directly
+on the event loop, so they must not block: the methods used to call the
+Telegram API return immediately and perform the request in the background.
+Methods that send messages return a `PendingMessage` that can be used in
+`reply_to()` and `register_next_step_handler()` as if it were the message
+sent, and requests to the same chat are always performed in order.
+"""
+
+import asyncio
+import logging
+import re
+
+import aiohttp
+
+from telebot import types, util
+
+from nekowatbot.metrics import count_api_error, count_updates
+from nekowatbot.supervisor import UpdateLedger
+
+
+logger = logging.getLogger('TeleBot')
+
+API_URL = 'https://api.telegram.org/bot{0}/{1}'
+
+
+class ApiError(Exception):
+    """Error returned by the Telegram API.
+
+    Attributes:
+
+    method (str): Name of the API method called.
+    error_code (int): Error code returned by Telegram (or the HTTP status).
+    description (str): Description of the error.
+    retry_after (int): Seconds to wait before retrying, if rate limited.
+    """
+
+    def __init__(self, method, error_code, description, retry_after=None):
+        super(ApiError, self).__init__(
+            'A request to the Telegram API was unsuccessful. '
+            'Error code: %s Description: %s' % (error_code, description)
+        )
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class PendingChat(object):
+    """Minimal chat object of a pending message."""
+
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class PendingMessage(object):
+    """Message that is being sent in the background.
+
+    Attributes:
+
+    chat (PendingChat): Chat the message is sent to.
+    future (Future): Future that resolves to the `Message` sent.
+    """
+
+    def __init__(self, chat_id, future):
+        self.chat = PendingChat(chat_id)
+        self.future = future
+
+    @property
+    def message_id(self):
+        """ID of the message, or None if it has not been sent yet."""
+        if self.future.done() and not self.future.exception():
+            return self.future.result().message_id
+
+        return None
+
+
+class AsyncTeleBot(object):
+    """Telegram bot running on an asyncio event loop.
+
+    Attributes:
+
+    token (str): Telegram bot token.
+    api_url (str): Format string of the URLs of the API methods.
+    skip_pending (bool): Whether to discard updates sent before starting.
+    limiter (RateLimiter): Rate limiter of outbound requests, if any.
+    max_retries (int): Times a rate limited request is retried.
+    offset_store (UpdateOffsetStore): Where to persist the ID of the last
+        update processed, if anywhere.
+    inline_tracker (InlineTracker): If set, tracks the inline queries
+        received and drops the superseded ones.
+    last_update_id (int): ID of the last update received.
+    ledger (UpdateLedger): Updates received that are still being processed.
+    message_handlers (list): Registered message handlers.
+    inline_handlers (list): Registered inline query handlers.
+    chosen_inline_handlers (list): Registered chosen inline result handlers.
+    callback_query_handlers (list): Registered callback query handlers.
+    next_step_handlers (dict): Handlers for the next message of each chat.
+    _connection_limit (int): Maximum number of simultaneous connections.
+    _session (ClientSession): HTTP session, created when polling starts.
+    _loop (AbstractEventLoop): Loop the bot is running on.
+    _stop (Event): Event used to stop polling.
+    _chat_tails (dict): Last request scheduled for each chat, used to keep
+        requests to the same chat in order.
+    _tasks (set): Background tasks currently running.
+    """
+
+    def __init__(self, token, skip_pending=False, api_url=API_URL,
+                 connection_limit=100, limiter=None, max_retries=3):
+        self.token = token
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.api_url = api_url
+        self.skip_pending = skip_pending
+        self.last_update_id = 0
+        self.offset_store = None
+        self.inline_tracker = None
+        self.ledger = UpdateLedger()
+
+        self.message_handlers = []
+        self.inline_handlers = []
+        self.chosen_inline_handlers = []
+        self.callback_query_handlers = []
+        self.next_step_handlers = {}
+
+        self._connection_limit = connection_limit
+        self._session = None
+        self._loop = None
+        self._stop = None
+        self._chat_tails = {}
+        self._tasks = set()
+
+    # Handler registration
+
+    @staticmethod
+    def _build_handler_dict(handler, **filters):
+        return {
+            'function': handler,
+            'filters': filters
+        }
+
+    def message_handler(self, commands=None, regexp=None, func=None,
+                        content_types=['text'], **kwargs):
+        """Message handler decorator. See `TeleBot.message_handler()`."""
+        def decorator(handler):
+            self.message_handlers.append(self._build_handler_dict(
+                handler,
+                commands=commands,
+                regexp=regexp,
+                func=func,
+                content_types=content_types,
+                **kwargs
+            ))
+
+            return handler
+
+        return decorator
+
+    def inline_handler(self, func, **kwargs):
+        """Inline query handler decorator."""
+        def decorator(handler):
+            self.inline_handlers.append(
+                self._build_handler_dict(handler, func=func, **kwargs)
+            )
+
+            return handler
+
+        return decorator
+
+    def chosen_inline_handler(self, func, **kwargs):
+        """Chosen inline result handler decorator."""
+        def decorator(handler):
+            self.chosen_inline_handlers.append(
+                self._build_handler_dict(handler, func=func, **kwargs)
+            )
+
+            return handler
+
+        return decorator
+
+    def callback_query_handler(self, func, **kwargs):
+        """Callback query handler decorator."""
+        def decorator(handler):
+            self.callback_query_handlers.append(
+                self._build_handler_dict(handler, func=func, **kwargs)
+            )
+
+            return handler
+
+        return decorator
+
+    def register_next_step_handler(self, message, callback, *args, **kwargs):
+        """Register a callback for the next message in the chat of `message`.
+        """
+        self.next_step_handlers.setdefault(message.chat.id, []).append({
+            'callback': callback,
+            'args': args,
+            'kwargs': kwargs
+        })
+
+    # Update processing
+
+    def process_new_updates(self, updates):
+        """Dispatch updates to the registered handlers.
+
+        Every handler runs in its own task, so that slow handlers do not delay
+        the rest of the updates. An update is pending until its handler tasks
+        and the requests they schedule finish, and only the updates before
+        the oldest pending one are confirmed when the offset is saved.
+        """
+        count_updates(updates)
+
+        if updates:
+            self._dispatch(updates)
+
+        # Saved for empty batches as well, as updates finish in between
+        self.save_offset()
+
+    def _dispatch(self, updates):
+        """Dispatch updates to the handlers, holding them meanwhile."""
+        self.ledger.receive([u.update_id for u in updates])
+
+        for update in updates:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+
+        handled = updates
+
+        if self.inline_tracker is not None:
+            handled = self.inline_tracker.track(updates)
+
+        for update in handled:
+            # Tasks created by the handlers inherit the update being handled
+            previous = self.ledger.set_current(update.update_id)
+
+            try:
+                self._dispatch_update(update)
+
+            finally:
+                self.ledger.set_current(previous)
+
+        for update in updates:
+            self.ledger.release(update.update_id)
+
+    def _dispatch_update(self, update):
+        """Dispatch a single update to its handlers."""
+        if update.message:
+            self._process_message(update.message)
+
+        if update.inline_query:
+            self._notify(self.inline_handlers, update.inline_query)
+
+        if update.chosen_inline_result:
+            self._notify(
+                self.chosen_inline_handlers,
+                update.chosen_inline_result
+            )
+
+        if update.callback_query:
+            self._notify(
+                self.callback_query_handlers,
+                update.callback_query
+            )
+
+    def save_offset(self):
+        """Persist the ID of the last update processed, if enabled."""
+        if not self.offset_store:
+            return
+
+        offset = self.ledger.offset()
+
+        if offset is not None:
+            self.offset_store.save(offset)
+
+    def _process_message(self, message):
+        """Dispatch a message to next step handlers or message handlers."""
+        handlers = self.next_step_handlers.pop(message.chat.id, None)
+
+        if handlers:
+            for handler in handlers:
+                self._exec_task(
+                    handler['callback'],
+                    message,
+                    *handler['args'],
+                    **handler['kwargs']
+                )
+
+            return
+
+        self._notify(self.message_handlers, message)
+
+    def _notify(self, handlers, obj):
+        """Execute the first handler whose filters accept the object."""
+        for handler in handlers:
+            if self._test_handler(handler, obj):
+                self._exec_task(handler['function'], obj)
+                break
+
+    @staticmethod
+    def _test_handler(handler, obj):
+        """Check the filters of a handler. See `TeleBot._test_filter()`."""
+        for name, value in handler['filters'].items():
+            if value is None:
+                continue
+
+            if name == 'content_types':
+                ok = obj.content_type in value
+
+            elif name == 'regexp':
+                ok = (
+                    obj.content_type == 'text'
+                    and re.search(value, obj.text, re.IGNORECASE)
+                )
+
+            elif name == 'commands':
+                ok = (
+                    obj.content_type == 'text'
+                    and util.extract_command(obj.text) in value
+                )
+
+            elif name == 'func':
+                ok = value(obj)
+
+            else:
+                ok = False
+
+            if not ok:
+                return False
+
+        return True
+
+    def _exec_task(self, task, *args, **kwargs):
+        """Run a handler, in a new task if it is a coroutine function."""
+        if asyncio.iscoroutinefunction(task):
+            self._spawn(task(*args, **kwargs))
+            return
+
+        try:
+            task(*args, **kwargs)
+
+        except Exception:
+            logger.exception('Error in handler %s', task)
+
+    def _spawn(self, coro):
+        """Run a coroutine in the background, keeping a reference to it.
+
+        A task spawned while handling an update keeps the update pending
+        until the task finishes.
+        """
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+        update_id = self.ledger.hold_current()
+
+        if update_id is not None:
+            task.add_done_callback(lambda _: self.ledger.release(update_id))
+
+        return task
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+
+        if not task.cancelled() and task.exception():
+            logger.error('Error in background task: %s', task.exception())
+
+    # Telegram API
+
+    async def request(self, method, params=None):
+        """Call a method of the Telegram API.
+
+        Args:
+            method (str): Name of the method.
+            params (dict): Parameters of the method. Values that are None
+                are not sent.
+
+        Returns:
+            The `result` of the response.
+
+        Raises:
+            ApiError if the request failed.
+        """
+        data = {}
+
+        for key, value in (params or {}).items():
+            if value is None:
+                continue
+
+            if hasattr(value, 'to_json'):
+                value = value.to_json()
+
+            elif isinstance(value, bool):
+                value = 'true' if value else 'false'
+
+            elif not isinstance(value, str):
+                value = str(value)
+
+            data[key] = value
+
+        url = self.api_url.format(self.token, method)
+
+        try:
+            async with self._session.post(url, data=data) as response:
+                try:
+                    result = await response.json(content_type=None)
+
+                except ValueError:
+                    raise ApiError(method, response.status, response.reason)
+
+            if not result.get('ok'):
+                raise ApiError(
+                    method,
+                    result.get('error_code', response.status),
+                    result.get('description'),
+                    result.get('parameters', {}).get('retry_after')
+                )
+
+        except (ApiError, aiohttp.ClientError) as e:
+            count_api_error(e)
+            raise
+
+        return result['result']
+
+    async def _limited_request(self, chat_id, method, params, limited=True):
+        """Call a method of the API respecting the rate limits.
+
+        Rate limited requests are retried after the time indicated by
+        Telegram, up to `max_retries` times.
+
+        Args:
+            limited (bool): Whether the request counts against the rate
+                limits of messages. Answers to queries do not.
+        """
+        retries = 0
+
+        while True:
+            if self.limiter and limited:
+                wait = self.limiter.acquire(chat_id)
+
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = self.limiter.acquire(chat_id)
+
+            try:
+                return await self.request(method, params)
+
+            except ApiError as e:
+                if e.error_code != 429 or retries >= self.max_retries:
+                    raise
+
+                retries += 1
+                retry_after = e.retry_after or 1
+
+                if self.limiter and limited:
+                    self.limiter.block(chat_id, retry_after)
+
+                else:
+                    await asyncio.sleep(retry_after)
+
+    def _send(self, chat_id, method, params, reply_to=None):
+        """Schedule a request to a chat after the previous ones.
+
+        Args:
+            chat_id (int): Chat the request is addressed to.
+            method (str): Name of the API method.
+            params (dict): Parameters of the method.
+            reply_to (PendingMessage): Message to reply to once it is sent.
+
+        Returns:
+            Future that resolves to the result of the request.
+        """
+        previous = self._chat_tails.get(chat_id)
+
+        async def run():
+            if previous is not None:
+                await asyncio.wait([previous])
+
+            if isinstance(reply_to, PendingMessage):
+                try:
+                    message = await reply_to.future
+                    params['reply_to_message_id'] = message.message_id
+
+                except Exception:
+                    pass
+
+            return await self._limited_request(chat_id, method, params)
+
+        task = self._spawn(run())
+        self._chat_tails[chat_id] = task
+
+        def cleanup(t):
+            if self._chat_tails.get(chat_id) is t:
+                del self._chat_tails[chat_id]
+
+        task.add_done_callback(cleanup)
+
+        return task
+
+    def _send_message_request(self, chat_id, method, params, reply_to=None):
+        """Schedule a request that returns a message."""
+        future = self._loop.create_future()
+        task = self._send(chat_id, method, params, reply_to)
+
+        def resolve(t):
+            if t.cancelled():
+                future.cancel()
+
+            elif t.exception():
+                future.set_exception(t.exception())
+
+                # Already logged by the task, avoid warnings if unused
+                future.exception()
+
+            else:
+                future.set_result(types.Message.de_json(t.result()))
+
+        task.add_done_callback(resolve)
+
+        return PendingMessage(chat_id, future)
+
+    def send_message(self, chat_id, text, disable_web_page_preview=None,
+                     reply_to_message_id=None, reply_markup=None,
+                     parse_mode=None, disable_notification=None):
+        """Send a text message. See `TeleBot.send_message()`.
+
+        Returns:
+            PendingMessage
+        """
+        params = {
+            'chat_id': chat_id,
+            'text': text,
+            'disable_web_page_preview': disable_web_page_preview,
+            'reply_markup': reply_markup,
+            'parse_mode': parse_mode,
+            'disable_notification': disable_notification
+        }
+
+        if not isinstance(reply_to_message_id, PendingMessage):
+            params['reply_to_message_id'] = reply_to_message_id
+            reply_to_message_id = None
+
+        return self._send_message_request(
+            chat_id,
+            'sendMessage',
+            params,
+            reply_to_message_id
+        )
+
+    def reply_to(self, message, text, **kwargs):
+        """Reply to a message, which may still be pending."""
+        if isinstance(message, PendingMessage):
+            reply_to = message
+
+        else:
+            reply_to = message.message_id
+
+        return self.send_message(
+            message.chat.id,
+            text,
+            reply_to_message_id=reply_to,
+            **kwargs
+        )
+
+    def send_photo(self, chat_id, photo, caption=None,
+                   reply_to_message_id=None, reply_markup=None,
+                   parse_mode=None, disable_notification=None):
+        """Send a photo by file ID. See `TeleBot.send_photo()`.
+
+        Returns:
+            PendingMessage
+        """
+        return self._send_message_request(
+            chat_id,
+            'sendPhoto',
+            {
+                'chat_id': chat_id,
+                'photo': photo,
+                'caption': caption,
+                'reply_to_message_id': reply_to_message_id,
+                'reply_markup': reply_markup,
+                'parse_mode': parse_mode,
+                'disable_notification': disable_notification
+            }
+        )
+
+    def answer_inline_query(self, inline_query_id, results, cache_time=None,
+                            is_personal=None, next_offset=None,
+                            switch_pm_text=None, switch_pm_parameter=None):
+        """Answer an inline query. See `TeleBot.answer_inline_query()`.
+
+        Returns:
+            Task performing the request.
+        """
+        return self._spawn(self._limited_request(
+            None,
+            'answerInlineQuery',
+            {
+                'inline_query_id': inline_query_id,
+                'results': '[%s]' % ','.join(r.to_json() for r in results),
+                'cache_time': cache_time,
+                'is_personal': is_personal,
+                'next_offset': next_offset,
+                'switch_pm_text': switch_pm_text,
+                'switch_pm_parameter': switch_pm_parameter
+            },
+            limited=False
+        ))
+
+    def answer_callback_query(self, callback_query_id, text=None,
+                              show_alert=None, url=None, cache_time=None):
+        """Answer a callback query. See `TeleBot.answer_callback_query()`.
+
+        Returns:
+            Task performing the request.
+        """
+        return self._spawn(self._limited_request(
+            None,
+            'answerCallbackQuery',
+            {
+                'callback_query_id': callback_query_id,
+                'text': text,
+                'show_alert': show_alert,
+                'url': url,
+                'cache_time': cache_time
+            },
+            limited=False
+        ))
+
+    def edit_message_text(self, text, chat_id=None, message_id=None,
+                          inline_message_id=None, parse_mode=None,
+                          disable_web_page_preview=None, reply_markup=None):
+        """Edit the text of a message. See `TeleBot.edit_message_text()`.
+
+        Returns:
+            Task performing the request.
+        """
+        return self._send(chat_id, 'editMessageText', {
+            'text': text,
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'inline_message_id': inline_message_id,
+            'parse_mode': parse_mode,
+            'disable_web_page_preview': disable_web_page_preview,
+            'reply_markup': reply_markup
+        })
+
+    # Polling
+
+    async def get_updates(self, offset=None, limit=None, timeout=20):
+        """Get updates using long polling.
+
+        Returns:
+            List of `Update` objects.
+        """
+        result = await self.request('getUpdates', {
+            'offset': offset,
+            'limit': limit,
+            'timeout': timeout
+        })
+
+        return [types.Update.de_json(u) for u in result]
+
+    async def _skip_updates(self):
+        """Discard the updates sent before starting."""
+        updates = await self.get_updates(offset=-1, timeout=0)
+
+        for update in updates:
+            self.last_update_id = max(self.last_update_id, update.update_id)
+
+    async def open(self):
+        """Prepare the bot to run on the current event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self._connection_limit,
+                keepalive_timeout=60
+            )
+        )
+
+    async def close(self):
+        """Wait for pending requests, close the HTTP session and save the
+        offset.
+        """
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=10)
+
+        await self._session.close()
+        self._session = None
+
+        # Confirm the updates finished while waiting
+        self.save_offset()
+
+    async def wait_stopped(self):
+        """Wait until `stop_polling()` is called."""
+        await self._stop.wait()
+
+    async def run(self, none_stop=False, interval=0, timeout=20):
+        """Poll for updates until `stop_polling()` is called."""
+        await self.open()
+        error_interval = .25
+
+        try:
+            if self.skip_pending:
+                await self._skip_updates()
+                self.skip_pending = False
+
+            while not self._stop.is_set():
+                poll = self._loop.create_task(self.get_updates(
+                    offset=self.last_update_id + 1,
+                    timeout=timeout
+                ))
+                stop = self._loop.create_task(self._stop.wait())
+
+                await asyncio.wait(
+                    [poll, stop],
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+
+                if not poll.done():
+                    poll.cancel()
+                    break
+
+                stop.cancel()
+
+                try:
+                    self.process_new_updates(poll.result())
+                    error_interval = .25
+
+                except (ApiError, aiohttp.ClientError,
+                        asyncio.TimeoutError) as e:
+                    logger.error(e)
+
+                    if not none_stop:
+                        break
+
+                    await asyncio.sleep(error_interval)
+                    error_interval = min(error_interval * 2, 60)
+
+                if interval:
+                    await asyncio.sleep(interval)
+
+        finally:
+            await self.close()
+
+    def polling(self, none_stop=False, interval=0, timeout=20):
+        """Run the event loop and poll for updates. See `TeleBot.polling()`.
+        """
+        asyncio.run(self.run(none_stop, interval, timeout))
+
+    def stop_polling(self):
+        """Stop polling. Can be called from any thread."""
+        if self._loop is None or self._stop is None:
+            return
+
+        if self._loop.is_closed():
+            return
+
+        self._loop.call_soon_threadsafe(self._stop.set)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Caches for search results."""
+
+import collections
+import threading
+import time
+
+from nekowatbot.metrics import CACHE_HITS, CACHE_MISSES
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entries.
+
+    Entries can also expire after a given time and are tagged with the
+    generation of the cache when they were stored. Invalidating the cache
+    simply increases the generation, so that every existing entry becomes
+    stale without walking the whole mapping.
+
+    Attributes:
+
+    maxsize (int): Maximum number of entries kept in the cache.
+    ttl (float): Seconds an entry is considered valid. None for no expiry.
+    name (str): Name of the cache, used to label its metrics, if any.
+    generation (int): Current generation of the cache.
+    hits (int): Number of successful lookups.
+    misses (int): Number of failed lookups (including stale entries).
+    _data (OrderedDict): Cached (value, generation, expiry) tuples, least
+        recently used first.
+    _lock (Lock): Lock protecting the cache from concurrent handler threads.
+    _hits (_CounterChild): Counter of the hits, if the cache has a name.
+    _misses (_CounterChild): Counter of the misses, if the cache has a name.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = CACHE_HITS.labels(name) if name else None
+        self._misses = CACHE_MISSES.labels(name) if name else None
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Get a value from the cache, marking it as recently used."""
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None:
+                self._miss()
+                return default
+
+            value, generation, expiry = entry
+
+            if (generation != self.generation
+                    or (expiry is not None and expiry < time.monotonic())):
+                del self._data[key]
+                self._miss()
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+
+            if self._hits is not None:
+                self._hits.inc()
+
+            return value
+
+    def _miss(self):
+        """Count a failed lookup. Must be called with the lock held."""
+        self.misses += 1
+
+        if self._misses is not None:
+            self._misses.inc()
+
+    def put(self, key, value, generation=None):
+        """Store a value in the cache, evicting old entries if needed.
+
+        Args:
+            key: Key of the value.
+            value: Value to store.
+            generation (int): Generation of the cache read before computing
+                the value. If the cache was invalidated since, the value may
+                be stale and is not stored.
+        """
+        expiry = None
+
+        if self.ttl is not None:
+            expiry = time.monotonic() + self.ttl
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._data[key] = (value, self.generation, expiry)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self):
+        """Mark every entry currently in the cache as stale."""
+        with self._lock:
+            self.generation += 1
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Get usage statistics of the cache.
+
+        Returns:
+            Dict with the number of entries, hits, misses and the hit ratio.
+        """
+        lookups = self.hits + self.misses
+
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""Configuration file of the bot.
+
+The configuration is read once at startup. Changes made by the bot (e.g. to
+the whitelist) are written back after a short delay, so that a burst of
+changes causes a single write, and always through a temporary file that then
+replaces the configuration, so that a crash never leaves a truncated file.
+Changes made to the file by anything else are detected through its
+modification time and reloaded without restarting the bot.
+"""
+
+import json
+import os
+import stat
+import tempfile
+import threading
+
+
+def write_atomic(path, data, mode='w'):
+    """Replace the contents of a file through a temporary file.
+
+    The temporary file keeps the permissions of the file it replaces, and
+    both the data and the rename are synced to disk.
+
+    Args:
+        path (str): Path to the file.
+        data (str|bytes): New contents of the file.
+        mode (str): Mode used to open the temporary file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory,
+        prefix='.%s.' % os.path.basename(path)
+    )
+
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        try:
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+
+        except OSError:
+            pass
+
+        os.replace(tmp_path, path)
+
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+    # Make the rename itself durable
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+
+    except OSError:
+        return
+
+    try:
+        os.fsync(dir_fd)
+
+    except OSError:
+        pass
+
+    finally:
+        os.close(dir_fd)
+
+
+class ConfigFile(object):
+    """JSON configuration file, saved atomically and reloaded when edited.
+
+    Attributes:
+
+    path (str): Path to the file.
+    save_delay (float): Seconds to wait after a change before writing the
+        file. 0 writes it right away.
+    data (dict): Parsed configuration.
+    _mtime (int): Modification time (in ns) of the file when it was last
+        read or written by this object.
+    _dirty (bool): Whether there are changes not yet written.
+    lock (RLock): Lock protecting the data and the pending write. Code
+        modifying the data must hold it, so that it is not serialized while
+        being modified.
+    _timer (Timer): Pending write, if any.
+    _flush_lock (Lock): Lock serializing writes, so that an older version
+        of the data never replaces a newer one.
+    _stop (Event): Event used to stop the watcher thread.
+    _watcher (Thread): Thread checking the file for changes, if any.
+    """
+
+    def __init__(self, path, save_delay=1):
+        self.path = path
+        self.save_delay = save_delay
+
+        self._dirty = False
+        self._timer = None
+        self.lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher = None
+
+        self.data = self._read()
+
+    def _stat(self):
+        """Get the modification time of the file, or None if missing."""
+        try:
+            return os.stat(self.path).st_mtime_ns
+
+        except OSError:
+            return None
+
+    def _read(self):
+        """Parse the file, remembering its modification time."""
+        self._mtime = self._stat()
+
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self):
+        """Write the configuration after the save delay."""
+        with self.lock:
+            self._dirty = True
+
+            if self.save_delay > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.save_delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+                return
+
+        self.flush()
+
+    def flush(self):
+        """Write pending changes of the configuration, if any.
+
+        The data is serialized while holding the lock, but written without
+        it.
+        """
+        with self._flush_lock:
+            with self.lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+
+                if not self._dirty:
+                    return
+
+                try:
+                    data = json.dumps(self.data)
+
+                except (TypeError, ValueError) as e:
+                    print('Failed to serialize configuration: %s' % e)
+                    return
+
+                self._dirty = False
+
+            try:
+                write_atomic(self.path, data)
+
+            except OSError as e:
+                print('Failed to write configuration: %s' % e)
+
+                with self.lock:
+                    self._dirty = True
+
+                return
+
+            with self.lock:
+                self._mtime = self._stat()
+
+    def changed(self):
+        """Check whether the file was modified by someone else.
+
+        Pending changes of this object take precedence over such changes.
+        """
+        with self._flush_lock, self.lock:
+            return not self._dirty and self._stat() != self._mtime
+
+    def reload(self):
+        """Parse the file again.
+
+        Returns:
+            The new configuration.
+
+        Raises:
+            OSError, ValueError: If the file cannot be read or parsed. The
+                current configuration is kept, and the same version of the
+                file is not tried again.
+        """
+        with self.lock:
+            try:
+                self.data = self._read()
+
+            except (OSError, ValueError):
+                self._mtime = self._stat()
+                raise
+
+            return self.data
+
+    def watch(self, interval, callback):
+        """Check the file for changes in the background.
+
+        Args:
+            interval (float): Seconds between checks.
+            callback (callable): Function receiving the new configuration
+                whenever it is reloaded.
+        """
+        def loop():
+            while not self._stop.wait(interval):
+                if not self.changed():
+                    continue
+
+                try:
+                    callback(self.reload())
+
+                except Exception as e:
+                    print('Failed to reload configuration: %s' % e)
+
+        self._watcher = threading.Thread(
+            target=loop,
+            name='ConfigWatcher',
+            daemon=True
+        )
+        self._watcher.start()
+
+    def stop(self):
+        """Stop watching the file and write pending changes."""
+        self._stop.set()
+        self.flush()
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""State of multi-step conversations.
+
+Admin commands such as `/add` span several messages. Instead of keeping a
+closure per chat, the state of each conversation is stored as a compact
+record with the following structure:
+
+    (state, data, expires)
+
+where `state` is the name of the step expecting the next message of the
+chat, `data` a small JSON serializable dict with the values collected so far
+and `expires` the time after which the conversation is abandoned.
+
+Records can be kept in memory or in a SQLite database, in which case
+conversations survive restarts and can be shared by several processes.
+"""
+
+import collections
+import json
+import sqlite3
+import threading
+import time
+
+
+def open_conversations(conf):
+    """Open the conversation store described in the configuration.
+
+    Args:
+        conf (dict): Optional keys `path` (SQLite file, conversations are
+            kept in memory if not provided), `ttl` (seconds) and `max_size`.
+
+    Returns:
+        Conversation store.
+    """
+    options = {
+        'ttl': conf.get('ttl', 3600),
+        'maxsize': conf.get('max_size', 10000)
+    }
+
+    if conf.get('path'):
+        return SQLiteConversationStore(conf['path'], **options)
+
+    return ConversationStore(**options)
+
+
+class ConversationStore(object):
+    """In-memory conversation store.
+
+    Attributes:
+
+    ttl (float): Seconds a conversation is kept since its last step.
+    maxsize (int): Maximum number of conversations kept. The oldest ones are
+        abandoned first.
+    _records (OrderedDict): Records by chat ID, oldest first.
+    _lock (Lock): Lock protecting the records.
+    """
+
+    def __init__(self, ttl=3600, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._records = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def _purge(self, now):
+        """Remove expired records.
+
+        Every record has the same TTL, so records are ordered by expiry.
+        """
+        while self._records:
+            chat_id, record = next(iter(self._records.items()))
+
+            if record[2] > now:
+                break
+
+            del self._records[chat_id]
+
+    def get(self, chat_id):
+        """Get the conversation of a chat.
+
+        Returns:
+            Tuple of state and data, or None if the chat is not in a
+            conversation.
+        """
+        record = self._records.get(chat_id)
+
+        if record is None or record[2] <= time.time():
+            return None
+
+        return record[0], record[1]
+
+    def set(self, chat_id, state, data=None):
+        """Set the step expecting the next message of a chat.
+
+        Args:
+            chat_id (int): Chat ID.
+            state (str): Name of the step.
+            data (dict): Values collected so far.
+        """
+        now = time.time()
+
+        with self._lock:
+            self._records.pop(chat_id, None)
+            self._records[chat_id] = (state, data or {}, now + self.ttl)
+
+            self._purge(now)
+
+            while len(self._records) > self.maxsize:
+                self._records.popitem(last=False)
+
+    def pop(self, chat_id):
+        """Remove and return the conversation of a chat. See `get()`."""
+        with self._lock:
+            record = self._records.pop(chat_id, None)
+
+        if record is None or record[2] <= time.time():
+            return None
+
+        return record[0], record[1]
+
+    def close(self):
+        """Close the store."""
+        pass
+
+
+class SQLiteConversationStore(object):
+    """Conversation store backed by a SQLite database.
+
+    Attributes:
+
+    ttl (float): Seconds a conversation is kept since its last step.
+    maxsize (int): Maximum number of conversations kept. The oldest ones are
+        abandoned first.
+    conn (Connection): Database connection, shared by all handler threads.
+    _lock (RLock): Lock serializing access to the connection.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS conversations ('
+        '    chat_id INTEGER PRIMARY KEY,'
+        '    state TEXT NOT NULL,'
+        '    data TEXT NOT NULL,'
+        '    expires REAL NOT NULL'
+        ')',
+        'CREATE INDEX IF NOT EXISTS conversations_expires '
+        '    ON conversations (expires)',
+    )
+
+    def __init__(self, path, ttl=3600, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.conn = sqlite3.connect(
+            path,
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=10
+        )
+        self._lock = threading.RLock()
+
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM conversations WHERE expires > ?',
+                (time.time(),)
+            ).fetchone()[0]
+
+    def get(self, chat_id):
+        """Get the conversation of a chat.
+
+        Returns:
+            Tuple of state and data, or None if the chat is not in a
+            conversation.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT state, data FROM conversations '
+                'WHERE chat_id = ? AND expires > ?',
+                (chat_id, time.time())
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return row[0], json.loads(row[1])
+
+    def set(self, chat_id, state, data=None):
+        """Set the step expecting the next message of a chat.
+
+        Args:
+            chat_id (int): Chat ID.
+            state (str): Name of the step.
+            data (dict): Values collected so far.
+        """
+        now = time.time()
+
+        with self._lock:
+            with self.conn:
+                self.conn.execute('BEGIN IMMEDIATE')
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO conversations '
+                    '(chat_id, state, data, expires) VALUES (?, ?, ?, ?)',
+                    (chat_id, state, json.dumps(data or {}), now + self.ttl)
+                )
+                self.conn.execute(
+                    'DELETE FROM conversations WHERE expires <= ?',
+                    (now,)
+                )
+                self.conn.execute(
+                    'DELETE FROM conversations WHERE chat_id IN ('
+                    '    SELECT chat_id FROM conversations '
+                    '    ORDER BY expires DESC LIMIT -1 OFFSET ?'
+                    ')',
+                    (self.maxsize,)
+                )
+
+    def pop(self, chat_id):
+        """Remove and return the conversation of a chat. See `get()`.
+
+        Only one process gets the conversation if several pop it at once.
+        """
+        with self._lock:
+            with self.conn:
+                self.conn.execute('BEGIN IMMEDIATE')
+                row = self.conn.execute(
+                    'SELECT state, data, expires FROM conversations '
+                    'WHERE chat_id = ?',
+                    (chat_id,)
+                ).fetchone()
+
+                if row is None:
+                    return None
+
+                self.conn.execute(
+                    'DELETE FROM conversations WHERE chat_id = ?',
+                    (chat_id,)
+                )
+
+        if row[2] <= time.time():
+            return None
+
+        return row[0], json.loads(row[1])
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""Handler executor with separate lanes for each class of update.
+
+By default the threaded engine runs every handler in a single thread pool,
+so a slow command of the owner (e.g. browsing the whole catalog) delays the
+inline queries queued behind it. Here handlers are sent to one of several
+lanes, each with its own queue and threads:
+
+- inline: inline queries, which must be answered while the user types.
+- user: commands and other updates of the users.
+- owner: commands of the owner, which may be slow but are rare.
+
+Each lane has a queue limit and a shedding policy applied when the queue is
+full: 'oldest' drops the call that has waited the longest (for inline
+queries, it is likely superseded already), while 'newest' rejects the new
+one. The time calls wait in the queue is recorded for every lane. Calls that
+are dropped or rejected are cancelled: if the function has a `cancel()`
+method, it is called with the arguments of the call.
+"""
+
+import collections
+import threading
+import time
+
+from nekowatbot.metrics import QUEUE_WAIT, SHED
+
+
+# Default settings of each lane
+LANES = {
+    'inline': {'threads': 4, 'max_queue': 200, 'shed': 'oldest'},
+    'user': {'threads': 2, 'max_queue': 500, 'shed': 'newest'},
+    'owner': {'threads': 1, 'max_queue': 0, 'shed': 'newest'},
+}
+
+SHED_POLICIES = ('oldest', 'newest')
+
+
+def _cancel(func, args, kwargs):
+    """Cancel a call that will not run."""
+    cancel = getattr(func, 'cancel', None)
+
+    if cancel is None:
+        return
+
+    try:
+        cancel(*args, **kwargs)
+
+    except Exception as e:
+        print('Error cancelling %s: %s' % (func, e))
+
+
+class Lane(object):
+    """Queue of handler calls served by its own threads.
+
+    Attributes:
+
+    name (str): Name of the lane, used to label its metrics.
+    max_queue (int): Maximum number of queued calls, or 0 for no limit.
+    shed (str): What to drop when the queue is full, either the 'oldest'
+        queued call or the 'newest' one being submitted.
+    _queue (deque): (time queued, function, args, kwargs) tuples.
+    _cond (Condition): Condition protecting the queue.
+    _running (bool): Whether new calls are accepted.
+    _threads (list): Threads of the lane.
+    _wait (_HistogramChild): Histogram of the time spent in the queue.
+    _shed (_CounterChild): Counter of the calls dropped.
+    """
+
+    def __init__(self, name, threads=1, max_queue=0, shed='newest'):
+        if shed not in SHED_POLICIES:
+            raise ValueError('Unknown shedding policy: %s' % shed)
+
+        self.name = name
+        self.max_queue = max_queue
+        self.shed = shed
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._running = True
+        self._wait = QUEUE_WAIT.labels(name)
+        self._shed = SHED.labels(name)
+
+        self._threads = [
+            threading.Thread(
+                target=self._work,
+                name='Lane-%s-%d' % (name, i),
+                daemon=True
+            )
+            for i in range(threads)
+        ]
+
+        for thread in self._threads:
+            thread.start()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def submit(self, func, args=(), kwargs=None):
+        """Queue a call.
+
+        Returns:
+            Boolean indicating if the call was queued or rejected.
+        """
+        kwargs = kwargs or {}
+        accepted = True
+        dropped = None
+
+        with self._cond:
+            if not self._running:
+                accepted = False
+
+            elif self.max_queue and len(self._queue) >= self.max_queue:
+                self._shed.inc()
+
+                if self.shed == 'newest':
+                    accepted = False
+
+                else:
+                    dropped = self._queue.popleft()[1:]
+
+            if accepted:
+                self._queue.append((time.monotonic(), func, args, kwargs))
+                self._cond.notify()
+
+        if not accepted:
+            dropped = (func, args, kwargs)
+
+        if dropped is not None:
+            _cancel(*dropped)
+
+        return accepted
+
+    def stop(self):
+        """Stop the threads once the queue is empty."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """Wait for the threads to exit after `stop()`."""
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self):
+        """Run queued calls until stopped."""
+        while True:
+            with self._cond:
+                while not self._queue and self._running:
+                    self._cond.wait()
+
+                if not self._queue:
+                    return
+
+                queued, func, args, kwargs = self._queue.popleft()
+
+            self._wait.observe(time.monotonic() - queued)
+
+            try:
+                func(*args, **kwargs)
+
+            except Exception as e:
+                print('Error in lane %s: %s' % (self.name, e))
+
+
+class HandlerExecutor(object):
+    """Runs handlers in the lane chosen for their arguments.
+
+    Attributes:
+
+    classify (callable): Function receiving the arguments of a handler (the
+        update object) and returning the name of its lane.
+    lanes (dict): Lanes indexed by name.
+    """
+
+    def __init__(self, classify, conf=None):
+        conf = conf or {}
+
+        self.classify = classify
+        self.lanes = dict(
+            (name, Lane(name, **dict(defaults, **conf.get(name, {}))))
+            for name, defaults in LANES.items()
+        )
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a handler call in its lane.
+
+        Returns:
+            Boolean indicating if the call was queued or rejected.
+        """
+        lane = self.lanes[self.classify(*args)]
+
+        return lane.submit(func, args, kwargs)
+
+    def stop(self):
+        """Stop every lane once its queue is empty."""
+        for lane in self.lanes.values():
+            lane.stop()
+
+    def join(self, timeout=None):
+        """Wait for every lane to stop."""
+        for lane in self.lanes.values():
+            lane.join(timeout)
@@ -27,22 +27,79 @@
 
 """Message handlers."""
 
-import random
-
 import telebot
 
 from nekowatbot import nekowat
 
 
+# Messages of any of these types may continue a conversation
+CONTENT_TYPES = [
+    'text', 'audio', 'document', 'photo', 'sticker', 'video', 'video_note',
+    'voice', 'location', 'contact'
+]
+
+# Steps of multi-step conversations by state name
+STEPS = {}
+
+# Number of WATs in each page of the keyboards to choose a WAT
+KEYBOARD_PAGE_SIZE = 10
+
+# Messages of the keyboards to choose a WAT, by action
+KEYBOARD_ACTIONS = {
+    'rm': 'Choose a WAT to delete',
+    'ex': 'Choose a WAT to modify'
+}
+
+
+def step(state):
+    """Register the function handling the messages of a conversation state.
+
+    The function receives the message and the data of the conversation as
+    keyword arguments.
+    """
+    def decorator(func):
+        STEPS[state] = func
+        return func
+
+    return decorator
+
+
+def in_conversation(message):
+    """Check whether the next message of a chat is expected by a step.
+
+    Only the owner starts conversations, so the conversation store is not
+    looked up for the messages of other chats.
+    """
+    return (
+        nekowat.is_owner(message.chat.id)
+        and nekowat.conversations.get(message.chat.id) is not None
+    )
+
+
+# Registered first so that it takes precedence over commands
+@nekowat.message_handler(func=in_conversation, content_types=CONTENT_TYPES)
+def handle_conversation(message):
+    """Pass a message to the step of the conversation of its chat."""
+    conversation = nekowat.conversations.pop(message.chat.id)
+
+    if conversation is None:
+        # Expired or handled by another worker in the meantime
+        return
+
+    state, data = conversation
+    STEPS[state](message, **data)
+
+
 @nekowat.message_handler(commands=['start', 'help'])
 def handle_start(message):
     """Initialize the bot."""
     response = (
         'nekowatbot - "What the!?"\n\n'
         '/add <name> : Add a new WAT\n'
-        '/remove : Remove a WAT\n'
+        '/remove [<name>] : Remove a WAT\n'
         '/wat <expression> : Get a random WAT\n'
-        '/setexpressions : Set the expressions of a WAT\n'
+        '/setexpressions [<name>] : Set the expressions of a WAT\n'
+        '/setweight <weight> <name> : Set how often a WAT is chosen\n'
         '/addwhitelist <name> <id> : Add user ID to whitelist\n'
         '/rmwhitelist <name> : Remove user from whitelist\n'
         '/whitelist : Show current whitelist\n'
@@ -82,16 +139,14 @@ def handle_add(message):
         nekowat.reply_to(message, 'There is already a WAT with that name')
         return
 
-    msg = nekowat.send_message(
+    nekowat.send_message(
         chat_id,
         'Please send the image for this WAT'
     )
 
-    nekowat.register_next_step_handler(
-        msg,
-        lambda m: process_add_image(m, name)
-    )
+    nekowat.conversations.set(chat_id, 'add_image', {'name': name})
 
+@step('add_image')
 def process_add_image(message, name):
     """Adds an image to the WAT."""
     chat_id = message.chat.id
@@ -101,15 +156,12 @@ def process_add_image(message, name):
         return
 
     if message.content_type != 'photo':
-        msg = nekowat.send_message(
+        nekowat.send_message(
             chat_id,
             'Please send the image for this WAT'
         )
 
-        nekowat.register_next_step_handler(
-            msg,
-            lambda m: process_add_image(m, name)
-        )
+        nekowat.conversations.set(chat_id, 'add_image', {'name': name})
 
         return
 
@@ -126,7 +178,21 @@ def process_add_image(message, name):
 def handle_remove(message):
     """Handle removing a WAT.
 
-    This shows all wats by name.
+    Expects a message with the format:
+
+        /remove [<name>]
+
+    This shows a page of WATs ordered by name, starting from the given name
+    (or its beginning) if any.
+    """
+    start_browsing(message, 'rm')
+
+
+def start_browsing(message, action):
+    """Show the keyboard to choose a WAT for an action.
+
+    While the keyboard is shown, sending text jumps to the WATs whose name
+    starts with it.
     """
     chat_id = message.chat.id
 
@@ -134,80 +200,164 @@ def handle_remove(message):
         nekowat.reply_to(message, 'You do not have permission to do that')
         return
 
-    markup = telebot.types.ReplyKeyboardMarkup(row_width=2)
+    prefix = telebot.util.extract_arguments(message.text)
+    offset = nekowat.get_name_offset(prefix) if prefix else 0
 
-    for w in nekowat.get_all_wats():
-        markup.add(telebot.types.KeyboardButton(w['name']))
+    send_wat_keyboard(chat_id, action, offset)
 
-    # Add cancel
-    markup.add(telebot.types.KeyboardButton('/cancel'))
+@step('browse_wats')
+def process_browse_wats(message, action):
+    """Jumps to the WATs whose name starts with the received text."""
+    chat_id = message.chat.id
 
-    msg = nekowat.send_message(
-        chat_id,
-        'Choose a WAT to delete',
-        reply_markup=markup
-    )
+    if message.content_type != 'text':
+        nekowat.send_message(chat_id, 'You need to send a WAT name')
+        nekowat.conversations.set(chat_id, 'browse_wats', {'action': action})
+        return
 
-    nekowat.register_next_step_handler(
-        msg,
-        lambda m: process_remove_wat(m)
-    )
+    if message.text == '/cancel':
+        nekowat.send_message(chat_id, 'Operation cancelled')
+        return
 
-def process_remove_wat(message):
-    """Removes a WAT from database."""
-    chat_id = message.chat.id
-    hide_markup = telebot.types.ReplyKeyboardRemove(selective=False)
+    send_wat_keyboard(chat_id, action, nekowat.get_name_offset(message.text))
 
-    if message.content_type != 'text':
-        msg = nekowat.send_message(chat_id, 'You need to send a bot name')
+def send_wat_keyboard(chat_id, action, offset):
+    """Send a page of the keyboard to choose a WAT."""
+    text, markup = build_wat_keyboard(action, offset)
 
-        nekowat.register_next_step_handler(
-            msg,
-            lambda m: process_remove_wat(m)
-        )
+    nekowat.send_message(chat_id, text, reply_markup=markup)
+    nekowat.conversations.set(chat_id, 'browse_wats', {'action': action})
 
-        return
+def build_wat_keyboard(action, offset):
+    """Build a page of the keyboard to choose a WAT.
 
-    if message.text == '/cancel':
-        nekowat.send_message(
-            chat_id,
-            'Operation cancelled',
-            reply_markup=hide_markup
+    Only the WATs of the page are fetched. Buttons send a callback query with
+    the data:
+
+        <action>:<command>:<value>
+
+    where the command is 's' to select the WAT with ID `value`, 'p' to show
+    the page starting at position `value` or 'c' to cancel.
+
+    Returns:
+        Tuple containing the text of the message and the keyboard.
+    """
+    wats, total = nekowat.get_wats_by_name(offset, KEYBOARD_PAGE_SIZE)
+    markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+
+    markup.add(*[
+        telebot.types.InlineKeyboardButton(
+            w['name'],
+            callback_data='%s:s:%d' % (action, w.doc_id)
         )
+        for w in wats
+    ])
 
-        return
+    navigation = []
+
+    if offset > 0:
+        navigation.append(telebot.types.InlineKeyboardButton(
+            '< Previous',
+            callback_data='%s:p:%d' % (
+                action,
+                max(offset - KEYBOARD_PAGE_SIZE, 0)
+            )
+        ))
 
-    # Fetch wat
-    name = message.text
-    wat = nekowat.get_wat(name)
+    if offset + KEYBOARD_PAGE_SIZE < total:
+        navigation.append(telebot.types.InlineKeyboardButton(
+            'Next >',
+            callback_data='%s:p:%d' % (action, offset + KEYBOARD_PAGE_SIZE)
+        ))
 
-    if not wat:
-        msg = nekowat.send_message(chat_id, 'No WAT found with that name')
+    if navigation:
+        markup.row(*navigation)
+
+    markup.row(telebot.types.InlineKeyboardButton(
+        'Cancel',
+        callback_data='%s:c:0' % action
+    ))
+
+    if wats:
+        position = '%d-%d of %d' % (offset + 1, offset + len(wats), total)
+
+    else:
+        position = 'no WATs here, %d in total' % total
+
+    text = '%s (%s)\n\nSend a name or its beginning to jump to it' % (
+        KEYBOARD_ACTIONS[action],
+        position
+    )
+
+    return text, markup
+
+
+@nekowat.callback_query_handler(lambda call: True)
+def handle_callback(call):
+    """Handle the buttons of the keyboards to choose a WAT.
 
-        nekowat.register_next_step_handler(
-            msg,
-            lambda m: process_remove_wat(m)
+    See `build_wat_keyboard()` for the format of the data of the buttons.
+    """
+    if not nekowat.is_owner(call.from_user.id) or not call.message:
+        nekowat.answer_callback_query(
+            call.id,
+            text='You do not have permission to do that'
         )
+        return
+
+    try:
+        action, command, value = call.data.split(':')
+        value = int(value)
 
+    except (AttributeError, ValueError):
+        nekowat.answer_callback_query(call.id)
         return
 
-    # Remove
-    result = nekowat.remove_wat(wat.doc_id)
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
 
-    if result:
-        nekowat.send_message(
+    if command == 'p':
+        text, markup = build_wat_keyboard(action, value)
+        nekowat.edit_message_text(
+            text,
             chat_id,
-            'Removed WAT %s' % name,
-            reply_markup=hide_markup
+            message_id,
+            reply_markup=markup
         )
-        return
 
-    nekowat.send_message(
-        chat_id,
-        'Failed to remove WAT WAT %s' % name,
-        reply_markup=hide_markup
-    )
-    return
+    elif command == 'c':
+        nekowat.conversations.pop(chat_id)
+        nekowat.edit_message_text('Operation cancelled', chat_id, message_id)
+
+    elif command == 's':
+        wat = nekowat.get_wat_by_id(value)
+
+        if not wat:
+            nekowat.answer_callback_query(
+                call.id,
+                text='That WAT no longer exists'
+            )
+            return
+
+        nekowat.conversations.pop(chat_id)
+
+        if action == 'rm':
+            remove_wat(chat_id, message_id, wat)
+
+        elif action == 'ex':
+            show_expressions(chat_id, message_id, wat)
+
+    nekowat.answer_callback_query(call.id)
+
+def remove_wat(chat_id, message_id, wat):
+    """Removes a WAT from database."""
+    if nekowat.remove_wat(wat.doc_id):
+        text = 'Removed WAT %s' % wat['name']
+
+    else:
+        text = 'Failed to remove WAT %s' % wat['name']
+
+    nekowat.edit_message_text(text, chat_id, message_id)
 
 
 @nekowat.message_handler(commands=['wat'])
@@ -224,21 +374,13 @@ def handle_wat(message):
         return
 
     # Normalize expression
-    expression = telebot.util.extract_arguments(message.text).lower()
+    expression = telebot.util.extract_arguments(message.text).lower().strip()
 
-    if not expression:
-        # Get all images
-        wats = nekowat.get_all_wats()
+    # Get by expression, by what the expression starts with or by similarity
+    # if the expression is misspelled. Defaults to any WAT
+    wat = nekowat.get_random_wat(expression)
 
-    else:
-        # Get by expression
-        wats = nekowat.get_wats_by_expression(expression)
-
-        if not wats:
-            # Default to all WATs
-            wats = nekowat.get_all_wats()
-
-    if not wats:
+    if not wat:
         # Happens when database is empty
         nekowat.reply_to(
             message,
@@ -246,9 +388,6 @@ def handle_wat(message):
         )
         return
 
-    # Choose random WAT and send file
-    wat = random.choice(wats)
-
     nekowat.send_photo(
         message.chat.id,
         wat['file_ids'][-1], # Get biggest image
@@ -260,45 +399,50 @@ def handle_wat(message):
 def handle_set_expressions(message):
     """Sets expressions for a WAT.
 
-    This shows all wats by name and then displays the expressions of the
-    WAT that was chosen.
-    """
-    chat_id = message.chat.id
-
-    if not nekowat.is_owner(chat_id):
-        nekowat.reply_to(message, 'You do not have permission to do that')
-        return
+    Expects a message with the format:
 
-    markup = telebot.types.ReplyKeyboardMarkup(row_width=2)
+        /setexpressions [<name>]
 
-    for w in nekowat.get_all_wats():
-        markup.add(telebot.types.KeyboardButton(w['name']))
+    This shows a page of WATs ordered by name (see `handle_remove()`) and
+    then displays the expressions of the WAT that was chosen.
+    """
+    start_browsing(message, 'ex')
 
-    # Add cancel
-    markup.add(telebot.types.KeyboardButton('/cancel'))
+def show_expressions(chat_id, message_id, wat):
+    """Shows the expressions of the selected WAT and asks for new ones."""
+    expressions = ','.join(wat['expressions'])
 
-    msg = nekowat.send_message(
+    nekowat.edit_message_text(
+        'Expressions of %s:\n\n%s\n\n'
+        'Send a comma separated list of expressions' % (
+            wat['name'],
+            expressions or '[No expressions defined]'
+        ),
         chat_id,
-        'Choose a WAT to modify',
-        reply_markup=markup
+        message_id
     )
 
-    nekowat.register_next_step_handler(
-        msg,
-        lambda m: process_get_expressions(m)
+    nekowat.conversations.set(
+        chat_id,
+        'set_expressions',
+        {'doc_id': wat.doc_id}
     )
 
-def process_get_expressions(message):
-    """Shows the expressions of the selected WAT and asks for new ones."""
+@step('set_expressions')
+def process_set_expressions(message, doc_id):
+    """Sets the expressions a wat."""
     chat_id = message.chat.id
-    hide_markup = telebot.types.ReplyKeyboardRemove(selective=False)
 
     if message.content_type != 'text':
-        msg = nekowat.send_message(chat_id, 'You need to send a WAT name')
+        nekowat.send_message(
+            chat_id,
+            'You need to send a comma separated list of expressions'
+        )
 
-        nekowat.register_next_step_handler(
-            msg,
-            lambda m: process_get_expressions(m)
+        nekowat.conversations.set(
+            chat_id,
+            'set_expressions',
+            {'doc_id': doc_id}
         )
 
         return
@@ -306,77 +450,52 @@ def process_get_expressions(message):
     if message.text == '/cancel':
         nekowat.send_message(
             chat_id,
-            'Operation cancelled',
-            reply_markup=hide_markup
+            'Operation cancelled'
         )
 
         return
 
-    # Fetch wat
-    name = message.text
-    wat = nekowat.get_wat(name)
-
-    if not wat:
-        msg = nekowat.send_message(chat_id, 'No WAT found with that name')
-
-        nekowat.register_next_step_handler(
-            msg,
-            lambda m: process_get_expressions(m)
-        )
+    # Update record
+    expressions = [e.lower().strip() for e in message.text.split(',')]
 
+    if not nekowat.set_wat_expressions(doc_id, expressions):
+        nekowat.send_message(chat_id, 'That WAT no longer exists')
         return
 
-    # Show expressions
-    expressions = ','.join(wat['expressions'])
-
-    msg = nekowat.send_message(
-        chat_id,
-        'Expressions of %s' % name,
-        reply_markup=hide_markup
-    )
+    nekowat.send_message(chat_id, 'Expressions updated')
 
-    nekowat.reply_to(msg, expressions or '[No expressions defined]')
 
-    msg = nekowat.send_message(
-        chat_id,
-        'Send a comma separated list of expressions'
-    )
+@nekowat.message_handler(commands=['setweight'])
+def handle_set_weight(message):
+    """Sets the weight of a WAT when choosing random WATs.
 
-    nekowat.register_next_step_handler(
-        msg,
-        lambda m: process_set_expressions(m, name)
-    )
+    Expects a message with the format:
 
-def process_set_expressions(message, name):
-    """Sets the expressions a wat."""
-    chat_id = message.chat.id
+        /setweight <weight> <name>
+    """
+    if not nekowat.is_owner(message.chat.id):
+        nekowat.reply_to(message, 'You do not have permission to do that')
+        return
 
-    if message.content_type != 'text':
-        msg = nekowat.send_message(
-            chat_id,
-            'You need to send a comma separated list of expressions'
-        )
+    args = telebot.util.extract_arguments(message.text).split(' ', 1)
 
-        nekowat.register_next_step_handler(
-            msg,
-            lambda m: process_set_expressions(m, name)
-        )
+    try:
+        weight = float(args[0])
+        name = args[1]
 
+    except:
+        nekowat.reply_to(message, '/setweight <weight> <name>')
         return
 
-    if message.text == '/cancel':
-        nekowat.send_message(
-            chat_id,
-            'Operation cancelled'
-        )
-
+    if weight < 0:
+        nekowat.reply_to(message, 'The weight cannot be negative')
         return
 
-    # Update record
-    expressions = [e.lower().strip() for e in message.text.split(',')]
-    nekowat.set_wat_expressions(name, expressions)
+    if nekowat.set_wat_weight(name, weight):
+        nekowat.reply_to(message, 'Weight updated')
+        return
 
-    nekowat.send_message(chat_id, 'Expressions updated')
+    nekowat.reply_to(message, 'No WAT found with that name')
 
 
 @nekowat.message_handler(commands=['addwhitelist'])
@@ -471,37 +590,105 @@ def handle_inline(inline_query):
 
     If no text is specified, returns a list of all WATs available. If text is
     specified, this is used as an expression to search for WATs in the
-    database.
+    database. Partial text also matches WATs with an expression or name that
+    starts with it, so that results appear while the user is typing.
+
+    Results are sent in pages, using the offset of the query to know which
+    page Telegram is asking for. Built answers are cached, as many users tend
+    to send the same queries.
+
+    Queries superseded by a newer query of the same user are dropped before
+    searching and before answering, as Telegram only shows the latest one.
     """
-    if not nekowat.is_allowed(inline_query.from_user.id):
-        nekowat.answer_inline_query(inline_query.id, [])
+    if not nekowat.inline_tracker.wait(inline_query):
         return
 
+    allowed = nekowat.is_allowed(inline_query.from_user.id)
+
     # Normalize expression
     expression = inline_query.query.lower().strip()
 
-    if not expression:
-        # Get all images
-        wats = nekowat.get_all_wats()
-
-    else:
-        # Get by expression
-        wats = nekowat.get_wats_by_expression(expression)
-
     try:
-        responses = []
-
-        for index, wat in enumerate(wats):
-            r = telebot.types.InlineQueryResultCachedPhoto(
-                str(index),
-                # Get smallest file for inline reply
-                wat['file_ids'][0],
-                parse_mode='' # Workaround for Telegram API error
-            )
+        offset = int(inline_query.offset or 0)
+
+    except ValueError:
+        offset = 0
 
-            responses.append(r)
+    key = (expression, offset, allowed)
+    generation = nekowat.inline_cache.generation
+    answer = nekowat.inline_cache.get(key)
 
-        nekowat.answer_inline_query(inline_query.id, responses)
+    try:
+        if answer is None:
+            answer = build_inline_answer(expression, offset, allowed)
+            nekowat.inline_cache.put(key, answer, generation)
+
+        if not nekowat.inline_tracker.is_current(inline_query):
+            return
+
+        responses, next_offset = answer
+
+        nekowat.answer_inline_query(
+            inline_query.id,
+            responses,
+            cache_time=nekowat.inline_cache_time,
+            is_personal=(
+                nekowat.inline_is_personal
+                or nekowat.use_whitelist
+                or not allowed
+            ),
+            next_offset=next_offset,
+            merge_key=('inline', inline_query.from_user.id)
+        )
 
     except Exception as e:
         print(e)
+
+    finally:
+        nekowat.inline_tracker.finish(inline_query)
+
+
+@nekowat.chosen_inline_handler(lambda result: True)
+def handle_chosen_inline(chosen_result):
+    """Counts the WATs chosen from inline results.
+
+    The counters are used to show the most popular WATs first. Telegram only
+    reports the results chosen if inline feedback is enabled for the bot
+    (`/setinlinefeedback` in BotFather).
+    """
+    try:
+        doc_id = int(chosen_result.result_id)
+
+    except ValueError:
+        return
+
+    # Same normalization as in handle_inline()
+    expression = chosen_result.query.lower().strip()
+
+    nekowat.record_chosen_wat(expression, doc_id)
+
+
+def build_inline_answer(expression, offset, allowed):
+    """Builds the results of a page of an inline query.
+
+    Returns:
+        Tuple containing the list of results and the next offset to send to
+        Telegram (empty if there are no more pages).
+    """
+    if not allowed:
+        return [], ''
+
+    wats, next_offset = nekowat.get_wats_page(expression, offset)
+    responses = []
+
+    for wat in wats:
+        r = telebot.types.InlineQueryResultCachedPhoto(
+            str(wat.doc_id),
+            # Get smallest file for inline reply
+            wat['file_ids'][0],
+            parse_mode='' # Workaround for Telegram API error
+        )
+
+        responses.append(r)
+
+    return responses, str(next_offset) if next_offset else ''
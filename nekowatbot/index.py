@@ -0,0 +1,981 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""In-memory search indexes for the WAT catalog."""
+
+import bisect
+import contextlib
+import itertools
+import random
+import threading
+import zlib
+
+import numpy as np
+
+from nekowatbot.query import EMPTY, tokenize
+
+
+# Versions of the prefix indexes, unique across instances
+_versions = itertools.count(1)
+
+
+def normalize(text):
+    """Normalize an expression or name for indexing and lookups."""
+    return text.lower().strip()
+
+
+class IdArray(object):
+    """Compact unordered set of document IDs.
+
+    IDs are stored in a list together with their position in it, so that
+    membership, insertion, removal (swapping the last element into the gap)
+    and uniform random selection are all O(1).
+
+    Attributes:
+
+    ids (list[int]): Document IDs in no particular order.
+    _pos (dict): Position of each ID in `ids`.
+    """
+
+    def __init__(self, ids=()):
+        self.ids = []
+        self._pos = {}
+
+        for doc_id in ids:
+            self.add(doc_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._pos
+
+    def add(self, doc_id):
+        """Add an ID to the array."""
+        if doc_id in self._pos:
+            return
+
+        self._pos[doc_id] = len(self.ids)
+        self.ids.append(doc_id)
+
+    def discard(self, doc_id):
+        """Remove an ID from the array by swapping in the last one."""
+        pos = self._pos.pop(doc_id, None)
+
+        if pos is None:
+            return
+
+        last = self.ids.pop()
+
+        if last != doc_id:
+            self.ids[pos] = last
+            self._pos[last] = pos
+
+    def choice(self):
+        """Get a random ID, or None if the array is empty."""
+        if not self.ids:
+            return None
+
+        return self.ids[random.randrange(len(self.ids))]
+
+
+class AliasTable(object):
+    """Walker's alias table for O(1) weighted random selection.
+
+    Building the table is O(n). It is meant to be built lazily and reused
+    until the weights change.
+
+    Attributes:
+
+    ids (list[int]): Document IDs that can be chosen.
+    _prob (list[float]): Probability of keeping each column.
+    _alias (list[int]): Alternative position of each column.
+    """
+
+    def __init__(self, ids, weights):
+        n = len(ids)
+        total = float(sum(weights))
+
+        self.ids = list(ids)
+        self._prob = [1.0] * n
+        self._alias = list(range(n))
+
+        if not n or total <= 0:
+            return
+
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+
+            self._prob[s] = scaled[s]
+            self._alias[s] = l
+
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+
+            if scaled[l] < 1.0:
+                small.append(l)
+
+            else:
+                large.append(l)
+
+        # Remaining columns are full (up to floating point errors)
+        for i in small + large:
+            self._prob[i] = 1.0
+
+    def choice(self):
+        """Get a random ID according to the weights, or None if empty."""
+        if not self.ids:
+            return None
+
+        i = random.randrange(len(self.ids))
+
+        if random.random() < self._prob[i]:
+            return self.ids[i]
+
+        return self.ids[self._alias[i]]
+
+
+class PrefixIndex(object):
+    """Sorted array of keys supporting prefix queries.
+
+    Keys are kept sorted so that every key starting with a given prefix lives
+    in a contiguous slice that can be located with a binary search. A query
+    therefore costs O(log n + k), with k being the number of matches.
+
+    New keys are appended and only sorted when the keys are next needed, so
+    that building the index costs a single sort instead of one insertion per
+    key.
+
+    Attributes:
+
+    _keys (list[str]): List of distinct keys, sorted unless `_unsorted`.
+    _unsorted (bool): Whether keys were appended since the last sort.
+    version (int): Number changed whenever a key is added or removed. It is
+        never reused, even by other instances.
+    _postings (dict): Reference counts of document IDs indexed by key. A
+        document may reference the same key more than once (e.g. through its
+        name and one of its expressions).
+    """
+
+    def __init__(self):
+        self.version = next(_versions)
+        self._keys = []
+        self._unsorted = False
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _sorted_keys(self):
+        """Get the list of keys, sorting it first if needed."""
+        if self._unsorted:
+            self._keys.sort()
+            self._unsorted = False
+
+        return self._keys
+
+    def keys(self):
+        """Get a copy of the sorted list of keys."""
+        return list(self._sorted_keys())
+
+    def get(self, key):
+        """Get the IDs of the documents referencing a key, ordered by ID."""
+        return sorted(self._postings.get(key, ()))
+
+    def add(self, key, doc_id):
+        """Add a reference from a key to a document."""
+        if not key:
+            return
+
+        postings = self._postings.get(key)
+
+        if postings is None:
+            postings = self._postings[key] = {}
+            self._keys.append(key)
+            self._unsorted = True
+            self.version = next(_versions)
+
+        postings[doc_id] = postings.get(doc_id, 0) + 1
+
+    def discard(self, key, doc_id):
+        """Remove a reference from a key to a document."""
+        postings = self._postings.get(key)
+
+        if not postings or doc_id not in postings:
+            return
+
+        postings[doc_id] -= 1
+
+        if postings[doc_id] <= 0:
+            del postings[doc_id]
+
+        if not postings:
+            keys = self._sorted_keys()
+
+            del self._postings[key]
+            del keys[bisect.bisect_left(keys, key)]
+            self.version = next(_versions)
+
+    def search(self, prefix, limit=None):
+        """Find documents with a key starting with the given prefix.
+
+        Args:
+            prefix (str): Normalized prefix.
+            limit (int): Maximum number of document IDs to return.
+
+        Returns:
+            List of unique document IDs, ordered by key and then by ID.
+        """
+        result = []
+        seen = set()
+
+        if not prefix:
+            return result
+
+        keys = self._sorted_keys()
+        start = bisect.bisect_left(keys, prefix)
+
+        for i in range(start, len(keys)):
+            key = keys[i]
+
+            if not key.startswith(prefix):
+                break
+
+            for doc_id in sorted(self._postings[key]):
+                if doc_id in seen:
+                    continue
+
+                seen.add(doc_id)
+                result.append(doc_id)
+
+                if limit and len(result) >= limit:
+                    return result
+
+        return result
+
+
+class TokenIndex(object):
+    """Sorted posting lists of the words of names and expressions.
+
+    Words are folded when indexed (see `nekowatbot.query.fold()`), so that
+    queries only need to fold their own words. Posting lists are NumPy arrays
+    that are never modified in place, so that they may be read-only views of
+    a snapshot: adding or removing a document replaces the array.
+
+    Attributes:
+
+    PREFIX_EXPANSION (int): Maximum number of words a prefix is expanded to.
+    _postings (dict): Sorted arrays of document IDs indexed by word.
+    _words (list[str]): Sorted list of words, or None if it must be rebuilt.
+    """
+
+    PREFIX_EXPANSION = 64
+
+    def __init__(self, postings=None):
+        self._postings = postings or {}
+        self._words = None
+
+    def __len__(self):
+        return len(self._postings)
+
+    def get(self, word):
+        """Get the sorted posting list of a word. It must not be modified."""
+        return self._postings.get(word, EMPTY)
+
+    def add(self, word, doc_id):
+        """Add a document to the posting list of a word."""
+        ids = self._postings.get(word)
+
+        if ids is None:
+            self._postings[word] = np.array([doc_id], dtype=np.int64)
+            self._words = None
+            return
+
+        pos = int(np.searchsorted(ids, doc_id))
+
+        if pos == len(ids) or ids[pos] != doc_id:
+            self._postings[word] = np.insert(ids, pos, doc_id)
+
+    def discard(self, word, doc_id):
+        """Remove a document from the posting list of a word."""
+        ids = self._postings.get(word)
+
+        if ids is None:
+            return
+
+        pos = int(np.searchsorted(ids, doc_id))
+
+        if pos == len(ids) or ids[pos] != doc_id:
+            return
+
+        if len(ids) == 1:
+            del self._postings[word]
+            self._words = None
+
+        else:
+            self._postings[word] = np.delete(ids, pos)
+
+    def expand(self, prefix):
+        """Get the posting lists of the words starting with a prefix.
+
+        Only the first `PREFIX_EXPANSION` words (in sorted order) are taken
+        into account, so that very short prefixes stay cheap.
+
+        Returns:
+            List of sorted arrays of document IDs.
+        """
+        if self._words is None:
+            self._words = sorted(self._postings)
+
+        start = bisect.bisect_left(self._words, prefix)
+        lists = []
+
+        for word in self._words[start:start + self.PREFIX_EXPANSION]:
+            if not word.startswith(prefix):
+                break
+
+            lists.append(self._postings[word])
+
+        return lists
+
+
+class TrigramIndex(object):
+    """Character trigram matrix used for fuzzy matching.
+
+    Every key is decomposed into its set of character trigrams, which are
+    hashed into a fixed number of buckets. The resulting sparse matrix is
+    stored column-wise (by bucket) in NumPy arrays, so that a query only
+    touches the rows that share at least one trigram with it. Scoring all the
+    keys is then a single `bincount` over the gathered rows.
+
+    The matrix is immutable: when the set of keys changes, which only happens
+    when the owner modifies the catalog, a new one is built in the background
+    while queries keep using the previous one.
+
+    Attributes:
+
+    BUCKETS (int): Number of hash buckets for trigrams. Must be a power of 2.
+    keys (list[str]): Keys in row order.
+    _indptr (ndarray): Start of each bucket in `_rows`.
+    _rows (ndarray): Row numbers grouped by bucket.
+    _sizes (ndarray): Number of distinct trigram buckets of each row.
+    """
+
+    BUCKETS = 1 << 18
+
+    def __init__(self, keys=()):
+        self.keys = list(keys)
+
+        buckets = []
+        rows = []
+        sizes = np.zeros(len(self.keys), dtype=np.int32)
+
+        for row, key in enumerate(self.keys):
+            hashes = self.hash_trigrams(key)
+            sizes[row] = len(hashes)
+            buckets.extend(hashes)
+            rows.extend([row] * len(hashes))
+
+        buckets = np.asarray(buckets, dtype=np.int64)
+        order = np.argsort(buckets, kind='stable')
+
+        self._rows = np.asarray(rows, dtype=np.int32)[order]
+        self._indptr = np.zeros(self.BUCKETS + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(buckets, minlength=self.BUCKETS),
+            out=self._indptr[1:]
+        )
+        self._sizes = sizes
+
+    @classmethod
+    def hash_trigrams(cls, text):
+        """Get the distinct trigram buckets of a text.
+
+        The text is padded with spaces so that short texts and word boundaries
+        also produce trigrams.
+        """
+        padded = ' %s ' % text
+        mask = cls.BUCKETS - 1
+
+        return list(set(
+            zlib.crc32(padded[i:i + 3].encode('utf-8')) & mask
+            for i in range(len(padded) - 2)
+        ))
+
+    def search(self, text, limit=10, threshold=0.4):
+        """Find the keys most similar to a text.
+
+        Similarity is measured as the Dice coefficient of the trigram sets.
+
+        Args:
+            text (str): Normalized query.
+            limit (int): Maximum number of keys to return.
+            threshold (float): Minimum similarity of the keys returned.
+
+        Returns:
+            List of (key, score) tuples ordered by descending score.
+        """
+        if not self.keys or not text:
+            return []
+
+        hashes = self.hash_trigrams(text)
+        matched = np.concatenate([
+            self._rows[self._indptr[h]:self._indptr[h + 1]] for h in hashes
+        ])
+
+        if not matched.size:
+            return []
+
+        overlap = np.bincount(matched, minlength=len(self.keys))
+        candidates = np.flatnonzero(overlap)
+        scores = (
+            2.0 * overlap[candidates]
+            / (self._sizes[candidates] + len(hashes))
+        )
+
+        selected = scores >= threshold
+        candidates = candidates[selected]
+        scores = scores[selected]
+
+        if candidates.size > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            candidates = candidates[top]
+            scores = scores[top]
+
+        order = np.argsort(-scores, kind='stable')
+
+        return [
+            (self.keys[candidates[i]], float(scores[i])) for i in order
+        ]
+
+
+class WatIndex(object):
+    """Inverted index mapping expressions to WAT documents.
+
+    The index is built once from the database and then kept up to date by the
+    methods of the bot that modify the catalog, so that lookups never need to
+    scan the whole table. Only document IDs and searchable keys are kept in
+    memory: documents themselves are fetched from the storage.
+
+    Attributes:
+
+    _live (IdArray): IDs of all the documents, for random selection.
+    _sorted_ids (ndarray): Sorted array of the IDs of all the documents, for
+        queries whose terms are all negated. Replaced instead of modified.
+    _names (dict): Normalized name of each document, indexed by ID.
+    _sorted_names (list): Sorted (name, ID) tuples, for browsing the
+        documents by name.
+    _doc_expressions (dict): Expressions of each document, indexed by ID.
+    _weights (dict): Weights of the documents that do not have the default
+        weight of 1, indexed by ID.
+    _expressions (dict): Arrays of document IDs indexed by expression.
+    _prefixes (PrefixIndex): Prefix index over expressions and names.
+    _tokens (TokenIndex): Posting lists of the words of expressions and
+        names, for boolean queries.
+    _trigrams (TrigramIndex): Fuzzy index over the keys of the prefix index,
+        or None if it has not been built yet. It may be stale while a new one
+        is built.
+    _trigrams_version (int): Version of the prefix index the fuzzy index was
+        built from.
+    _trigrams_builder (Thread): Thread building a new fuzzy index, if any.
+    _alias (dict): Alias tables for weighted selection, indexed by expression
+        (or None for the whole catalog). Cleared whenever documents change.
+    _lock (RLock): Lock protecting the index from concurrent handler threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._trigrams = None
+        self._trigrams_builder = None
+        self._reset()
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._live
+
+    def after_fork(self):
+        """Prepare the index for use in a forked process.
+
+        The lock is replaced, as it may have been held by another thread of
+        the parent process, and a fuzzy index being built by the parent is
+        built again if needed.
+        """
+        self._lock = threading.RLock()
+        self._trigrams_builder = None
+
+    @contextlib.contextmanager
+    def quiesce(self):
+        """Keep the index from being modified, e.g. while forking."""
+        with self._lock:
+            yield
+
+    def _reset(self):
+        """Empty the index."""
+        self._live = IdArray()
+        self._sorted_ids = EMPTY
+        self._names = {}
+        self._sorted_names = []
+        self._doc_expressions = {}
+        self._weights = {}
+        self._expressions = {}
+        self._prefixes = PrefixIndex()
+        self._tokens = TokenIndex()
+        self._trigrams_version = None
+        self._alias = {}
+
+    def build(self, docs):
+        """Rebuild the index from scratch.
+
+        Args:
+            docs (iterable): Database documents.
+        """
+        with self._lock:
+            self._reset()
+
+            for doc in docs:
+                self._add(doc)
+
+            self._sorted_ids = np.array(sorted(self._live), dtype=np.int64)
+            self._sorted_names = sorted(
+                (name, doc_id) for doc_id, name in self._names.items()
+            )
+            self._tokens = TokenIndex(self._build_tokens())
+            self._changed()
+
+    def load(self, snapshot):
+        """Rebuild the index from the prebuilt sections of a snapshot.
+
+        The names and the expression postings are read as stored in the
+        snapshot, already sorted, instead of being derived document by
+        document.
+
+        Args:
+            snapshot (Snapshot): Catalog snapshot.
+        """
+        with self._lock:
+            self._reset()
+
+            table = snapshot.string_table()
+            ids = snapshot.doc_ids.tolist()
+            names = snapshot.name_keys(table)
+
+            self._live = IdArray(ids)
+            self._sorted_ids = np.sort(np.array(ids, dtype=np.int64))
+            self._names = dict(zip(ids, names))
+            self._sorted_names = [
+                (names[row], ids[row]) for row in snapshot.name_order()
+            ]
+
+            for doc_id, name in zip(ids, names):
+                self._prefixes.add(name, doc_id)
+
+            for doc_id, expressions in zip(ids,
+                                           snapshot.row_expressions(table)):
+                self._doc_expressions[doc_id] = tuple(expressions)
+
+            for expression, rows in snapshot.expression_postings(table):
+                doc_ids = [ids[row] for row in rows]
+                self._expressions[expression] = IdArray(doc_ids)
+
+                for doc_id in doc_ids:
+                    self._prefixes.add(expression, doc_id)
+
+            for doc_id, weight in zip(ids, snapshot.weights.tolist()):
+                if weight != 1:
+                    self._weights[doc_id] = weight
+
+            self._tokens = TokenIndex(dict(snapshot.token_postings(table)))
+
+            self._changed()
+
+    def add(self, doc):
+        """Add a document to the index.
+
+        Args:
+            doc (Document): Database document. Must have a `doc_id`.
+        """
+        with self._lock:
+            self._add(doc)
+
+            for word in self._doc_words(doc.doc_id):
+                self._tokens.add(word, doc.doc_id)
+
+            pos = int(np.searchsorted(self._sorted_ids, doc.doc_id))
+
+            if (pos == len(self._sorted_ids)
+                    or self._sorted_ids[pos] != doc.doc_id):
+                self._sorted_ids = np.insert(self._sorted_ids, pos, doc.doc_id)
+
+            bisect.insort(
+                self._sorted_names,
+                (self._names[doc.doc_id], doc.doc_id)
+            )
+
+            self._changed()
+
+    def _add(self, doc):
+        """Add a document to every structure but the sorted names."""
+        doc_id = doc.doc_id
+        name = normalize(doc['name'])
+
+        self._live.add(doc_id)
+        self._names[doc_id] = name
+        self._prefixes.add(name, doc_id)
+        self._link_expressions(doc_id, doc['expressions'])
+
+        weight = doc.get('weight', 1)
+
+        if weight != 1:
+            self._weights[doc_id] = weight
+
+    def remove(self, doc_id):
+        """Remove a document from the index.
+
+        Args:
+            doc_id (int): ID of the document.
+        """
+        with self._lock:
+            if doc_id not in self._live:
+                return
+
+            for word in self._doc_words(doc_id):
+                self._tokens.discard(word, doc_id)
+
+            name = self._names.pop(doc_id)
+
+            self._live.discard(doc_id)
+            self._sorted_ids = np.delete(
+                self._sorted_ids,
+                np.searchsorted(self._sorted_ids, doc_id)
+            )
+            self._prefixes.discard(name, doc_id)
+            del self._sorted_names[
+                bisect.bisect_left(self._sorted_names, (name, doc_id))
+            ]
+            self._unlink_expressions(doc_id)
+            self._weights.pop(doc_id, None)
+
+            self._changed()
+
+    def set_expressions(self, doc_id, expressions):
+        """Replace the expressions of an indexed document.
+
+        Args:
+            doc_id (int): ID of the document.
+            expressions (list[str]): New expressions of the document.
+        """
+        with self._lock:
+            if doc_id not in self._live:
+                return
+
+            previous = self._doc_words(doc_id)
+
+            self._unlink_expressions(doc_id)
+            self._link_expressions(doc_id, expressions)
+
+            current = self._doc_words(doc_id)
+
+            for word in previous - current:
+                self._tokens.discard(word, doc_id)
+
+            for word in current - previous:
+                self._tokens.add(word, doc_id)
+
+            self._changed()
+
+    def set_weight(self, doc_id, weight):
+        """Set the weight of a document for weighted random selection.
+
+        Args:
+            doc_id (int): ID of the document.
+            weight (float): New weight of the document.
+        """
+        with self._lock:
+            if doc_id not in self._live:
+                return
+
+            if weight != 1:
+                self._weights[doc_id] = weight
+
+            else:
+                self._weights.pop(doc_id, None)
+
+            self._alias = {}
+
+    def all(self):
+        """Get the IDs of all documents in ascending order."""
+        with self._lock:
+            return self._sorted_ids.tolist()
+
+    def by_expression(self, expression):
+        """Get the documents that match an expression.
+
+        Returns:
+            List of document IDs in ascending order.
+        """
+        with self._lock:
+            doc_ids = self._expressions.get(expression)
+
+            if not doc_ids:
+                return []
+
+            return sorted(doc_ids)
+
+    def random(self, expression=None, weighted=False):
+        """Get a random document.
+
+        Args:
+            expression (str): If provided, only documents matching this
+                expression exactly are considered.
+            weighted (bool): Whether to take into account the weights of the
+                documents or choose uniformly.
+
+        Returns:
+            Random document ID, or None if there are no candidates.
+        """
+        with self._lock:
+            if expression is None:
+                ids = self._live
+
+            else:
+                ids = self._expressions.get(expression)
+
+                if not ids:
+                    return None
+
+            if not weighted:
+                return ids.choice()
+
+            table = self._alias.get(expression)
+
+            if table is None:
+                table = self._alias[expression] = AliasTable(
+                    ids.ids,
+                    [self._weights.get(d, 1) for d in ids]
+                )
+
+            return table.choice()
+
+    def by_name(self, offset=0, limit=None):
+        """Get a slice of the documents ordered by name.
+
+        Args:
+            offset (int): Position of the first document.
+            limit (int): Maximum number of documents to return.
+
+        Returns:
+            List of document IDs.
+        """
+        with self._lock:
+            end = offset + limit if limit else None
+
+            return [d for _, d in self._sorted_names[offset:end]]
+
+    def name_position(self, prefix):
+        """Get the position of the first name not sorted before a prefix.
+
+        Used to jump to the documents whose name starts with the prefix when
+        browsing them with `by_name()`.
+        """
+        with self._lock:
+            return bisect.bisect_left(self._sorted_names, (prefix,))
+
+    def by_prefix(self, prefix, limit=None):
+        """Get the documents with an expression or name starting with a prefix.
+
+        Args:
+            prefix (str): Normalized prefix.
+            limit (int): Maximum number of documents to return.
+
+        Returns:
+            List of document IDs ordered by matching key and then by ID.
+        """
+        with self._lock:
+            return self._prefixes.search(prefix, limit)
+
+    def by_similarity(self, text, limit=10):
+        """Get the documents with expressions or names most similar to a text.
+
+        This is meant for misspelled queries that do not match anything
+        through exact or prefix lookups.
+
+        Args:
+            text (str): Normalized query.
+            limit (int): Maximum number of similar keys to consider.
+
+        Returns:
+            List of document IDs ordered by descending similarity.
+        """
+        with self._lock:
+            trigrams = self._trigrams
+            builder = self._update_trigrams()
+
+        if trigrams is None:
+            # Nothing to serve until the first index is built
+            builder.join()
+            trigrams = self._trigrams
+
+        # The fuzzy index is immutable, so it is searched without the lock
+        matches = trigrams.search(text, limit)
+
+        with self._lock:
+            result = []
+            seen = set()
+
+            for key, _ in matches:
+                for doc_id in self._prefixes.get(key):
+                    if doc_id not in seen:
+                        seen.add(doc_id)
+                        result.append(doc_id)
+
+            return result
+
+    def _update_trigrams(self):
+        """Start building the fuzzy index if the keys changed since the last.
+
+        Must be called with the lock held.
+
+        Returns:
+            Thread building the fuzzy index, if any.
+        """
+        version = self._prefixes.version
+
+        if (self._trigrams_version != version
+                and self._trigrams_builder is None):
+            self._trigrams_builder = threading.Thread(
+                target=self._build_trigrams,
+                args=(self._prefixes.keys(), version),
+                name='TrigramIndex',
+                daemon=True
+            )
+            self._trigrams_builder.start()
+
+        return self._trigrams_builder
+
+    def _build_trigrams(self, keys, version):
+        """Build the fuzzy index of the given keys and swap it in."""
+        trigrams = TrigramIndex(keys)
+
+        with self._lock:
+            self._trigrams = trigrams
+            self._trigrams_version = version
+            self._trigrams_builder = None
+
+    def by_query(self, query):
+        """Get the documents matching a boolean query.
+
+        Args:
+            query (Query): Parsed query.
+
+        Returns:
+            List of document IDs in ascending order.
+        """
+        with self._lock:
+            return query.evaluate(
+                self._tokens.get,
+                self._tokens.expand,
+                lambda: self._sorted_ids
+            ).tolist()
+
+    def _doc_words(self, doc_id, cache=None):
+        """Get the set of words of the name and expressions of a document.
+
+        Args:
+            doc_id (int): ID of the document.
+            cache (dict): Words of each expression, to avoid tokenizing the
+                same expression more than once when indexing many documents.
+        """
+        words = set(tokenize(self._names[doc_id]))
+
+        for expression in self._doc_expressions.get(doc_id, ()):
+            if cache is None:
+                words.update(tokenize(expression))
+                continue
+
+            if expression not in cache:
+                cache[expression] = tokenize(expression)
+
+            words.update(cache[expression])
+
+        return words
+
+    def _build_tokens(self):
+        """Build the posting lists of every word from scratch.
+
+        Returns:
+            Dict of sorted arrays of document IDs, indexed by word.
+        """
+        postings = {}
+        cache = {}
+
+        for doc_id in sorted(self._names):
+            for word in self._doc_words(doc_id, cache):
+                postings.setdefault(word, []).append(doc_id)
+
+        return {
+            word: np.array(ids, dtype=np.int64)
+            for word, ids in postings.items()
+        }
+
+    def _changed(self):
+        """Discard the structures derived from the set of documents.
+
+        The fuzzy index is not discarded: it is rebuilt in the background
+        once a query finds that the keys changed (see `by_similarity()`).
+        """
+        self._alias = {}
+
+    def _link_expressions(self, doc_id, expressions):
+        """Add a document to the arrays of the given expressions."""
+        self._doc_expressions[doc_id] = tuple(expressions)
+
+        for expression in expressions:
+            self._expressions.setdefault(expression, IdArray()).add(doc_id)
+            self._prefixes.add(expression, doc_id)
+
+    def _unlink_expressions(self, doc_id):
+        """Remove a document from the arrays of its current expressions."""
+        for expression in self._doc_expressions.pop(doc_id, ()):
+            self._prefixes.discard(expression, doc_id)
+            doc_ids = self._expressions.get(expression)
+
+            if doc_ids is None:
+                continue
+
+            doc_ids.discard(doc_id)
+
+            if not doc_ids:
+                del self._expressions[expression]
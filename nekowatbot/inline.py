@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""Tracking of the inline queries in flight.
+
+Telegram sends a new inline query for almost every character typed, and
+only the answer to the latest query of a user is ever shown. The tracker
+remembers the latest query of each user as soon as it is received, so that
+older ones can be dropped before searching and before answering:
+
+- Queries superseded within the same batch of updates are never handled.
+- A handler may wait a short coalescing window for a newer query to arrive
+  before searching. The wait ends as soon as one does.
+- A handler checks whether its query is still the latest before answering.
+"""
+
+import threading
+
+from nekowatbot.metrics import INLINE_SUPERSEDED
+
+
+class InlineTracker(object):
+    """Latest inline query of each user.
+
+    Attributes:
+
+    window (float): Seconds a handler waits for a newer query of the same
+        user before searching. 0 disables the wait.
+    _latest (dict): ID of the latest query received from each user, for the
+        users with a query being handled.
+    _cond (Condition): Condition notified whenever a query is received.
+    """
+
+    def __init__(self, window=0):
+        self.window = window
+        self._latest = {}
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._latest)
+
+    def track(self, updates):
+        """Record the inline queries of a batch of updates.
+
+        Must be called when the updates are received, before they are handed
+        to the handlers.
+
+        Args:
+            updates (list[Update]): Updates received.
+
+        Returns:
+            List of updates, without the inline queries superseded by a later
+            query of the same user in the same batch.
+        """
+        latest = {}
+
+        for update in updates:
+            query = update.inline_query
+
+            if query is not None:
+                latest[query.from_user.id] = query.id
+
+        if not latest:
+            return updates
+
+        with self._cond:
+            self._latest.update(latest)
+            self._cond.notify_all()
+
+        kept = [
+            u for u in updates
+            if u.inline_query is None
+            or latest[u.inline_query.from_user.id] == u.inline_query.id
+        ]
+
+        if len(kept) < len(updates):
+            INLINE_SUPERSEDED.labels('batch').inc(len(updates) - len(kept))
+
+        return kept
+
+    def is_current(self, query, stage='answer'):
+        """Check whether a query is still the latest one of its user.
+
+        Args:
+            query (InlineQuery): Query being handled.
+            stage (str): Label of the superseded queries counter to increment
+                if the query is not current.
+        """
+        current = self._latest.get(query.from_user.id, query.id) == query.id
+
+        if not current:
+            INLINE_SUPERSEDED.labels(stage).inc()
+
+        return current
+
+    def wait(self, query):
+        """Wait for a newer query of the same user, up to the window.
+
+        Returns:
+            Whether the query is still the latest one of its user.
+        """
+        if self.window > 0:
+            user_id = query.from_user.id
+
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._latest.get(user_id, query.id) != query.id,
+                    self.window
+                )
+
+        return self.is_current(query, 'search')
+
+    def finish(self, query):
+        """Forget a query once handled, if still the latest of its user."""
+        with self._cond:
+            if self._latest.get(query.from_user.id) == query.id:
+                del self._latest[query.from_user.id]
@@ -0,0 +1,576 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Instrumentation of the bot.
+
+Metrics are kept in memory and exposed in the Prometheus text format through
+a small HTTP server. Worker processes send the changes of their counters and
+histograms to the primary process, which adds them to its own, so that the
+server exposes the totals of every process (gauges are only those of the
+primary). Counters and histograms are updated without locks: the
+children of a metric (one per label value) are created once and then only
+incremented, so recording a value does not allocate. Under heavy contention
+an increment may occasionally be lost, which is acceptable for monitoring.
+"""
+
+import asyncio
+import bisect
+import functools
+import http.server
+import os
+import resource
+import threading
+import time
+
+
+# Default latency buckets, in seconds
+BUCKETS = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10
+)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for n, v in zip(names, values)
+    )
+
+
+class _CounterChild(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def sample(self):
+        return self.value
+
+    def merge(self, value):
+        self.value += value
+
+    @staticmethod
+    def difference(value, baseline):
+        return value - baseline if baseline is not None else value
+
+
+class _HistogramChild(object):
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def sample(self):
+        return (list(self.counts), self.sum, self.count)
+
+    def merge(self, value):
+        counts, total, count = value
+
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+
+        self.sum += total
+        self.count += count
+
+    @staticmethod
+    def difference(value, baseline):
+        if baseline is None:
+            return value
+
+        return (
+            [a - b for a, b in zip(value[0], baseline[0])],
+            value[1] - baseline[1],
+            value[2] - baseline[2]
+        )
+
+
+class Metric(object):
+    """Base class of metrics with optional labels.
+
+    Attributes:
+
+    name (str): Name of the metric.
+    documentation (str): Help text of the metric.
+    labelnames (tuple): Names of the labels.
+    _children (dict): Children of the metric indexed by label values.
+    _lock (Lock): Lock used only when creating children.
+    """
+
+    kind = None
+    child_class = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Get the child of some label values, creating it if needed.
+
+        The child should be kept by the caller when used in hot paths.
+        """
+        child = self._children.get(values)
+
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+
+                if child is None:
+                    child = self._children[values] = self._new_child()
+
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self):
+        """Get the lines of the metric in text format."""
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.kind)
+        ]
+
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._collect_child(values, child))
+
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing counter."""
+
+    kind = 'counter'
+    child_class = _CounterChild
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        """Increment the counter without labels."""
+        self.labels().inc(amount)
+
+    def _collect_child(self, values, child):
+        yield '%s%s %s' % (
+            self.name,
+            _format_labels(self.labelnames, values),
+            child.value
+        )
+
+
+class Histogram(Metric):
+    """Histogram of observed values with fixed buckets."""
+
+    kind = 'histogram'
+    child_class = _HistogramChild
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        """Observe a value without labels."""
+        self.labels().observe(value)
+
+    def _collect_child(self, values, child):
+        names = self.labelnames + ('le',)
+        counts = list(child.counts)
+        cumulative = 0
+
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            yield '%s_bucket%s %d' % (
+                self.name,
+                _format_labels(names, values + (bound,)),
+                cumulative
+            )
+
+        labels = _format_labels(self.labelnames, values)
+
+        yield '%s_sum%s %r' % (self.name, labels, child.sum)
+        yield '%s_count%s %d' % (self.name, labels, cumulative)
+
+
+class Gauge(Metric):
+    """Value computed when collecting, through callbacks."""
+
+    kind = 'gauge'
+
+    def set_function(self, func, *values):
+        """Set the function returning the value of some label values."""
+        with self._lock:
+            self._children[values] = func
+
+    def _collect_child(self, values, func):
+        try:
+            value = func()
+
+        except Exception:
+            return
+
+        yield '%s%s %s' % (
+            self.name,
+            _format_labels(self.labelnames, values),
+            value
+        )
+
+
+class Registry(object):
+    """Collection of metrics.
+
+    Attributes:
+
+    _metrics (dict): Registered metrics indexed by name.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def after_fork(self):
+        """Prepare the metrics for use in a forked process.
+
+        The locks of the metrics are replaced, as they may have been held by
+        another thread of the parent process.
+        """
+        for metric in self._metrics.values():
+            metric._lock = threading.Lock()
+
+    def register(self, metric):
+        """Register a metric, returning the existing one if already known."""
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        return self.register(
+            Histogram(name, documentation, labelnames, buckets)
+        )
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def sample(self):
+        """Get the current values of the counters and histograms.
+
+        Returns:
+            Dict of the values of each child, indexed by metric name and then
+            by label values.
+        """
+        return dict(
+            (name, dict(
+                (values, child.sample())
+                for values, child in list(metric._children.items())
+            ))
+            for name, metric in self._metrics.items()
+            if metric.kind != 'gauge'
+        )
+
+    def difference(self, sample, baseline):
+        """Get the changes between two samples, see `sample()`.
+
+        Only the children that changed are included.
+        """
+        changes = {}
+
+        for name, children in sample.items():
+            child_class = self._metrics[name].child_class
+            previous = baseline.get(name, {})
+
+            for values, value in children.items():
+                if value != previous.get(values):
+                    changes.setdefault(name, {})[values] = \
+                        child_class.difference(value, previous.get(values))
+
+        return changes
+
+    def merge(self, changes):
+        """Add changes recorded by another process, see `difference()`."""
+        for name, children in changes.items():
+            metric = self._metrics.get(name)
+
+            if metric is None:
+                continue
+
+            for values, value in children.items():
+                metric.labels(*values).merge(value)
+
+    def exposition(self):
+        """Get every metric in the Prometheus text format."""
+        lines = []
+
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].collect())
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.histogram(
+    'nekowat_handler_seconds',
+    'Time spent in update handlers',
+    ('handler',)
+)
+DB_LATENCY = REGISTRY.histogram(
+    'nekowat_db_seconds',
+    'Time spent in catalog methods',
+    ('method',)
+)
+UPDATES = REGISTRY.counter(
+    'nekowat_updates_total',
+    'Updates received by type',
+    ('type',)
+)
+HANDLER_ERRORS = REGISTRY.counter(
+    'nekowat_handler_errors_total',
+    'Exceptions raised by update handlers',
+    ('handler',)
+)
+API_ERRORS = REGISTRY.counter(
+    'nekowat_api_errors_total',
+    'Failed requests to the Telegram API by error code',
+    ('code',)
+)
+CACHE_HITS = REGISTRY.counter(
+    'nekowat_cache_hits_total',
+    'Cache hits',
+    ('cache',)
+)
+CACHE_MISSES = REGISTRY.counter(
+    'nekowat_cache_misses_total',
+    'Cache misses',
+    ('cache',)
+)
+QUEUE_DEPTH = REGISTRY.gauge(
+    'nekowat_queue_depth',
+    'Items waiting in internal queues',
+    ('queue',)
+)
+
+QUEUE_WAIT = REGISTRY.histogram(
+    'nekowat_queue_wait_seconds',
+    'Time handler calls wait in the queue of their lane',
+    ('lane',)
+)
+SHED = REGISTRY.counter(
+    'nekowat_shed_total',
+    'Handler calls dropped because the queue of their lane was full',
+    ('lane',)
+)
+INLINE_SUPERSEDED = REGISTRY.counter(
+    'nekowat_inline_superseded_total',
+    'Inline queries dropped in favour of a newer query of the same user',
+    ('stage',)
+)
+RESIDENT_MEMORY = REGISTRY.gauge(
+    'nekowat_resident_memory_bytes',
+    'Resident memory of the process'
+)
+
+UPDATE_TYPES = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'inline_query', 'chosen_inline_result', 'callback_query',
+    'shipping_query', 'pre_checkout_query'
+)
+
+_UPDATE_COUNTERS = tuple((t, UPDATES.labels(t)) for t in UPDATE_TYPES)
+
+
+def resident_memory():
+    """Get the resident memory of the process, in bytes.
+
+    Falls back to the peak resident memory where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def count_updates(updates):
+    """Count received updates by type."""
+    for update in updates:
+        for update_type, counter in _UPDATE_COUNTERS:
+            if getattr(update, update_type, None) is not None:
+                counter.inc()
+
+
+def count_api_error(exc):
+    """Count a failed request to the Telegram API.
+
+    Supports both `telebot.apihelper.ApiException` and
+    `nekowatbot.aio.ApiError`. Other exceptions are counted as 'network'.
+    """
+    code = getattr(exc, 'error_code', None)
+
+    if code is None:
+        code = getattr(getattr(exc, 'result', None), 'status_code', None)
+
+    API_ERRORS.labels(str(code) if code is not None else 'network').inc()
+
+
+def timed(histogram, label):
+    """Decorator recording the duration of each call of a function.
+
+    Works with plain functions and coroutine functions.
+    """
+    child = histogram.labels(label)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+
+                try:
+                    return await func(*args, **kwargs)
+
+                finally:
+                    child.observe(time.perf_counter() - start)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+
+            try:
+                return func(*args, **kwargs)
+
+            finally:
+                child.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_handler(handler, label=None):
+    """Wrap an update handler to record its latency and exceptions.
+
+    Args:
+        handler (callable): Handler function or coroutine function.
+        label (str): Label of the handler in the metrics. Defaults to the
+            name of the function.
+    """
+    label = label or getattr(handler, '__name__', 'handler')
+    errors = HANDLER_ERRORS.labels(label)
+
+    @functools.wraps(handler)
+    def count_errors(*args, **kwargs):
+        try:
+            return handler(*args, **kwargs)
+
+        except Exception:
+            errors.inc()
+            raise
+
+    @functools.wraps(handler)
+    async def async_count_errors(*args, **kwargs):
+        try:
+            return await handler(*args, **kwargs)
+
+        except Exception:
+            errors.inc()
+            raise
+
+    if asyncio.iscoroutinefunction(handler):
+        return timed(HANDLER_LATENCY, label)(async_count_errors)
+
+    return timed(HANDLER_LATENCY, label)(count_errors)
+
+
+class MetricsServer(object):
+    """HTTP server exposing the metrics of a registry on `/metrics`.
+
+    Attributes:
+
+    registry (Registry): Registry exposed.
+    httpd (ThreadingHTTPServer): HTTP server.
+    """
+
+    def __init__(self, registry=REGISTRY, listen='127.0.0.1', port=9090):
+        self.registry = registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = registry.exposition().encode('utf-8')
+
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type',
+                    'text/plain; version=0.0.4; charset=utf-8'
+                )
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((listen, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(
+            target=self.httpd.serve_forever,
+            name='MetricsServer',
+            daemon=True
+        )
+        thread.start()
+
+    def shutdown(self):
+        """Stop serving requests."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Popularity of the WATs chosen from inline results.
+
+Every time a user sends a WAT from the inline results, Telegram reports the
+chosen result (if inline feedback is enabled for the bot). The choices are
+counted per WAT and per query and WAT, with a score that decays over time so
+that recent choices weigh more than old ones.
+
+Scores are kept relative to a fixed epoch: a choice made at time `t` adds
+`2 ** ((t - epoch) / half_life)` to the score. Decaying every score at once
+does not change their order, so rankings only change when new choices are
+counted and never need to be decayed. The epoch is moved forward once in a
+long while so that the values stay within range.
+
+Recording a choice only appends it to a queue. A background thread counts
+the queued choices, rebuilds the rankings and writes the changed scores to
+a SQLite database in a single transaction.
+
+The rankings are kept as arrays of WAT IDs in order, so that ordering a long
+list of results only filters them, while short lists are sorted by the
+position of each WAT.
+"""
+
+import collections
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+# Scores below this value, relative to the epoch, are dropped
+MIN_SCORE = 1e-6
+
+# Number of half-lives after which the epoch is moved forward
+REBASE_AFTER = 64
+
+# Lists of at least 1 / FILTER_RATIO of the size of the rankings are ordered
+# by filtering the rankings instead of sorting
+FILTER_RATIO = 16
+
+
+class Popularity(object):
+    """Time-decayed counters of the inline results chosen by users.
+
+    Attributes:
+
+    half_life (float): Seconds after which the weight of a choice halves.
+    flush_interval (float): Seconds between background flushes.
+    max_pairs (int): Maximum number of (query, WAT) counters kept. The
+        lowest ones are dropped first.
+    conn (Connection): Database connection, or None if counters are only
+        kept in memory.
+    epoch (float): Time the scores are relative to.
+    _wats (dict): Score of each WAT, indexed by ID.
+    _pairs (dict): Score of each WAT for a query, indexed by (query, ID).
+    _pending (deque): Choices not counted yet, as (query, ID, time) tuples.
+    _removed (deque): IDs of the WATs whose counters must be dropped.
+    _dirty (set): Counters changed since the last write, as (query, ID)
+        tuples. The query is None for the counters of WATs.
+    _deleted (set): Counters dropped since the last write.
+    _ranking (tuple): Rankings, see `_rank()`. Replaced as a whole, so that
+        it is read without locking.
+    _lock (Lock): Lock serializing flushes.
+    _stop (Event): Event used to stop the flusher thread.
+    _flusher (Thread): Background flusher thread, once started.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS wat_usage ('
+        '    doc_id INTEGER PRIMARY KEY,'
+        '    score REAL NOT NULL'
+        ')',
+        'CREATE TABLE IF NOT EXISTS query_usage ('
+        '    query TEXT NOT NULL,'
+        '    doc_id INTEGER NOT NULL,'
+        '    score REAL NOT NULL,'
+        '    PRIMARY KEY (query, doc_id)'
+        ') WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS usage_meta ('
+        '    key TEXT PRIMARY KEY,'
+        '    value REAL NOT NULL'
+        ')',
+    )
+
+    def __init__(self, path=None, half_life=7 * 86400, flush_interval=60,
+                 max_pairs=100000):
+        self.half_life = float(half_life)
+        self.flush_interval = flush_interval
+        self.max_pairs = max_pairs
+        self.conn = None
+        self.epoch = time.time()
+
+        self._wats = {}
+        self._pairs = {}
+        self._pending = collections.deque()
+        self._removed = collections.deque()
+        self._dirty = set()
+        self._deleted = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+
+        if path:
+            self._load(path)
+
+        self._rank()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _load(self, path):
+        """Open the database and read the counters stored in it."""
+        self.conn = sqlite3.connect(
+            path,
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=10
+        )
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+
+        row = self.conn.execute(
+            "SELECT value FROM usage_meta WHERE key = 'epoch'"
+        ).fetchone()
+
+        if row is None:
+            self.conn.execute(
+                "INSERT INTO usage_meta (key, value) VALUES ('epoch', ?)",
+                (self.epoch,)
+            )
+
+        else:
+            self.epoch = row[0]
+
+        self._wats = dict(
+            self.conn.execute('SELECT doc_id, score FROM wat_usage')
+        )
+        self._pairs = dict(
+            ((query, doc_id), score) for query, doc_id, score in
+            self.conn.execute('SELECT query, doc_id, score FROM query_usage')
+        )
+
+    def start(self, callback=None):
+        """Flush the counters periodically in the background.
+
+        Args:
+            callback (callable): Function called without arguments whenever
+                the rankings change.
+        """
+        def loop():
+            while not self._stop.wait(self.flush_interval):
+                try:
+                    if self.flush() and callback is not None:
+                        callback()
+
+                except Exception as e:
+                    print('Failed to flush popularity counters: %s' % e)
+
+        self._flusher = threading.Thread(
+            target=loop,
+            name='PopularityFlusher',
+            daemon=True
+        )
+        self._flusher.start()
+
+    def stop(self):
+        """Stop flushing in the background and count pending choices."""
+        self._stop.set()
+        self.flush()
+
+    def record(self, query, doc_id):
+        """Record that a WAT was chosen from the results of a query.
+
+        This only queues the choice, which is counted by the next flush.
+
+        Args:
+            query (str): Normalized text of the inline query.
+            doc_id (int): ID of the chosen WAT.
+        """
+        self._pending.append((query, doc_id, time.time()))
+
+    def forget(self, doc_id):
+        """Drop the counters of a WAT on the next flush."""
+        self._removed.append(doc_id)
+
+    def flush(self):
+        """Count the queued choices, rebuild the rankings and write them.
+
+        Returns:
+            Whether the rankings changed.
+        """
+        with self._lock:
+            changed = False
+
+            while self._pending:
+                query, doc_id, when = self._pending.popleft()
+                weight = 2 ** ((when - self.epoch) / self.half_life)
+
+                self._add((None, doc_id), weight)
+
+                if query:
+                    self._add((query, doc_id), weight)
+
+                changed = True
+
+            while self._removed:
+                doc_id = self._removed.popleft()
+                keys = [(q, d) for q, d in self._pairs if d == doc_id]
+
+                if doc_id in self._wats:
+                    keys.append((None, doc_id))
+
+                for key in keys:
+                    self._drop(key)
+                    changed = True
+
+            if time.time() - self.epoch > REBASE_AFTER * self.half_life:
+                self._rebase()
+                changed = True
+
+            if len(self._pairs) > self.max_pairs:
+                lowest = sorted(self._pairs, key=self._pairs.get)
+
+                for key in lowest[:len(self._pairs) - self.max_pairs]:
+                    self._drop(key)
+
+            if changed:
+                self._rank()
+
+            self._write()
+
+            return changed
+
+    def _add(self, key, weight):
+        """Add to the score of a counter."""
+        scores = self._wats if key[0] is None else self._pairs
+        doc_id = key[1] if key[0] is None else key
+
+        scores[doc_id] = scores.get(doc_id, 0) + weight
+        self._dirty.add(key)
+        self._deleted.discard(key)
+
+    def _drop(self, key):
+        """Remove a counter."""
+        if key[0] is None:
+            self._wats.pop(key[1], None)
+
+        else:
+            self._pairs.pop(key, None)
+
+        self._dirty.discard(key)
+        self._deleted.add(key)
+
+    def _rebase(self):
+        """Move the epoch to the current time, scaling every score."""
+        now = time.time()
+        factor = 2 ** ((self.epoch - now) / self.half_life)
+
+        for key in [(None, d) for d in self._wats] + list(self._pairs):
+            scores = self._wats if key[0] is None else self._pairs
+            doc_id = key[1] if key[0] is None else key
+            scores[doc_id] *= factor
+
+            if scores[doc_id] < MIN_SCORE:
+                self._drop(key)
+
+            else:
+                self._dirty.add(key)
+
+        self.epoch = now
+
+        if self.conn is not None:
+            with self.conn:
+                self.conn.execute('BEGIN IMMEDIATE')
+                self.conn.execute(
+                    "UPDATE usage_meta SET value = ? WHERE key = 'epoch'",
+                    (now,)
+                )
+
+    def _rank(self):
+        """Rebuild the rankings from the current scores.
+
+        The rankings are a tuple of:
+
+        - Array with the position of each WAT ID in the overall ranking.
+        - Array of every WAT ID covered by the positions, in overall order.
+          WATs never chosen follow the ranked ones, in ID order.
+        - Number of ranked WATs.
+        - Tuple of the position of each WAT in the ranking of the query
+          (dict) and array of the WAT IDs in order, indexed by query.
+        """
+        ranked = sorted(self._wats, key=lambda d: (-self._wats[d], d))
+        size = max(ranked) + 1 if ranked else 0
+
+        positions = np.arange(size, dtype=np.int64) + len(ranked)
+        positions[ranked] = np.arange(len(ranked))
+
+        unranked = np.ones(size, dtype=bool)
+        unranked[ranked] = False
+        overall = np.concatenate((
+            np.array(ranked, dtype=np.int64),
+            np.flatnonzero(unranked)
+        ))
+
+        queries = {}
+
+        for (query, doc_id), score in self._pairs.items():
+            if doc_id < size:
+                queries.setdefault(query, []).append((-score, doc_id))
+
+        for query, scores in queries.items():
+            scores.sort()
+            queries[query] = (
+                dict((doc_id, i) for i, (_, doc_id) in enumerate(scores)),
+                np.array([doc_id for _, doc_id in scores], dtype=np.int64)
+            )
+
+        self._ranking = (positions, overall, len(ranked), queries)
+
+    def _write(self):
+        """Write the counters changed since the last write."""
+        if self.conn is None:
+            self._dirty.clear()
+            self._deleted.clear()
+            return
+
+        if not self._dirty and not self._deleted:
+            return
+
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO wat_usage (doc_id, score) '
+                'VALUES (?, ?)',
+                [(d, self._wats[d]) for q, d in self._dirty if q is None]
+            )
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO query_usage (query, doc_id, score) '
+                'VALUES (?, ?, ?)',
+                [(q, d, self._pairs[(q, d)])
+                 for q, d in self._dirty if q is not None]
+            )
+            self.conn.executemany(
+                'DELETE FROM wat_usage WHERE doc_id = ?',
+                [(d,) for q, d in self._deleted if q is None]
+            )
+            self.conn.executemany(
+                'DELETE FROM query_usage WHERE query = ? AND doc_id = ?',
+                [(q, d) for q, d in self._deleted if q is not None]
+            )
+
+        self._dirty.clear()
+        self._deleted.clear()
+
+    def order(self, query, doc_ids):
+        """Sort WATs by popularity.
+
+        WATs chosen more often for the query come first, followed by the
+        rest in order of overall popularity. WATs that were never chosen
+        keep their order of ID. Only the precomputed rankings are looked up.
+
+        Args:
+            query (str): Normalized text of the inline query.
+            doc_ids (list[int]): IDs of the WATs.
+
+        Returns:
+            List of WAT IDs.
+        """
+        positions, overall, ranked, queries = self._ranking
+
+        if not doc_ids or not ranked:
+            return doc_ids
+
+        ids = np.array(doc_ids, dtype=np.int64)
+        specific = queries.get(query)
+
+        # Filtering costs the size of the rankings, sorting that of the list
+        if len(ids) * FILTER_RATIO >= len(positions):
+            return self._filter(ids, overall, specific)
+
+        known = ids < len(positions)
+        overall = np.where(
+            known,
+            positions[np.where(known, ids, 0)],
+            ids + ranked
+        )
+
+        if specific is None:
+            return ids[np.argsort(overall, kind='stable')].tolist()
+
+        ranking = specific[0]
+        specific = np.array(
+            [ranking.get(doc_id, len(ranking)) for doc_id in doc_ids],
+            dtype=np.int64
+        )
+
+        return ids[np.lexsort((overall, specific))].tolist()
+
+    @staticmethod
+    def _filter(ids, overall, specific):
+        """Order WATs by filtering the rankings, see `order()`."""
+        size = len(overall)
+        selected = np.zeros(size, dtype=bool)
+        selected[ids[ids < size]] = True
+        parts = []
+
+        if specific is not None:
+            first = specific[1][selected[specific[1]]]
+            selected[first] = False
+            parts.append(first)
+
+        parts.append(overall[selected[overall]])
+        parts.append(np.sort(ids[ids >= size]))
+
+        return np.concatenate(parts).tolist()
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Boolean queries over the words of the catalog.
+
+A query is made of whitespace-separated terms, all of which must match:
+
+    angry cat       WATs with both words
+    cat|dog         WATs with either word
+    cat -dog        WATs with the word cat but not dog
+
+A term is a word or several alternatives separated by `|`, and may be
+negated with a leading `-`. Words are folded (case folded, with accents
+removed) and the last word of a query also matches words starting with it,
+so that results appear while the user is typing.
+
+Queries are evaluated over sorted posting lists of document IDs, one per
+word, stored in NumPy arrays. Intersections start from the shortest list and
+binary search its IDs in the longer ones, so their cost depends on the size
+of the rarest word rather than the most common one.
+"""
+
+import re
+import unicodedata
+
+import numpy as np
+
+
+WORD_RE = re.compile(r'\w+')
+
+EMPTY = np.zeros(0, dtype=np.int64)
+
+
+def fold(text):
+    """Case fold a text and remove its accents."""
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    """Split a text into folded words."""
+    return WORD_RE.findall(fold(text))
+
+
+def intersect(lists):
+    """Intersect sorted arrays of IDs.
+
+    The arrays are intersected from the shortest to the longest: the IDs
+    left so far are searched in the next array with a binary search each,
+    which NumPy runs in a single call.
+
+    Returns:
+        Sorted array of the IDs present in every array.
+    """
+    if not lists:
+        return EMPTY
+
+    lists = sorted(lists, key=len)
+    result = lists[0]
+
+    for ids in lists[1:]:
+        if not len(result) or not len(ids):
+            return EMPTY
+
+        pos = np.searchsorted(ids, result)
+        pos[pos == len(ids)] = 0
+        result = result[ids[pos] == result]
+
+    return result
+
+
+def union(lists):
+    """Merge sorted arrays of IDs.
+
+    Returns:
+        Sorted array of the IDs present in any array.
+    """
+    lists = [ids for ids in lists if len(ids)]
+
+    if not lists:
+        return EMPTY
+
+    if len(lists) == 1:
+        return lists[0]
+
+    return np.unique(np.concatenate(lists))
+
+
+def difference(ids, excluded):
+    """Remove the IDs of a sorted array from another sorted array.
+
+    Returns:
+        Sorted array of the IDs in `ids` but not in `excluded`.
+    """
+    if not len(ids) or not len(excluded):
+        return ids
+
+    pos = np.searchsorted(excluded, ids)
+    pos[pos == len(excluded)] = 0
+
+    return ids[excluded[pos] != ids]
+
+
+class Query(object):
+    """Parsed boolean query.
+
+    Attributes:
+
+    terms (list): (negated, alternatives) tuples, one per term. Each
+        alternative is a list of words that must all match (an alternative
+        such as 'grumpy-cat' is split into several words).
+    prefix (str): Last word of the query, also matched as a prefix. None if
+        the query ends with a negated term.
+    """
+
+    def __init__(self, terms, prefix=None):
+        self.terms = terms
+        self.prefix = prefix
+
+    @classmethod
+    def parse(cls, text):
+        """Parse the text of a query.
+
+        Returns:
+            Query instance. It has no terms if the text has no words.
+        """
+        # Alternatives may be written with spaces around the bar
+        text = re.sub(r'\s*\|\s*', '|', text.strip())
+        terms = []
+        prefix = None
+
+        for term in text.split():
+            negated = term.startswith('-')
+            alternatives = [
+                words for words in (
+                    tokenize(part) for part in term.lstrip('-').split('|')
+                )
+                if words
+            ]
+
+            if not alternatives:
+                continue
+
+            terms.append((negated, alternatives))
+            prefix = None if negated else alternatives[-1][-1]
+
+        return cls(terms, prefix)
+
+    def is_simple(self):
+        """Whether the query is a single word, with nothing to combine."""
+        return (
+            len(self.terms) == 1
+            and not self.terms[0][0]
+            and len(self.terms[0][1]) == 1
+            and len(self.terms[0][1][0]) == 1
+        )
+
+    def has_operators(self):
+        """Whether the query has alternatives or negated terms."""
+        return any(
+            negated or len(alternatives) > 1
+            for negated, alternatives in self.terms
+        )
+
+    def evaluate(self, postings, expand, universe):
+        """Find the IDs of the documents matching the query.
+
+        Args:
+            postings (callable): Function returning the sorted array of IDs
+                of the documents with a word (empty if unknown).
+            expand (callable): Function returning the sorted arrays of IDs of
+                the words starting with a prefix.
+            universe (callable): Function returning the sorted array of IDs
+                of every document, used when all the terms are negated.
+
+        Returns:
+            Sorted array of document IDs.
+        """
+        if not self.terms:
+            return EMPTY
+
+        included = []
+        excluded = []
+
+        for i, (negated, alternatives) in enumerate(self.terms):
+            branches = []
+
+            for j, words in enumerate(alternatives):
+                lists = [postings(w) for w in words]
+
+                if (self.prefix is not None and i == len(self.terms) - 1
+                        and j == len(alternatives) - 1):
+                    # The prefix matches the union of several lists
+                    branches.extend(
+                        lists[:-1] + [ids] for ids in expand(words[-1])
+                    )
+
+                else:
+                    branches.append(lists)
+
+            (excluded if negated else included).append(branches)
+
+        if not included:
+            result = universe()
+
+        else:
+            # Start from a term that needs no union, preferably the one with
+            # the fewest candidates, then intersect each alternative of the
+            # others with the result instead of merging them first
+            included.sort(key=lambda branches: (
+                len(branches) > 1,
+                sum(min(len(ids) for ids in lists) for lists in branches)
+            ))
+            result = union([intersect(lists) for lists in included[0]])
+
+            for branches in included[1:]:
+                if not len(result):
+                    break
+
+                result = union([
+                    intersect([result] + lists) for lists in branches
+                ])
+
+        for branches in excluded:
+            for lists in branches:
+                result = difference(result, intersect([result] + lists))
+
+        return result
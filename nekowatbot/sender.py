@@ -0,0 +1,598 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Outbound request scheduling.
+
+Telegram limits how fast a bot can send messages: about 30 per second
+overall, one per second in the same chat and 20 per minute in the same
+group. Requests that exceed the limits are rejected with a 429 error and a
+`retry_after` value.
+
+The scheduler in this module queues every outbound request and sends them
+from a small pool of threads, respecting a global token bucket and one token
+bucket per chat, so that the bot slows down instead of being rate limited.
+Answers to inline and callback queries are not messages and do not count
+against those limits, so they bypass the buckets.
+
+Requests are served by priority lane (inline answers, then user requests,
+then the owner's requests) with stride scheduling: each lane gets a share of
+the requests sent proportional to its weight, so lower lanes keep making
+progress while the inline lane is busy. Requests to the same chat are sent
+in order.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from nekowatbot.metrics import count_api_error
+
+
+logger = logging.getLogger('TeleBot')
+
+
+# Priority lanes, lower is more important
+PRIORITY_INLINE = 0
+PRIORITY_USER = 1
+PRIORITY_ADMIN = 2
+
+# Share of the requests sent from each lane while every lane is busy
+LANE_WEIGHTS = {
+    PRIORITY_INLINE: 8,
+    PRIORITY_USER: 4,
+    PRIORITY_ADMIN: 1,
+}
+
+
+class QueueFull(Exception):
+    """Raised when a request is dropped because the queue is full."""
+    pass
+
+
+def get_retry_after(exc):
+    """Get the seconds to wait after a rate limit error.
+
+    Supports both `telebot.apihelper.ApiException` and
+    `nekowatbot.aio.ApiError`.
+
+    Returns:
+        Seconds to wait, or None if the exception is not a rate limit error.
+    """
+    if getattr(exc, 'error_code', None) == 429:
+        return exc.retry_after or 1
+
+    result = getattr(exc, 'result', None)
+
+    if getattr(result, 'status_code', None) != 429:
+        return None
+
+    try:
+        return result.json()['parameters']['retry_after']
+
+    except (ValueError, KeyError, TypeError):
+        return 1
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter.
+
+    Attributes:
+
+    rate (float): Tokens added per second.
+    capacity (float): Maximum number of tokens (burst size).
+    tokens (float): Tokens currently available.
+    last (float): Time of the last refill.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'last')
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.last) * self.rate
+        )
+        self.last = now
+
+    def delay(self, now):
+        """Seconds until a token is available (0 if available now)."""
+        self._refill(now)
+
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Consume a token. Call only after `delay()` returned 0."""
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        """Empty the bucket so that no token is available for some time."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self, now):
+        """Check whether the bucket is full, i.e. has been idle."""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter(object):
+    """Global and per-chat token buckets.
+
+    Attributes:
+
+    global_bucket (TokenBucket): Bucket shared by every request.
+    chat_rate (float): Requests per second allowed in a private chat.
+    group_rate (float): Requests per second allowed in a group.
+    chat_burst (float): Burst size of the chat buckets.
+    _chats (dict): Bucket of each chat.
+    """
+
+    MAX_IDLE_CHATS = 10000
+
+    def __init__(self, global_rate=30, chat_rate=1, group_rate=20 / 60.0,
+                 global_burst=30, chat_burst=3):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self._chats = {}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+
+        if bucket is None:
+            if len(self._chats) >= self.MAX_IDLE_CHATS:
+                self._prune()
+
+            # Group IDs are negative
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+
+        return bucket
+
+    def _prune(self):
+        """Forget the buckets of idle chats."""
+        now = time.monotonic()
+
+        for chat_id in [c for c, b in self._chats.items() if b.is_full(now)]:
+            del self._chats[chat_id]
+
+    def acquire(self, chat_id=None, now=None):
+        """Try to acquire permission to send a request.
+
+        Args:
+            chat_id (int): Chat the request is addressed to, if any.
+
+        Returns:
+            0 if the request can be sent now (tokens are consumed), or the
+            seconds to wait before trying again.
+        """
+        now = now or time.monotonic()
+        chat_bucket = self._chat_bucket(chat_id) if chat_id else None
+
+        wait = self.global_bucket.delay(now)
+
+        if chat_bucket:
+            wait = max(wait, chat_bucket.delay(now))
+
+        if wait > 0:
+            return wait
+
+        self.global_bucket.take(now)
+
+        if chat_bucket:
+            chat_bucket.take(now)
+
+        return 0
+
+    def block(self, chat_id, seconds):
+        """Block a chat (or every request if no chat) for some seconds."""
+        now = time.monotonic()
+
+        if chat_id:
+            self._chat_bucket(chat_id).block(now, seconds)
+
+        else:
+            self.global_bucket.block(now, seconds)
+
+
+class Job(object):
+    """Queued request."""
+
+    __slots__ = (
+        'priority', 'seq', 'func', 'args', 'kwargs', 'chat_id', 'merge_key',
+        'limited', 'future', 'retries', 'enqueued', 'cancelled'
+    )
+
+    def __init__(self, priority, seq, func, args, kwargs, chat_id,
+                 merge_key, limited=True):
+        self.priority = priority
+        self.seq = seq
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.chat_id = chat_id
+        self.merge_key = merge_key
+        self.limited = limited
+        self.future = Future()
+        self.retries = 0
+        self.enqueued = time.monotonic()
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SendScheduler(object):
+    """Rate limited, prioritized queue of outbound requests.
+
+    Attributes:
+
+    limiter (RateLimiter): Rate limiter of the requests.
+    max_queue (int): Maximum number of queued requests. When full, the
+        request with the lowest priority (the newest one among equals) is
+        dropped.
+    max_retries (int): Times a rate limited request is retried.
+    ledger (UpdateLedger): If set, the update whose handler queues a request
+        is held until the request is sent or dropped (see
+        nekowatbot.supervisor).
+    dropped (int): Number of requests dropped because the queue was full.
+    merged (int): Number of requests replaced by a newer one.
+    rate_limited (int): Number of 429 errors received.
+    _ready (dict): Heap of jobs ready to be sent, for each priority lane.
+    _pass (dict): Virtual time of each lane for stride scheduling. The lane
+        with the lowest one is served next and advances by the inverse of
+        its weight.
+    _delayed (list): Heap of (time, job) waiting for their rate limits.
+    _waiting (dict): Jobs waiting for a previous request to the same chat.
+    _in_flight (set): Chats with a request being sent.
+    _merge (dict): Queued jobs by merge key.
+    _cond (Condition): Condition protecting the queues.
+    _workers (list): Sender threads.
+    """
+
+    def __init__(self, limiter=None, max_queue=1000, workers=4,
+                 max_retries=3, ledger=None):
+        self.limiter = limiter or RateLimiter()
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.ledger = ledger
+
+        self.dropped = 0
+        self.merged = 0
+        self.rate_limited = 0
+
+        self._ready = dict((priority, []) for priority in LANE_WEIGHTS)
+        self._pass = dict((priority, 0.0) for priority in LANE_WEIGHTS)
+        self._delayed = []
+        self._waiting = {}
+        self._in_flight = set()
+        self._merge = {}
+        self._size = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+
+        self._workers = [
+            threading.Thread(
+                target=self._work,
+                name='Sender-%d' % i,
+                daemon=True
+            )
+            for i in range(workers)
+        ]
+
+        for worker in self._workers:
+            worker.start()
+
+    def __len__(self):
+        return self._size
+
+    def submit(self, func, args=(), kwargs=None, chat_id=None,
+               priority=PRIORITY_USER, merge_key=None, limited=True):
+        """Queue a request.
+
+        Args:
+            func (callable): Function performing the request.
+            args (tuple): Positional arguments of the function.
+            kwargs (dict): Keyword arguments of the function.
+            chat_id (int): Chat the request is addressed to, if any.
+            priority (int): Priority lane of the request.
+            merge_key: If provided, a queued request with the same key that
+                has not been sent yet is replaced by this one.
+            limited (bool): Whether the request counts against the rate
+                limits of messages.
+
+        Returns:
+            Future that resolves to the result of the request. Dropped or
+            replaced requests resolve to a `QueueFull` exception or None.
+        """
+        job = Job(
+            priority,
+            next(self._seq),
+            func,
+            args,
+            kwargs or {},
+            chat_id,
+            merge_key,
+            limited
+        )
+
+        update_id = self.ledger.hold_current() if self.ledger else None
+
+        if update_id is not None:
+            job.future.add_done_callback(
+                lambda _: self.ledger.release(update_id)
+            )
+
+        with self._cond:
+            if merge_key is not None:
+                previous = self._merge.get(merge_key)
+
+                if previous is not None and not previous.cancelled:
+                    self._cancel(previous)
+                    previous.future.set_result(None)
+                    self.merged += 1
+
+                self._merge[merge_key] = job
+
+            if self._size >= self.max_queue and not self._make_room(job):
+                self._merge.pop(merge_key, None)
+                self.dropped += 1
+                job.future.set_exception(QueueFull())
+                return job.future
+
+            self._push_ready(job)
+            self._size += 1
+            self._cond.notify()
+
+        return job.future
+
+    def call(self, func, args=(), kwargs=None, chat_id=None,
+             priority=PRIORITY_USER, merge_key=None, limited=True):
+        """Queue a request and wait for its result."""
+        return self.submit(
+            func,
+            args,
+            kwargs,
+            chat_id,
+            priority,
+            merge_key,
+            limited
+        ).result()
+
+    def stop(self):
+        """Stop the sender threads once the queue is empty."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """Wait for the sender threads to exit after `stop()`."""
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def _cancel(self, job):
+        """Mark a queued job as cancelled. It is skipped when popped."""
+        job.cancelled = True
+        self._size -= 1
+
+    def _make_room(self, job):
+        """Drop the worst queued job if it is worse than the given one.
+
+        Returns:
+            Boolean indicating whether there is room for the job now.
+        """
+        candidates = [
+            j for jobs in self._ready.values() for j in jobs
+            if not j.cancelled
+        ]
+        candidates += [j for _, j in self._delayed if not j.cancelled]
+
+        for jobs in self._waiting.values():
+            candidates += [j for j in jobs if not j.cancelled]
+
+        if not candidates:
+            return True
+
+        worst = max(candidates)
+
+        if worst < job:
+            return False
+
+        self._cancel(worst)
+        self.dropped += 1
+        worst.future.set_exception(QueueFull())
+
+        if self._merge.get(worst.merge_key) is worst:
+            del self._merge[worst.merge_key]
+
+        return True
+
+    def _push_ready(self, job):
+        """Queue a job in the ready heap of its lane.
+
+        A lane that was idle starts from the virtual time of the busy lanes,
+        so that it does not get a burst of turns to catch up.
+        """
+        jobs = self._ready[job.priority]
+
+        if not jobs:
+            busy = [self._pass[p] for p, j in self._ready.items() if j]
+
+            if busy:
+                self._pass[job.priority] = max(
+                    self._pass[job.priority],
+                    min(busy)
+                )
+
+        heapq.heappush(jobs, job)
+
+    def _pop_ready(self):
+        """Pop the next ready job, from the lane with the lowest pass.
+
+        Returns:
+            Job, or None if no job is ready.
+        """
+        lanes = [p for p, jobs in self._ready.items() if jobs]
+
+        if not lanes:
+            return None
+
+        priority = min(lanes, key=lambda p: (self._pass[p], p))
+
+        return heapq.heappop(self._ready[priority])
+
+    def _next_job(self):
+        """Get the next job that can be sent, waiting if needed.
+
+        Must be called with the condition held.
+
+        Returns:
+            Job, or None if the scheduler was stopped.
+        """
+        while True:
+            now = time.monotonic()
+
+            # Jobs whose rate limit has expired are ready again
+            while self._delayed and self._delayed[0][0] <= now:
+                self._push_ready(heapq.heappop(self._delayed)[1])
+
+            timeout = None
+
+            if self._delayed:
+                timeout = self._delayed[0][0] - now
+
+            while True:
+                job = self._pop_ready()
+
+                if job is None:
+                    break
+
+                if job.cancelled:
+                    continue
+
+                if job.chat_id in self._in_flight:
+                    # Keep requests to the same chat in order
+                    self._waiting.setdefault(job.chat_id, []).append(job)
+                    continue
+
+                wait = self.limiter.acquire(job.chat_id, now) \
+                    if job.limited else 0
+
+                if wait > 0:
+                    heapq.heappush(self._delayed, (now + wait, job))
+                    timeout = wait if timeout is None else min(timeout, wait)
+                    continue
+
+                if self._merge.get(job.merge_key) is job:
+                    del self._merge[job.merge_key]
+
+                if job.chat_id is not None:
+                    self._in_flight.add(job.chat_id)
+
+                self._pass[job.priority] += 1.0 / LANE_WEIGHTS[job.priority]
+                self._size -= 1
+
+                return job
+
+            if not self._running and not self._size:
+                return None
+
+            self._cond.wait(timeout)
+
+    def _done(self, job):
+        """Release the chat of a job that has been sent.
+
+        Must be called with the condition held.
+        """
+        if job.chat_id is None:
+            return
+
+        self._in_flight.discard(job.chat_id)
+
+        for waiting in self._waiting.pop(job.chat_id, ()):
+            self._push_ready(waiting)
+
+        self._cond.notify_all()
+
+    def _work(self):
+        """Send queued requests until stopped."""
+        while True:
+            with self._cond:
+                job = self._next_job()
+
+            if job is None:
+                return
+
+            try:
+                result = job.func(*job.args, **job.kwargs)
+
+            except Exception as e:
+                count_api_error(e)
+                retry_after = get_retry_after(e)
+
+                with self._cond:
+                    if retry_after is None or job.retries >= self.max_retries:
+                        logger.error(e)
+                        self._done(job)
+                        job.future.set_exception(e)
+                        continue
+
+                    # Rate limited, try again later
+                    self.rate_limited += 1
+
+                    if job.limited:
+                        self.limiter.block(job.chat_id, retry_after)
+
+                    job.retries += 1
+                    self._size += 1
+                    heapq.heappush(
+                        self._delayed,
+                        (time.monotonic() + retry_after, job)
+                    )
+                    self._done(job)
+
+                continue
+
+            with self._cond:
+                self._done(job)
+
+            job.future.set_result(result)
@@ -0,0 +1,556 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""Compact binary snapshot of the WAT catalog.
+
+A snapshot stores the whole catalog in a single file that is opened with
+`mmap` and read in place, so that opening it does not parse anything nor
+create one Python object per field of every document. It is made of a
+header, a table of sections and the sections themselves, each one a packed
+array aligned to 8 bytes:
+
+- STRD/STRO: UTF-8 string table and the offset of each string in it.
+- DOCS/NAME/WGHT: ID, name (string number) and weight of each document,
+  ordered by ID. The position of a document in these arrays is its row.
+- FIDO/FIDS, EXPO/EXPS: file IDs and expressions of the documents, as
+  string numbers. The values of row `r` are in `[offsets[r], offsets[r+1])`.
+- NKEY/NORD: normalized name of each row, and the rows sorted by it.
+- XKEY/XPSO/XPST: distinct expressions in sorted order and the rows
+  referencing each one, so that the expression index is loaded without
+  walking every document.
+- TKEY/TPSO/TPST: distinct words of names and expressions (see
+  `nekowatbot.query.tokenize()`) and the IDs of the documents containing
+  each one, used in place as the posting lists of boolean queries.
+
+The header records the format version and a stamp of the primary database
+(see `source_stamp()`), so that a stale or incompatible snapshot is detected
+and rebuilt instead of being used.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+from tinydb.database import Document
+
+from nekowatbot.index import normalize
+from nekowatbot.query import tokenize
+
+
+MAGIC = b'NKWSNAP\x00'
+VERSION = 2
+
+# Magic, version, number of sections, number of documents, stamp
+HEADER = struct.Struct('<8sIIQQQQ')
+# Section name, offset and length in bytes
+SECTION = struct.Struct('<4sQQ')
+
+# Stamp that matches no database file, as no file has that size
+STALE_STAMP = (2 ** 64 - 1, 0, 0)
+
+SECTIONS = (
+    (b'STRD', np.uint8),
+    (b'STRO', np.uint64),
+    (b'DOCS', np.int64),
+    (b'NAME', np.uint32),
+    (b'WGHT', np.float64),
+    (b'FIDO', np.uint64),
+    (b'FIDS', np.uint32),
+    (b'EXPO', np.uint64),
+    (b'EXPS', np.uint32),
+    (b'NKEY', np.uint32),
+    (b'NORD', np.uint32),
+    (b'XKEY', np.uint32),
+    (b'XPSO', np.uint64),
+    (b'XPST', np.uint32),
+    (b'TKEY', np.uint32),
+    (b'TPSO', np.uint64),
+    (b'TPST', np.int64),
+)
+
+
+class SnapshotError(Exception):
+    """The snapshot file is not valid or was written by another version."""
+    pass
+
+
+def source_stamp(path):
+    """Get the stamp of a database file, changing whenever it is written.
+
+    Args:
+        path (str): Path to the file.
+
+    Returns:
+        Tuple with the size, modification time (in ns) and CRC-32 of the
+        file, or zeros if it does not exist.
+    """
+    try:
+        st = os.stat(path)
+
+        with open(path, 'rb') as f:
+            checksum = 0
+
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                checksum = zlib.crc32(chunk, checksum)
+
+    except OSError:
+        return (0, 0, 0)
+
+    return (st.st_size, st.st_mtime_ns, checksum)
+
+
+def _offsets(lengths):
+    """Build an offset array from a list of lengths."""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.uint64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    return offsets
+
+
+def write_snapshot(path, docs, stamp=(0, 0, 0)):
+    """Write a snapshot of some documents.
+
+    The file is written to a temporary file first, which then replaces the
+    previous snapshot, so that readers never see a partial file.
+
+    Args:
+        path (str): Path to the snapshot.
+        docs (iterable): Database documents.
+        stamp (tuple): Stamp of the primary database the documents come from.
+
+    Returns:
+        Number of documents written.
+    """
+    strings = {}
+    encoded = []
+
+    def intern(text):
+        number = strings.get(text)
+
+        if number is None:
+            number = strings[text] = len(encoded)
+            encoded.append(text.encode('utf-8'))
+
+        return number
+
+    docs = sorted(docs, key=lambda d: d.doc_id)
+
+    names = []
+    weights = []
+    file_ids = []
+    file_lengths = []
+    expressions = []
+    expression_lengths = []
+    keys = []
+    postings = {}
+    words = {}
+    tokens = {}
+
+    for row, doc in enumerate(docs):
+        names.append(intern(doc['name']))
+        weights.append(doc.get('weight', 1))
+        keys.append(intern(normalize(doc['name'])))
+
+        file_ids.extend(intern(f) for f in doc['file_ids'])
+        file_lengths.append(len(doc['file_ids']))
+
+        expressions.extend(intern(e) for e in doc['expressions'])
+        expression_lengths.append(len(doc['expressions']))
+
+        doc_words = set(tokenize(doc['name']))
+
+        for expression in doc['expressions']:
+            postings.setdefault(expression, []).append(row)
+
+            if expression not in tokens:
+                tokens[expression] = tokenize(expression)
+
+            doc_words.update(tokens[expression])
+
+        for word in doc_words:
+            words.setdefault(word, []).append(doc.doc_id)
+
+    name_order = sorted(
+        range(len(docs)),
+        key=lambda r: (encoded[keys[r]], docs[r].doc_id)
+    )
+    expression_keys = sorted(postings)
+    word_keys = sorted(words)
+    word_numbers = [intern(w) for w in word_keys]
+
+    arrays = {
+        b'STRD': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        b'STRO': _offsets([len(s) for s in encoded]),
+        b'DOCS': np.array([d.doc_id for d in docs], dtype=np.int64),
+        b'NAME': np.array(names, dtype=np.uint32),
+        b'WGHT': np.array(weights, dtype=np.float64),
+        b'FIDO': _offsets(file_lengths),
+        b'FIDS': np.array(file_ids, dtype=np.uint32),
+        b'EXPO': _offsets(expression_lengths),
+        b'EXPS': np.array(expressions, dtype=np.uint32),
+        b'NKEY': np.array(keys, dtype=np.uint32),
+        b'NORD': np.array(name_order, dtype=np.uint32),
+        b'XKEY': np.array(
+            [strings[e] for e in expression_keys],
+            dtype=np.uint32
+        ),
+        b'XPSO': _offsets([len(postings[e]) for e in expression_keys]),
+        b'XPST': np.array(
+            [r for e in expression_keys for r in postings[e]],
+            dtype=np.uint32
+        ),
+        b'TKEY': np.array(word_numbers, dtype=np.uint32),
+        b'TPSO': _offsets([len(words[w]) for w in word_keys]),
+        b'TPST': np.array(
+            [i for w in word_keys for i in words[w]],
+            dtype=np.int64
+        ),
+    }
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory,
+        prefix='.%s.' % os.path.basename(path)
+    )
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            position = HEADER.size + SECTION.size * len(SECTIONS)
+            table = []
+
+            for name, dtype in SECTIONS:
+                position += -position % 8
+                length = arrays[name].astype(dtype, copy=False).nbytes
+                table.append((name, position, length))
+                position += length
+
+            f.write(HEADER.pack(
+                MAGIC, VERSION, len(SECTIONS), len(docs), *stamp
+            ))
+
+            for entry in table:
+                f.write(SECTION.pack(*entry))
+
+            for (name, dtype), (_, offset, _) in zip(SECTIONS, table):
+                f.write(b'\0' * (offset - f.tell()))
+                f.write(arrays[name].astype(dtype, copy=False).tobytes())
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+    return len(docs)
+
+
+class _StringTable(dict):
+    """Strings of a snapshot indexed by number, decoded on demand."""
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def __missing__(self, number):
+        text = self[number] = self._snapshot.string(number)
+        return text
+
+
+class Snapshot(object):
+    """Read-only view of a snapshot file.
+
+    The file is mapped in memory and its sections are wrapped in NumPy arrays
+    without copying them. Documents are only decoded when requested.
+
+    Attributes:
+
+    path (str): Path to the snapshot.
+    stamp (tuple): Stamp of the primary database when the snapshot was
+        written.
+    doc_ids (ndarray): IDs of the documents, in ascending order.
+    weights (ndarray): Weights of the documents, by row.
+    _map (mmap): Memory map of the file.
+    _strings_offset (int): Position of the string table in the file.
+    _sections (dict): Arrays of the sections, indexed by name.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            except ValueError:
+                raise SnapshotError('Empty snapshot file')
+
+        if len(self._map) < HEADER.size:
+            raise SnapshotError('Truncated snapshot header')
+
+        magic, version, count, docs, size, mtime, checksum = \
+            HEADER.unpack_from(self._map, 0)
+
+        if magic != MAGIC:
+            raise SnapshotError('Not a snapshot file')
+
+        if version != VERSION:
+            raise SnapshotError('Unsupported snapshot version %d' % version)
+
+        self.stamp = (size, mtime, checksum)
+        self._sections = {}
+        dtypes = dict(SECTIONS)
+
+        for i in range(count):
+            name, offset, length = SECTION.unpack_from(
+                self._map,
+                HEADER.size + i * SECTION.size
+            )
+
+            if name not in dtypes:
+                continue
+
+            if offset + length > len(self._map):
+                raise SnapshotError('Truncated section %s' % name.decode())
+
+            if name == b'STRD':
+                self._strings_offset = offset
+
+            dtype = np.dtype(dtypes[name])
+            self._sections[name] = np.frombuffer(
+                self._map,
+                dtype=dtype,
+                count=length // dtype.itemsize,
+                offset=offset
+            )
+
+        missing = set(dtypes) - set(self._sections)
+
+        if missing:
+            raise SnapshotError('Missing sections in snapshot')
+
+        self.doc_ids = self._sections[b'DOCS']
+        self.weights = self._sections[b'WGHT']
+
+        if len(self.doc_ids) != docs:
+            raise SnapshotError('Inconsistent snapshot')
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def close(self):
+        """Release the arrays of the snapshot and unmap the file.
+
+        The file stays mapped while any array of the snapshot is still
+        referenced elsewhere.
+        """
+        self._sections = {}
+        self.doc_ids = self.weights = None
+
+        try:
+            self._map.close()
+
+        except BufferError:
+            pass
+
+    def matches(self, path):
+        """Check whether the snapshot was written from a database file as it
+        is now.
+
+        The file is only read to compute its checksum if its size matches
+        but its modification time does not, as opening a TinyDB file touches
+        it without changing its contents.
+        """
+        try:
+            st = os.stat(path)
+
+        except OSError:
+            return self.stamp == (0, 0, 0)
+
+        if (st.st_size, st.st_mtime_ns) == self.stamp[:2]:
+            return True
+
+        return st.st_size == self.stamp[0] and \
+            source_stamp(path)[2] == self.stamp[2]
+
+    def string(self, number):
+        """Decode a string of the string table."""
+        offsets = self._sections[b'STRO']
+        start = self._strings_offset + int(offsets[number])
+        end = self._strings_offset + int(offsets[number + 1])
+
+        return self._map[start:end].decode('utf-8')
+
+    def strings(self, numbers, table=None):
+        """Decode several strings of the string table.
+
+        Args:
+            numbers (list[int]): Numbers of the strings.
+            table (dict): String table returned by `string_table()`, to
+                avoid decoding the same string more than once.
+        """
+        if table is not None:
+            return [table[n] for n in numbers]
+
+        return [self.string(n) for n in numbers]
+
+    def string_table(self):
+        """Get a table decoding each string once, when first accessed."""
+        return _StringTable(self)
+
+    def _values(self, offsets, values, row):
+        """Get the string numbers of a row in a pair of offset/value sections."""
+        offsets = self._sections[offsets]
+
+        return self._sections[values][int(offsets[row]):int(offsets[row + 1])]
+
+    def row(self, doc_id):
+        """Get the row of a document, or None if not in the snapshot."""
+        row = int(np.searchsorted(self.doc_ids, doc_id))
+
+        if row < len(self.doc_ids) and self.doc_ids[row] == doc_id:
+            return row
+
+        return None
+
+    def doc(self, row):
+        """Decode the document stored in a row."""
+        doc = {
+            'name': self.string(int(self._sections[b'NAME'][row])),
+            'file_ids': self.strings(
+                self._values(b'FIDO', b'FIDS', row).tolist()
+            ),
+            'expressions': self.strings(
+                self._values(b'EXPO', b'EXPS', row).tolist()
+            )
+        }
+
+        weight = float(self.weights[row])
+
+        if weight != 1:
+            doc['weight'] = weight
+
+        return Document(doc, int(self.doc_ids[row]))
+
+    def get(self, doc_id):
+        """Get a document by ID."""
+        row = self.row(doc_id)
+
+        return self.doc(row) if row is not None else None
+
+    def docs(self):
+        """Iterate over all the documents in ascending ID order."""
+        for row in range(len(self.doc_ids)):
+            yield self.doc(row)
+
+    def find_name(self, name):
+        """Get the rows of the documents with a given name.
+
+        The rows sorted by normalized name are searched with a binary search,
+        and then compared with the exact name.
+
+        Returns:
+            List of rows in ascending ID order.
+        """
+        key = normalize(name)
+        keys = self._sections[b'NKEY']
+        order = self._sections[b'NORD']
+        lo, hi = 0, len(order)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self.string(int(keys[order[mid]])) < key:
+                lo = mid + 1
+
+            else:
+                hi = mid
+
+        rows = []
+        names = self._sections[b'NAME']
+
+        for i in range(lo, len(order)):
+            row = int(order[i])
+
+            if self.string(int(keys[row])) != key:
+                break
+
+            if self.string(int(names[row])) == name:
+                rows.append(row)
+
+        return rows
+
+    def name_keys(self, table=None):
+        """Get the normalized name of every row."""
+        return self.strings(self._sections[b'NKEY'].tolist(), table)
+
+    def name_order(self):
+        """Get the rows sorted by normalized name and then by ID."""
+        return self._sections[b'NORD'].tolist()
+
+    def row_expressions(self, table=None):
+        """Iterate over the expressions of every row."""
+        offsets = self._sections[b'EXPO'].tolist()
+        values = self.strings(self._sections[b'EXPS'].tolist(), table)
+
+        for row in range(len(offsets) - 1):
+            yield values[offsets[row]:offsets[row + 1]]
+
+    def expression_postings(self, table=None):
+        """Iterate over the prebuilt expression index.
+
+        Yields:
+            Tuples with an expression and the list of rows referencing it,
+            in ascending order of expression.
+        """
+        keys = self.strings(self._sections[b'XKEY'].tolist(), table)
+        offsets = self._sections[b'XPSO'].tolist()
+        rows = self._sections[b'XPST']
+
+        for i, key in enumerate(keys):
+            yield key, rows[offsets[i]:offsets[i + 1]].tolist()
+
+    def token_postings(self, table=None):
+        """Iterate over the prebuilt word index.
+
+        Yields:
+            Tuples with a word and the sorted array of IDs of the documents
+            containing it. The arrays are read-only views of the snapshot.
+        """
+        keys = self.strings(self._sections[b'TKEY'].tolist(), table)
+        offsets = self._sections[b'TPSO'].tolist()
+        ids = self._sections[b'TPST']
+
+        for i, key in enumerate(keys):
+            yield key, ids[offsets[i]:offsets[i + 1]]
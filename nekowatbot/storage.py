@@ -0,0 +1,994 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Storage backends for the WAT catalog.
+
+Every backend stores WATs as documents with the following fields:
+
+- name (str): Name of the file
+- file_ids (list): List of file IDs ordered by size
+- expressions (list): List of expressions that match the image
+- weight (float): Optional weight used when choosing a random WAT
+
+Documents are returned as TinyDB `Document` instances, which carry their ID
+in the `doc_id` attribute regardless of the backend used.
+"""
+
+import contextlib
+import json
+import sqlite3
+import sys
+import threading
+
+from tinydb import TinyDB
+from tinydb.database import Document
+from tinydb_smartcache import SmartCacheTable
+
+from nekowatbot.config import write_atomic
+from nekowatbot.snapshot import (
+    STALE_STAMP, Snapshot, SnapshotError, source_stamp, write_snapshot
+)
+
+
+def open_storage(conf):
+    """Open the storage described in the configuration.
+
+    Args:
+        conf (str|dict): Either the path to a TinyDB file, or a dict with the
+            keys `backend` ('tinydb' or 'sqlite') and `path`. If the key
+            `snapshot` is present, reads are served from a snapshot file
+            at that path (see `SnapshotStorage`). Any other key is passed to
+            the backend as an option.
+
+    Returns:
+        Storage instance.
+    """
+    if not isinstance(conf, dict):
+        conf = {'backend': 'tinydb', 'path': conf}
+
+    options = dict(conf)
+    backend = options.pop('backend', 'tinydb')
+    path = options.pop('path')
+
+    if backend not in BACKENDS:
+        sys.exit('Unknown database backend: %s' % backend)
+
+    if 'snapshot' in options:
+        return SnapshotStorage(backend, path, **options)
+
+    return BACKENDS[backend](path, **options)
+
+
+class TinyDBStorage(object):
+    """Storage backed by a TinyDB JSON file.
+
+    TinyDB parses the whole file on every read, so documents are loaded once
+    and kept in memory.
+
+    By default writes go through TinyDB, which rewrites the whole file on
+    every change. In write-behind mode TinyDB is only used to load the file:
+    changes are applied in memory and a background thread periodically
+    writes an atomic snapshot of the catalog, using the same format.
+
+    Attributes:
+
+    path (str): Path to the JSON file.
+    db (TinyDB): Database instance. None in write-behind mode.
+    write_behind (bool): Whether changes are persisted in the background.
+    flush_interval (float): Seconds between background snapshots.
+    _docs (dict): Documents indexed by their ID.
+    _next_id (int): ID of the next document in write-behind mode.
+    _dirty (bool): Whether there are changes not yet written to disk.
+    _lock (RLock): Lock protecting the storage from concurrent handlers.
+    _flush_lock (Lock): Lock serializing snapshot writes.
+    _stop (Event): Event used to stop the writer thread.
+    _writer (Thread): Background writer thread.
+    """
+
+    TABLE = '_default'
+
+    def __init__(self, path, write_behind=False, flush_interval=5):
+        self.path = path
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._docs = {}
+        self._dirty = False
+
+        self.db = TinyDB(path)
+        self.db.table_class = SmartCacheTable
+
+        for doc in sorted(self.db.all(), key=lambda d: d.doc_id):
+            self._docs[doc.doc_id] = doc
+
+        self._next_id = max(self._docs) + 1 if self._docs else 1
+
+        if not write_behind:
+            return
+
+        self.db.close()
+        self.db = None
+
+        self._stop = threading.Event()
+        self._writer = threading.Thread(
+            target=self._write_loop,
+            name='TinyDBWriter',
+            daemon=True
+        )
+        self._writer.start()
+
+    def close(self):
+        """Close the database, writing pending changes first."""
+        if not self.write_behind:
+            self.db.close()
+            return
+
+        self._stop.set()
+        self._writer.join()
+        self.flush()
+
+    def after_fork(self):
+        """Prepare the storage for reading in a forked process.
+
+        Documents are inherited from the parent process. The process must
+        not write to the storage, so write-behind is disabled there.
+        """
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self.write_behind = False
+
+    @contextlib.contextmanager
+    def quiesce(self):
+        """Keep the storage from being modified, e.g. while forking."""
+        with self._lock:
+            yield
+
+    def flush(self):
+        """Write pending changes to disk.
+
+        The snapshot is written to a temporary file which then replaces the
+        database file, so that a crash never leaves a truncated database.
+        Documents are copied while holding the lock, but serialized and
+        written without it. Does nothing if not in write-behind mode.
+        """
+        if not self.write_behind:
+            return
+
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+
+                # Updates replace the fields of a document, so a shallow
+                # copy is not affected by later changes
+                docs = dict(
+                    (str(doc_id), dict(doc))
+                    for doc_id, doc in self._docs.items()
+                )
+                self._dirty = False
+
+            try:
+                write_atomic(self.path, json.dumps({self.TABLE: docs}))
+
+            except Exception:
+                with self._lock:
+                    self._dirty = True
+
+                raise
+
+    def _write_loop(self):
+        """Periodically write pending changes until stopped."""
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+
+            except Exception as e:
+                print('Failed to write database: %s' % e)
+
+    def all(self):
+        """Iterate over all documents in ascending ID order."""
+        with self._lock:
+            return list(self._docs.values())
+
+    def get(self, doc_id):
+        """Get a document by ID."""
+        return self._docs.get(doc_id)
+
+    def get_many(self, doc_ids):
+        """Get several documents by ID, in the same order."""
+        docs = self._docs
+
+        return [docs[d] for d in doc_ids if d in docs]
+
+    def get_by_name(self, name):
+        """Get a document by name."""
+        with self._lock:
+            for doc in self._docs.values():
+                if doc['name'] == name:
+                    return doc
+
+        return None
+
+    def insert(self, doc):
+        """Insert a new document.
+
+        Returns:
+            ID of the new document.
+        """
+        return self.insert_many([doc])[0]
+
+    def insert_many(self, docs):
+        """Insert several documents at once.
+
+        Returns:
+            List of IDs of the new documents.
+        """
+        docs = [dict(d) for d in docs]
+
+        with self._lock:
+            if self.write_behind:
+                doc_ids = list(range(self._next_id, self._next_id + len(docs)))
+                self._dirty = True
+
+            else:
+                doc_ids = self.db.insert_multiple(docs)
+
+            for doc_id, doc in zip(doc_ids, docs):
+                self._docs[doc_id] = Document(doc, doc_id)
+
+            if doc_ids:
+                self._next_id = max(self._next_id, doc_ids[-1] + 1)
+
+        return doc_ids
+
+    def update(self, doc_id, fields):
+        """Update some fields of a document.
+
+        Returns:
+            Boolean indicating if the document was updated or not.
+        """
+        with self._lock:
+            if doc_id not in self._docs:
+                return False
+
+            if self.write_behind:
+                self._dirty = True
+
+            else:
+                self.db.update(fields, doc_ids=[doc_id,])
+
+            self._docs[doc_id].update(fields)
+
+        return True
+
+    def remove(self, doc_id):
+        """Remove a document by ID.
+
+        Returns:
+            Boolean indicating if the document was removed or not.
+        """
+        with self._lock:
+            if self._docs.pop(doc_id, None) is None:
+                return False
+
+            if self.write_behind:
+                self._dirty = True
+
+            else:
+                self.db.remove(doc_ids=[doc_id,])
+
+        return True
+
+    def search_text(self, text):
+        """Full text search. Not supported by this backend.
+
+        Returns:
+            None
+        """
+        return None
+
+
+class SQLiteStorage(object):
+    """Storage backed by a SQLite database.
+
+    WATs are stored in an indexed table, so writes only touch the affected rows
+    and documents are read from disk on demand instead of being kept in
+    memory. If the SQLite library supports it, an FTS5 table is used to
+    search individual words of names and expressions.
+
+    Attributes:
+
+    path (str): Path to the database file.
+    conn (Connection): Database connection, shared by all handler threads.
+    has_fts (bool): Whether full text search is available.
+    _lock (RLock): Lock serializing access to the connection.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS wats ('
+        '    id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        '    name TEXT NOT NULL,'
+        '    file_ids TEXT NOT NULL,'
+        '    expressions TEXT NOT NULL,'
+        '    weight REAL'
+        ')',
+        'CREATE INDEX IF NOT EXISTS wats_name ON wats (name)',
+        # Expressions are matched by the in-memory index, not by SQL
+        'DROP TABLE IF EXISTS expressions',
+    )
+
+    FTS_SCHEMA = (
+        'CREATE VIRTUAL TABLE IF NOT EXISTS wats_fts '
+        '    USING fts5 (name, expressions)'
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._connect()
+
+    def _connect(self):
+        """Open the connection, creating the tables if needed."""
+        self.conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None
+        )
+
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+
+        try:
+            self.conn.execute(self.FTS_SCHEMA)
+            self.has_fts = True
+
+        except sqlite3.OperationalError:
+            self.has_fts = False
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self.conn.close()
+
+    def after_fork(self):
+        """Prepare the storage for use in a forked process.
+
+        SQLite connections cannot be shared between processes, so a new one
+        is opened.
+        """
+        self._lock = threading.RLock()
+        self._connect()
+
+    @contextlib.contextmanager
+    def quiesce(self):
+        """Keep the storage from being modified, e.g. while forking."""
+        with self._lock:
+            yield
+
+    def flush(self):
+        """Write pending changes to the database file.
+
+        Changes are committed as they happen, but may stay in the write-ahead
+        log for a while. This moves them to the database file.
+        """
+        with self._lock:
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def _to_doc(self, row):
+        """Build a document from a row of the `wats` table."""
+        doc = {
+            'name': row[1],
+            'file_ids': json.loads(row[2]),
+            'expressions': json.loads(row[3])
+        }
+
+        if row[4] is not None:
+            doc['weight'] = row[4]
+
+        return Document(doc, row[0])
+
+    def all(self):
+        """Iterate over all documents in ascending ID order.
+
+        Rows are streamed from the database rather than loaded at once.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'SELECT id, name, file_ids, expressions, weight '
+            'FROM wats ORDER BY id'
+        )
+
+        for row in cursor:
+            yield self._to_doc(row)
+
+    def get(self, doc_id):
+        """Get a document by ID."""
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT id, name, file_ids, expressions, weight '
+                'FROM wats WHERE id = ?',
+                (doc_id,)
+            ).fetchone()
+
+        return self._to_doc(row) if row else None
+
+    def get_many(self, doc_ids):
+        """Get several documents by ID, in the same order."""
+        docs = {}
+        doc_ids = list(doc_ids)
+
+        with self._lock:
+            # Stay below the default limit of variables in a statement
+            for i in range(0, len(doc_ids), 500):
+                chunk = doc_ids[i:i + 500]
+                rows = self.conn.execute(
+                    'SELECT id, name, file_ids, expressions, weight '
+                    'FROM wats WHERE id IN (%s)' % ','.join('?' * len(chunk)),
+                    chunk
+                )
+
+                for row in rows:
+                    docs[row[0]] = self._to_doc(row)
+
+        return [docs[d] for d in doc_ids if d in docs]
+
+    def get_by_name(self, name):
+        """Get a document by name."""
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT id, name, file_ids, expressions, weight '
+                'FROM wats WHERE name = ? LIMIT 1',
+                (name,)
+            ).fetchone()
+
+        return self._to_doc(row) if row else None
+
+    def insert(self, doc, doc_id=None):
+        """Insert a new document.
+
+        Args:
+            doc (dict): Document to insert.
+            doc_id (int): ID to use for the document. If not provided, a new
+                one is assigned.
+
+        Returns:
+            ID of the new document.
+        """
+        return self.insert_many([doc], [doc_id])[0]
+
+    def insert_many(self, docs, doc_ids=None):
+        """Insert several documents in a single transaction.
+
+        Args:
+            docs (iterable): Documents to insert.
+            doc_ids (list[int]): IDs to use for the documents, if any.
+
+        Returns:
+            List of IDs of the new documents.
+        """
+        result = []
+        docs = list(docs)
+        doc_ids = doc_ids or [None] * len(docs)
+
+        with self._lock:
+            with self.conn:
+                self.conn.execute('BEGIN')
+
+                for doc, doc_id in zip(docs, doc_ids):
+                    cursor = self.conn.execute(
+                        'INSERT INTO wats '
+                        '(id, name, file_ids, expressions, weight) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (
+                            doc_id,
+                            doc['name'],
+                            json.dumps(doc['file_ids']),
+                            json.dumps(doc['expressions']),
+                            doc.get('weight')
+                        )
+                    )
+
+                    doc_id = cursor.lastrowid
+                    self._index_row(doc_id, doc['name'], doc['expressions'])
+                    result.append(doc_id)
+
+        return result
+
+    def update(self, doc_id, fields):
+        """Update some fields of a document.
+
+        Returns:
+            Boolean indicating if the document was updated or not.
+        """
+        with self._lock:
+            doc = self.get(doc_id)
+
+            if not doc:
+                return False
+
+            doc.update(fields)
+
+            with self.conn:
+                self.conn.execute('BEGIN')
+                self.conn.execute(
+                    'UPDATE wats SET name = ?, file_ids = ?, expressions = ?, '
+                    'weight = ? WHERE id = ?',
+                    (
+                        doc['name'],
+                        json.dumps(doc['file_ids']),
+                        json.dumps(doc['expressions']),
+                        doc.get('weight'),
+                        doc_id
+                    )
+                )
+
+                if 'name' in fields or 'expressions' in fields:
+                    self._unindex_row(doc_id)
+                    self._index_row(doc_id, doc['name'], doc['expressions'])
+
+        return True
+
+    def remove(self, doc_id):
+        """Remove a document by ID.
+
+        Returns:
+            Boolean indicating if the document was removed or not.
+        """
+        with self._lock:
+            with self.conn:
+                self.conn.execute('BEGIN')
+                self._unindex_row(doc_id)
+                cursor = self.conn.execute(
+                    'DELETE FROM wats WHERE id = ?',
+                    (doc_id,)
+                )
+
+        return cursor.rowcount > 0
+
+    def search_text(self, text):
+        """Find documents containing all the words of a text.
+
+        Every word is matched as a prefix against the words of the names and
+        expressions of the documents.
+
+        Returns:
+            List of document IDs ordered by relevance, or None if full text
+            search is not available.
+        """
+        if not self.has_fts:
+            return None
+
+        words = text.split()
+
+        if not words:
+            return []
+
+        query = ' '.join(
+            '"%s"*' % w.replace('"', '""') for w in words
+        )
+
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT rowid FROM wats_fts WHERE wats_fts MATCH ? '
+                'ORDER BY rank',
+                (query,)
+            ).fetchall()
+
+        return [r[0] for r in rows]
+
+    def _index_row(self, doc_id, name, expressions):
+        """Add the full text search entry of a document."""
+        if self.has_fts:
+            self.conn.execute(
+                'INSERT INTO wats_fts (rowid, name, expressions) '
+                'VALUES (?, ?, ?)',
+                (doc_id, name, '\n'.join(expressions))
+            )
+
+    def _unindex_row(self, doc_id):
+        """Remove the full text search entry of a document."""
+        if self.has_fts:
+            self.conn.execute(
+                'DELETE FROM wats_fts WHERE rowid = ?',
+                (doc_id,)
+            )
+
+
+class SnapshotStorage(object):
+    """Storage serving reads from a snapshot of another storage.
+
+    The catalog is read from a memory-mapped snapshot file (see
+    nekowatbot.snapshot), so opening it takes a fraction of the time and
+    memory needed to load the primary database. Writes go to the primary
+    storage, which is only opened when first needed, and the documents they
+    change are kept in an overlay until the snapshot is rebuilt in the
+    background.
+
+    When opened, the snapshot is rebuilt if it is missing, was written by
+    another version or does not match the current primary database.
+
+    Attributes:
+
+    backend (str): Backend of the primary storage.
+    path (str): Path to the primary database.
+    snapshot_path (str): Path to the snapshot file.
+    rebuild_delay (float): Seconds to wait after a change before rebuilding
+        the snapshot, so that a burst of changes causes a single rebuild.
+    options (dict): Options of the primary storage.
+    snapshot (Snapshot): Current snapshot.
+    _primary: Primary storage, or None if not opened yet.
+    _overlay (dict): (sequence, document) tuples of the documents changed
+        since the snapshot was written, indexed by ID. The document is None
+        if it was removed.
+    _seq (int): Sequence number of the last change.
+    _timer (Timer): Pending rebuild, if any.
+    _lock (RLock): Lock protecting the snapshot and the overlay.
+    _rebuild_lock (Lock): Lock serializing rebuilds.
+    """
+
+    def __init__(self, backend, path, snapshot, rebuild_delay=5, **options):
+        self.backend = backend
+        self.path = path
+        self.snapshot_path = snapshot
+        self.rebuild_delay = rebuild_delay
+        self.options = options
+
+        self.snapshot = None
+        self._primary = None
+        self._overlay = {}
+        self._seq = 0
+        self._timer = None
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.Lock()
+
+        try:
+            current = Snapshot(snapshot)
+
+        except (OSError, SnapshotError) as e:
+            print('Cannot use catalog snapshot: %s' % e)
+
+        else:
+            # Recent changes to a SQLite database may only be in its log
+            if self.backend == 'sqlite':
+                self._open_primary().flush()
+
+            if current.matches(path):
+                self.snapshot = current
+
+            else:
+                print('Catalog snapshot is out of date')
+                current.close()
+
+        if self.snapshot is None:
+            print('Rebuilding catalog snapshot')
+            self.rebuild()
+
+            # Do not keep a whole TinyDB catalog in memory until a write
+            if self.backend != 'sqlite':
+                self._primary.close()
+                self._primary = None
+
+    def _open_primary(self):
+        """Get the primary storage, opening it if needed."""
+        with self._lock:
+            if self._primary is None:
+                self._primary = BACKENDS[self.backend](
+                    self.path,
+                    **self.options
+                )
+
+            return self._primary
+
+    def close(self):
+        """Close the storage, rebuilding the snapshot if needed."""
+        with self._lock:
+            pending = self._timer is not None
+
+            if pending:
+                self._timer.cancel()
+                self._timer = None
+
+        if pending:
+            self.rebuild()
+
+        if self._primary is not None:
+            self._primary.close()
+
+    def after_fork(self):
+        """Prepare the storage for reading in a forked process.
+
+        The snapshot and the overlay are inherited from the parent process.
+        The process must not write to the storage, so no rebuilds are
+        scheduled there.
+        """
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.Lock()
+        self._timer = None
+
+        if self._primary is not None:
+            self._primary.after_fork()
+
+    @contextlib.contextmanager
+    def quiesce(self):
+        """Keep the storage from being modified, e.g. while forking."""
+        with self._lock:
+            if self._primary is None:
+                yield
+                return
+
+            with self._primary.quiesce():
+                yield
+
+    def flush(self):
+        """Write pending changes to disk and rebuild the snapshot."""
+        with self._lock:
+            if self._timer is None:
+                return
+
+            self._timer.cancel()
+            self._timer = None
+
+        self.rebuild()
+
+    def rebuild(self):
+        """Write a new snapshot of the primary database and switch to it.
+
+        Only copying the documents from the primary holds the lock. Pending
+        changes are written to the database file, its stamp is computed and
+        the snapshot is written without it, so reads and writes are not
+        blocked for long. If the catalog changes in the meantime, the stamp
+        may not match the documents copied, so the snapshot is written with
+        a stamp that never matches and is rebuilt again.
+
+        Returns:
+            Number of documents in the snapshot.
+        """
+        with self._rebuild_lock:
+            with self._lock:
+                primary = self._open_primary()
+                flushed = self._seq
+
+            primary.flush()
+
+            with self._lock:
+                docs = [
+                    Document(dict(doc), doc.doc_id) for doc in primary.all()
+                ]
+                seq = self._seq
+
+            stamp = source_stamp(self.path)
+
+            with self._lock:
+                if self._seq != flushed:
+                    stamp = STALE_STAMP
+
+            write_snapshot(self.snapshot_path, docs, stamp)
+            snapshot = Snapshot(self.snapshot_path)
+
+            with self._lock:
+                self.snapshot = snapshot
+                self._overlay = dict(
+                    (doc_id, entry) for doc_id, entry in self._overlay.items()
+                    if entry[0] > seq
+                )
+
+        return len(docs)
+
+    def _rebuild_later(self):
+        """Rebuild the snapshot from the timer thread."""
+        with self._lock:
+            self._timer = None
+
+        try:
+            self.rebuild()
+
+        except Exception as e:
+            print('Failed to rebuild catalog snapshot: %s' % e)
+
+    def _changed(self, doc_id, doc):
+        """Record a change in the overlay and schedule a rebuild.
+
+        Must be called with the lock held.
+        """
+        self._seq += 1
+        self._overlay[doc_id] = (
+            self._seq,
+            Document(dict(doc), doc_id) if doc is not None else None
+        )
+
+        if self._timer is None:
+            self._timer = threading.Timer(
+                self.rebuild_delay,
+                self._rebuild_later
+            )
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _view(self):
+        """Get the current snapshot and overlay, consistent with each other."""
+        with self._lock:
+            return self.snapshot, self._overlay
+
+    @staticmethod
+    def _lookup(view, doc_id):
+        """Get a document from a view, or None if not found."""
+        snapshot, overlay = view
+        entry = overlay.get(doc_id)
+
+        if entry is not None:
+            return entry[1]
+
+        return snapshot.get(doc_id)
+
+    def all(self):
+        """Iterate over all documents in ascending ID order."""
+        view = self._view()
+        snapshot, overlay = view
+        doc_ids = set(snapshot.doc_ids.tolist())
+        doc_ids.update(overlay)
+
+        for doc_id in sorted(doc_ids):
+            doc = self._lookup(view, doc_id)
+
+            if doc is not None:
+                yield doc
+
+    def get(self, doc_id):
+        """Get a document by ID."""
+        return self._lookup(self._view(), doc_id)
+
+    def get_many(self, doc_ids):
+        """Get several documents by ID, in the same order."""
+        view = self._view()
+        docs = (self._lookup(view, d) for d in doc_ids)
+
+        return [doc for doc in docs if doc is not None]
+
+    def get_by_name(self, name):
+        """Get a document by name."""
+        snapshot, overlay = self._view()
+        candidates = [
+            entry[1] for entry in overlay.values()
+            if entry[1] is not None and entry[1]['name'] == name
+        ]
+
+        for row in snapshot.find_name(name):
+            if int(snapshot.doc_ids[row]) not in overlay:
+                candidates.append(snapshot.doc(row))
+
+        if not candidates:
+            return None
+
+        return min(candidates, key=lambda d: d.doc_id)
+
+    def insert(self, doc):
+        """Insert a new document.
+
+        Returns:
+            ID of the new document.
+        """
+        return self.insert_many([doc])[0]
+
+    def insert_many(self, docs):
+        """Insert several documents at once.
+
+        Returns:
+            List of IDs of the new documents.
+        """
+        docs = [dict(d) for d in docs]
+
+        with self._lock:
+            doc_ids = self._open_primary().insert_many(docs)
+
+            for doc_id, doc in zip(doc_ids, docs):
+                self._changed(doc_id, doc)
+
+        return doc_ids
+
+    def update(self, doc_id, fields):
+        """Update some fields of a document.
+
+        Returns:
+            Boolean indicating if the document was updated or not.
+        """
+        with self._lock:
+            primary = self._open_primary()
+
+            if not primary.update(doc_id, fields):
+                return False
+
+            self._changed(doc_id, primary.get(doc_id))
+
+        return True
+
+    def remove(self, doc_id):
+        """Remove a document by ID.
+
+        Returns:
+            Boolean indicating if the document was removed or not.
+        """
+        with self._lock:
+            if not self._open_primary().remove(doc_id):
+                return False
+
+            self._changed(doc_id, None)
+
+        return True
+
+    def search_text(self, text):
+        """Full text search, if supported by the primary storage.
+
+        Returns:
+            List of document IDs ordered by relevance, or None if full text
+            search is not available.
+        """
+        if self.backend != 'sqlite':
+            return None
+
+        return self._open_primary().search_text(text)
+
+
+BACKENDS = {
+    'tinydb': TinyDBStorage,
+    'sqlite': SQLiteStorage
+}
+
+
+def migrate(source, target, batch_size=1000):
+    """Copy every document from a storage to another, keeping their IDs.
+
+    Args:
+        source: Storage to read from.
+        target (SQLiteStorage): Storage to write to.
+        batch_size (int): Number of documents inserted per transaction.
+
+    Returns:
+        Number of documents copied.
+    """
+    count = 0
+    batch = []
+
+    for doc in source.all():
+        batch.append(doc)
+
+        if len(batch) >= batch_size:
+            target.insert_many(batch, [d.doc_id for d in batch])
+            count += len(batch)
+            batch = []
+
+    if batch:
+        target.insert_many(batch, [d.doc_id for d in batch])
+        count += len(batch)
+
+    return count
+
@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Supervision of the bot.
+
+This module keeps the bot running: handler errors are logged instead of
+stopping the bot, the ID of the last update processed is persisted so that a
+restart resumes where the bot left off, and the launcher restarts the bot
+with a jittered exponential backoff when receiving updates fails.
+
+An update counts as processed once every handler call it caused has finished
+and every request queued by those handlers has been sent, whether it was
+handled by this process or by a worker process. The ID persisted is the one
+before the oldest update still pending, so updates received but not handled
+yet when the bot stops are received again on restart.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import traceback
+
+import requests
+import telebot
+
+from nekowatbot.metrics import count_updates
+
+
+logger = logging.getLogger('TeleBot')
+
+# Attributes of an update holding the object passed to its handlers
+UPDATE_TYPES = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'inline_query', 'chosen_inline_result', 'callback_query',
+    'shipping_query', 'pre_checkout_query'
+)
+
+
+def safe_handler(task):
+    """Wrap a handler so that its exceptions are logged, not raised."""
+    def wrapper(*args, **kwargs):
+        try:
+            return task(*args, **kwargs)
+
+        except Exception:
+            logger.exception('Error in handler %s', getattr(
+                task,
+                '__name__',
+                task
+            ))
+
+    return wrapper
+
+
+def is_transient(exc):
+    """Check whether an error is likely to be temporary.
+
+    Network errors and Telegram server errors (including rate limits) are
+    considered transient.
+    """
+    if isinstance(exc, (requests.exceptions.RequestException, OSError)):
+        return True
+
+    # asyncio engine
+    error_code = getattr(exc, 'error_code', None)
+
+    if error_code is not None:
+        return error_code == 429 or error_code >= 500
+
+    result = getattr(exc, 'result', None)
+    status = getattr(result, 'status_code', None)
+
+    if status is not None:
+        return status == 429 or status >= 500
+
+    try:
+        import aiohttp
+        import asyncio
+
+        return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    except ImportError:
+        return False
+
+
+class UpdateOffsetStore(object):
+    """Persistent ID of the last update processed.
+
+    Attributes:
+
+    path (str): Path to the state file.
+    _last (int): Last ID saved.
+    _lock (Lock): Lock serializing writes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._last = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Get the last update ID saved, or 0 if there is none."""
+        try:
+            with open(self.path) as f:
+                self._last = int(json.load(f)['last_update_id'])
+
+        except (IOError, ValueError, KeyError, TypeError):
+            self._last = 0
+
+        return self._last
+
+    def save(self, update_id):
+        """Save the last update ID, atomically replacing the state file."""
+        with self._lock:
+            if update_id == self._last:
+                return
+
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'last_update_id': update_id}, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                os.replace(tmp_path, self.path)
+
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+            self._last = update_id
+
+
+class UpdateLedger(object):
+    """Updates received that have not been completely processed yet.
+
+    Each pending update has a number of holds: one while it is dispatched,
+    one for each handler call queued or running, and one for each request
+    queued by those handlers. The update is done once every hold has been
+    released.
+
+    The update being handled is kept in a context variable, so that it is
+    per thread and inherited by the asyncio tasks created while handling it.
+
+    Attributes:
+
+    on_done (callable): Function receiving the ID of each update once it is
+        done, if any.
+    _pending (dict): Number of holds of each pending update, by ID.
+    _last (int): Highest update ID received.
+    _current (ContextVar): ID of the update whose handler the current
+        thread or task runs.
+    _lock (Lock): Lock protecting the holds.
+    """
+
+    def __init__(self, on_done=None):
+        self.on_done = on_done
+        self._pending = {}
+        self._last = None
+        self._current = contextvars.ContextVar('update_id', default=None)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def receive(self, update_ids):
+        """Hold updates while they are dispatched."""
+        with self._lock:
+            for update_id in update_ids:
+                self._pending[update_id] = self._pending.get(update_id, 0) + 1
+
+                if self._last is None or update_id > self._last:
+                    self._last = update_id
+
+    def hold(self, update_id):
+        """Add a hold to a pending update."""
+        with self._lock:
+            self._pending[update_id] += 1
+
+    def release(self, update_id):
+        """Release a hold of an update."""
+        with self._lock:
+            holds = self._pending[update_id] - 1
+
+            if holds:
+                self._pending[update_id] = holds
+                return
+
+            del self._pending[update_id]
+
+        if self.on_done:
+            self.on_done(update_id)
+
+    def current(self):
+        """ID of the update whose handler the current thread runs, if any."""
+        return self._current.get()
+
+    def set_current(self, update_id):
+        """Set the update whose handler the current thread runs.
+
+        Returns:
+            ID of the previous update, to be restored afterwards.
+        """
+        previous = self.current()
+        self._current.set(update_id)
+
+        return previous
+
+    def hold_current(self):
+        """Add a hold to the update whose handler the current thread runs.
+
+        Returns:
+            ID of the update held, or None if there is no such update.
+        """
+        update_id = self.current()
+
+        if update_id is not None:
+            self.hold(update_id)
+
+        return update_id
+
+    def offset(self):
+        """ID of the last update that may be confirmed.
+
+        Returns:
+            ID before the oldest pending update, the highest ID received if
+            none is pending, or None if no update has been received.
+        """
+        with self._lock:
+            if self._pending:
+                return min(self._pending) - 1
+
+            return self._last
+
+
+class HandlerTask(object):
+    """Handler call caused by an update, which is pending until it finishes.
+
+    Exceptions raised by the handler are logged (see `safe_handler()`). If
+    the executor drops the call, `cancel()` is called instead.
+
+    Attributes:
+
+    handler (callable): Handler to call.
+    ledger (UpdateLedger): Ledger of the pending updates.
+    update_id (int): ID of the update.
+    on_cancel (callable): Function receiving the arguments of the call if
+        it is dropped, if any.
+    """
+
+    def __init__(self, handler, ledger, update_id, on_cancel=None):
+        self.handler = safe_handler(handler)
+        self.ledger = ledger
+        self.update_id = update_id
+        self.on_cancel = on_cancel
+
+        ledger.hold(update_id)
+
+    def __call__(self, *args, **kwargs):
+        previous = self.ledger.set_current(self.update_id)
+
+        try:
+            return self.handler(*args, **kwargs)
+
+        finally:
+            self.ledger.set_current(previous)
+            self.ledger.release(self.update_id)
+
+    def cancel(self, *args, **kwargs):
+        """Release the update of a call that will not run."""
+        try:
+            if self.on_cancel:
+                self.on_cancel(*args, **kwargs)
+
+        finally:
+            self.ledger.release(self.update_id)
+
+
+def set_api_url(api_url):
+    """Send the requests of telebot to another Bot API server.
+
+    telebot binds the URL of the API as a default argument, so the default
+    is replaced as well.
+
+    Args:
+        api_url (str): Format string of the URLs of the API methods, such as
+            'http://127.0.0.1:8081/bot{0}/{1}'.
+    """
+    make_request = telebot.apihelper._make_request
+
+    telebot.apihelper.API_URL = api_url
+    make_request.__defaults__ = make_request.__defaults__[:-1] + (api_url,)
+
+
+class SupervisedTeleBot(telebot.TeleBot):
+    """TeleBot that survives handler errors and persists its offset.
+
+    By default, an exception in a handler stops polling. Here handlers are
+    wrapped so that their exceptions are only logged.
+
+    Attributes:
+
+    offset_store (UpdateOffsetStore): Where to persist the ID of the last
+        update processed, if anywhere.
+    ledger (UpdateLedger): Updates received that are still being processed.
+    router (callable): If set, receives every list of updates and returns
+        the ones to handle in this process (see `WorkerPool.route()`).
+    inline_tracker (InlineTracker): If set, tracks the inline queries
+        received and drops the superseded ones.
+    executor (HandlerExecutor): If set, runs the handlers instead of the
+        thread pool of the bot (see nekowatbot.executor).
+    count_received (bool): Whether the updates are counted in the metrics.
+        Worker processes receive updates already counted by the primary.
+    _dispatching (local): Update IDs of the objects being dispatched by the
+        current thread, by object ID.
+    """
+
+    count_received = True
+    offset_store = None
+    router = None
+    inline_tracker = None
+    executor = None
+
+    def __init__(self, *args, **kwargs):
+        super(SupervisedTeleBot, self).__init__(*args, **kwargs)
+
+        self.ledger = UpdateLedger()
+        self._dispatching = threading.local()
+
+    def _exec_task(self, task, *args, **kwargs):
+        objects = getattr(self._dispatching, 'objects', {})
+        update_id = objects.get(id(args[0])) if args else None
+
+        if update_id is not None:
+            task = HandlerTask(
+                task,
+                self.ledger,
+                update_id,
+                self._handler_dropped
+            )
+
+        else:
+            task = safe_handler(task)
+
+        if self.threaded and self.executor is not None:
+            self.executor.submit(task, *args, **kwargs)
+            return
+
+        super(SupervisedTeleBot, self)._exec_task(task, *args, **kwargs)
+
+    def _handler_dropped(self, obj, *args, **kwargs):
+        """Clean up after a handler call dropped by the executor.
+
+        Dropped inline queries are never answered, so they are forgotten by
+        the inline tracker, as handled ones are.
+        """
+        if (self.inline_tracker is not None
+                and isinstance(obj, telebot.types.InlineQuery)):
+            self.inline_tracker.finish(obj)
+
+    def process_new_updates(self, updates):
+        if self.count_received:
+            count_updates(updates)
+
+        if updates:
+            self._dispatch(updates)
+
+        # Saved for empty batches as well, as updates finish in between
+        self.save_offset()
+
+    def _dispatch(self, updates):
+        """Dispatch updates to the workers or the handlers."""
+        update_ids = [u.update_id for u in updates]
+
+        self.ledger.receive(update_ids)
+        self.last_update_id = max(self.last_update_id, max(update_ids))
+
+        local = updates
+
+        if self.router:
+            # Routed updates are released when the workers are done
+            local = self.router(updates)
+
+        handled = local
+
+        if self.inline_tracker is not None:
+            handled = self.inline_tracker.track(local)
+
+        self._dispatching.objects = dict(
+            (id(getattr(update, update_type)), update.update_id)
+            for update in handled
+            for update_type in UPDATE_TYPES
+            if getattr(update, update_type, None) is not None
+        )
+
+        try:
+            super(SupervisedTeleBot, self).process_new_updates(handled)
+
+        finally:
+            self._dispatching.objects = {}
+
+            for update in local:
+                self.ledger.release(update.update_id)
+
+    def save_offset(self):
+        """Persist the ID of the last update processed, if enabled."""
+        if not self.offset_store:
+            return
+
+        offset = self.ledger.offset()
+
+        if offset is not None:
+            self.offset_store.save(offset)
+
+
+class Supervisor(object):
+    """Runs the bot, restarting it with exponential backoff when it fails.
+
+    Network and Telegram server errors usually go away soon, so they are not
+    counted as failures: the bot is restarted after a short fixed delay (or
+    the delay requested by Telegram) instead.
+
+    Attributes:
+
+    start (callable): Function running the bot until it stops or fails.
+    stop (callable): Function stopping the bot.
+    base_delay (float): Delay before the first restart.
+    max_delay (float): Maximum delay between restarts.
+    stable_time (float): Seconds the bot must run for the backoff to reset.
+    transient_delay (float): Delay before restarting after a transient error.
+    failures (int): Consecutive failures so far.
+    _stopping (Event): Set when the supervisor is asked to stop.
+    """
+
+    def __init__(self, start, stop, base_delay=1, max_delay=300,
+                 stable_time=60, transient_delay=5):
+        self.start = start
+        self.stop = stop
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stable_time = stable_time
+        self.transient_delay = transient_delay
+        self.failures = 0
+        self._stopping = threading.Event()
+
+    def backoff(self):
+        """Delay before the next restart after a failure (full jitter)."""
+        cap = min(self.max_delay, self.base_delay * 2 ** self.failures)
+        return random.uniform(0, cap)
+
+    def run(self):
+        """Run the bot until `shutdown()` is called."""
+        while not self._stopping.is_set():
+            started = time.monotonic()
+
+            try:
+                self.start()
+
+            except Exception as e:
+                if self._stopping.is_set():
+                    break
+
+                if time.monotonic() - started >= self.stable_time:
+                    self.failures = 0
+
+                if is_transient(e):
+                    print('Connection error: %s' % e)
+                    delay = max(
+                        self.transient_delay,
+                        getattr(e, 'retry_after', None) or 0
+                    )
+
+                else:
+                    traceback.print_exc()
+                    delay = self.backoff()
+                    self.failures += 1
+
+                print('Restarting in %.1f seconds' % delay)
+                self.stop()
+
+                self._stopping.wait(delay)
+                continue
+
+            # The bot stopped without errors, but not because it was asked to
+            if not self._stopping.is_set():
+                self.stop()
+                self._stopping.wait(self.base_delay)
+
+    def shutdown(self):
+        """Stop the bot and the supervisor."""
+        self._stopping.set()
+        self.stop()
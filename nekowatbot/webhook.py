@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Webhook servers.
+
+Instead of polling Telegram for updates, the bot can receive them through an
+embedded HTTP server. Telegram (or anyone testing locally) POSTs updates to
+the configured path, either one update per request as Telegram does or a
+list of updates. Updates are queued in a bounded queue and dispatched in
+batches to the handlers of the bot; when the queue is full the server answers
+with an error so that Telegram retries later.
+
+Requests are only accepted if they carry the configured secret in the
+`X-Telegram-Bot-Api-Secret-Token` header.
+
+Telegram only sends updates to HTTPS URLs, so the server should either be
+given a certificate or run behind a reverse proxy terminating TLS.
+"""
+
+import asyncio
+import hmac
+import http.server
+import json
+import queue
+import ssl
+import threading
+
+import telebot
+from telebot import types
+
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Maximum size of a request body
+MAX_BODY_SIZE = 1 << 20
+
+# Maximum number of updates dispatched at once
+BATCH_SIZE = 100
+
+
+def parse_updates(body):
+    """Parse the body of a webhook request.
+
+    Args:
+        body (bytes): JSON encoded update or list of updates.
+
+    Returns:
+        List of update dicts.
+
+    Raises:
+        ValueError if the body is not valid.
+    """
+    data = json.loads(body.decode('utf-8'))
+
+    if isinstance(data, dict):
+        data = [data]
+
+    if not isinstance(data, list) or not all(
+            isinstance(u, dict) and 'update_id' in u for u in data):
+        raise ValueError('Invalid update')
+
+    return data
+
+
+def check_secret(secret, received):
+    """Compare the configured secret with the one received."""
+    if not secret:
+        return True
+
+    return hmac.compare_digest(secret.encode(), (received or '').encode())
+
+
+def ssl_context(conf):
+    """Build the SSL context of the server, if configured."""
+    if not conf.get('certificate'):
+        return None
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(conf['certificate'], conf.get('key'))
+
+    return context
+
+
+def set_webhook(token, conf):
+    """Tell Telegram to send updates to the configured URL.
+
+    Nothing is done if no `url` is configured, which is useful to test the
+    server locally.
+    """
+    if not conf.get('url'):
+        return
+
+    params = {'url': conf['url']}
+
+    if conf.get('secret'):
+        params['secret_token'] = conf['secret']
+
+    if conf.get('max_connections'):
+        params['max_connections'] = conf['max_connections']
+
+    telebot.apihelper._make_request(
+        token,
+        'setWebhook',
+        params=params,
+        method='post'
+    )
+
+
+class WebhookServer(object):
+    """Threaded webhook server for `TeleBot`.
+
+    Attributes:
+
+    bot (TeleBot): Bot the updates are dispatched to.
+    conf (dict): Webhook configuration.
+    queue (Queue): Bounded queue of received updates.
+    httpd (ThreadingHTTPServer): HTTP server.
+    _dispatcher (Thread): Thread dispatching queued updates.
+    """
+
+    def __init__(self, bot, conf):
+        self.bot = bot
+        self.conf = conf
+        self.queue = queue.Queue(conf.get('queue_size', 1000))
+        self.httpd = http.server.ThreadingHTTPServer(
+            (conf.get('listen', '0.0.0.0'), conf.get('port', 8443)),
+            self._handler_class()
+        )
+        self.httpd.daemon_threads = True
+
+        context = ssl_context(conf)
+
+        if context:
+            self.httpd.socket = context.wrap_socket(
+                self.httpd.socket,
+                server_side=True
+            )
+
+        self._dispatcher = None
+
+    def _handler_class(self):
+        """Build the request handler class bound to this server."""
+        server = self
+        path = self.conf.get('path', '/')
+        secret = self.conf.get('secret')
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                if self.path != path:
+                    self.send_error(404)
+                    return
+
+                if not check_secret(secret, self.headers.get(SECRET_HEADER)):
+                    self.send_error(403)
+                    return
+
+                length = int(self.headers.get('Content-Length') or 0)
+
+                if length > MAX_BODY_SIZE:
+                    self.send_error(413)
+                    return
+
+                try:
+                    updates = parse_updates(self.rfile.read(length))
+
+                except ValueError:
+                    self.send_error(400)
+                    return
+
+                for update in updates:
+                    try:
+                        server.queue.put_nowait(update)
+
+                    except queue.Full:
+                        # Telegram will send it again later
+                        self.send_error(503)
+                        return
+
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _dispatch_loop(self):
+        """Dispatch queued updates to the bot in batches."""
+        while True:
+            update = self.queue.get()
+
+            if update is None:
+                return
+
+            batch = [update]
+
+            while len(batch) < BATCH_SIZE:
+                try:
+                    update = self.queue.get_nowait()
+
+                except queue.Empty:
+                    break
+
+                if update is None:
+                    self.queue.put(None)
+                    break
+
+                batch.append(update)
+
+            try:
+                self.bot.process_new_updates(
+                    [types.Update.de_json(u) for u in batch]
+                )
+
+            except Exception:
+                telebot.logger.exception('Error processing updates')
+
+    def serve_forever(self):
+        """Set the webhook and serve requests until `shutdown()`."""
+        set_webhook(self.bot.token, self.conf)
+
+        self._dispatcher = threading.Thread(
+            target=self._dispatch_loop,
+            name='WebhookDispatcher',
+            daemon=True
+        )
+        self._dispatcher.start()
+
+        try:
+            self.httpd.serve_forever()
+
+        finally:
+            self.httpd.server_close()
+            self.queue.put(None)
+            self._dispatcher.join()
+
+    def shutdown(self):
+        """Stop serving requests. Can be called from any thread."""
+        threading.Thread(target=self.httpd.shutdown, daemon=True).start()
+
+
+class AsyncWebhookServer(object):
+    """Webhook server for `AsyncTeleBot`, running on its event loop.
+
+    Attributes:
+
+    bot (AsyncTeleBot): Bot the updates are dispatched to.
+    conf (dict): Webhook configuration.
+    queue (Queue): Bounded asyncio queue of received updates.
+    """
+
+    def __init__(self, bot, conf):
+        self.bot = bot
+        self.conf = conf
+        self.queue = None
+
+    async def _handle(self, request):
+        from aiohttp import web
+
+        secret = self.conf.get('secret')
+
+        if not check_secret(secret, request.headers.get(SECRET_HEADER)):
+            return web.Response(status=403)
+
+        if (request.content_length or 0) > MAX_BODY_SIZE:
+            return web.Response(status=413)
+
+        try:
+            updates = parse_updates(await request.read())
+
+        except ValueError:
+            return web.Response(status=400)
+
+        for update in updates:
+            try:
+                self.queue.put_nowait(update)
+
+            except asyncio.QueueFull:
+                # Telegram will send it again later
+                return web.Response(status=503)
+
+        return web.Response()
+
+    async def _dispatch_loop(self):
+        """Dispatch queued updates to the bot in batches."""
+        while True:
+            batch = [await self.queue.get()]
+
+            while len(batch) < BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                self.bot.process_new_updates(
+                    [types.Update.de_json(u) for u in batch]
+                )
+
+            except Exception:
+                telebot.logger.exception('Error processing updates')
+
+    async def run(self):
+        """Serve requests until the bot is stopped."""
+        from aiohttp import web
+
+        await self.bot.open()
+        self.queue = asyncio.Queue(self.conf.get('queue_size', 1000))
+
+        app = web.Application(client_max_size=MAX_BODY_SIZE)
+        app.router.add_post(self.conf.get('path', '/'), self._handle)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+
+        site = web.TCPSite(
+            runner,
+            self.conf.get('listen', '0.0.0.0'),
+            self.conf.get('port', 8443),
+            ssl_context=ssl_context(self.conf)
+        )
+        await site.start()
+
+        dispatcher = asyncio.get_running_loop().create_task(
+            self._dispatch_loop()
+        )
+
+        try:
+            if self.conf.get('url'):
+                await self.bot.request('setWebhook', {
+                    'url': self.conf['url'],
+                    'secret_token': self.conf.get('secret'),
+                    'max_connections': self.conf.get('max_connections')
+                })
+
+            await self.bot.wait_stopped()
+
+        finally:
+            await runner.cleanup()
+            dispatcher.cancel()
+            await self.bot.close()
+
+    def serve_forever(self):
+        """Run the event loop and serve requests until `shutdown()`."""
+        asyncio.run(self.run())
+
+    def shutdown(self):
+        """Stop serving requests. Can be called from any thread."""
+        self.bot.stop_polling()
@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Worker processes handling updates in parallel.
+
+The process receiving updates (the primary) sends them to a pool of worker
+processes, choosing the worker by chat (or user) ID so that the updates of a
+chat are always handled in order by the same worker. Updates of the owner are
+handled by the primary itself, since it is the only process allowed to modify
+the catalog.
+
+Workers are forked from the primary once the catalog and its indexes are
+loaded, so they share them copy-on-write instead of loading their own copy.
+When the catalog changes, new workers are forked from the primary and the old
+ones exit once they have handled their pending updates.
+
+Workers report to the primary the changes of their metrics and the IDs of
+the updates they are done with, so that the primary persists the offset of
+the updates processed by every process.
+"""
+
+import contextlib
+import gc
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+from nekowatbot.metrics import REGISTRY
+
+
+logger = logging.getLogger('TeleBot')
+
+# Seconds between reports of the metrics of a worker to the primary
+REPORT_INTERVAL = 1
+
+# Types of updates sent by a user, in which the user ID is the routing key.
+# Chosen inline results are not routed, as the primary process keeps the
+# popularity counters
+USER_UPDATES = ('inline_query', 'callback_query')
+
+# Types of updates sent to a chat, in which the chat ID is the routing key
+CHAT_UPDATES = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post'
+)
+
+
+def routing_key(update):
+    """Get the ID used to choose the worker of an update.
+
+    Returns:
+        Chat ID for messages, user ID for queries, or None for other updates.
+    """
+    for update_type in CHAT_UPDATES:
+        message = getattr(update, update_type, None)
+
+        if message is not None:
+            return message.chat.id
+
+    for update_type in USER_UPDATES:
+        query = getattr(update, update_type, None)
+
+        if query is not None:
+            return query.from_user.id
+
+    return None
+
+
+def _worker_main(updates, reports, setup, index):
+    """Entry point of a worker process.
+
+    Args:
+        updates (Queue): Queue of lists of updates for this worker. None
+            signals that the worker should exit.
+        reports (Queue): Queue receiving ('metrics', changes) tuples with
+            the changes of the metrics of the worker (see
+            `Registry.difference()`) and ('done', update_id) tuples.
+        setup (callable): Function preparing the process state inherited
+            from the primary. Receives the index of the worker and a
+            function to call with the ID of each update the worker is done
+            with, and returns a tuple of functions to process updates and
+            to shut down.
+        index (int): Index of the worker.
+    """
+    # The primary handles signals and tells workers when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    parent = os.getppid()
+    REGISTRY.after_fork()
+
+    def done(update_id):
+        reports.put(('done', update_id))
+
+    process_updates, shutdown = setup(index, done)
+
+    # Metrics inherited from the primary are not reported back
+    baseline = REGISTRY.sample()
+    reported = time.monotonic()
+
+    def report():
+        nonlocal baseline, reported
+
+        sample = REGISTRY.sample()
+        changes = REGISTRY.difference(sample, baseline)
+        baseline = sample
+        reported = time.monotonic()
+
+        if changes:
+            reports.put(('metrics', changes))
+
+    while True:
+        if time.monotonic() - reported >= REPORT_INTERVAL:
+            report()
+
+        try:
+            batch = updates.get(timeout=REPORT_INTERVAL)
+
+        except queue.Empty:
+            if os.getppid() != parent:
+                # Orphaned
+                break
+
+            continue
+
+        if batch is None:
+            break
+
+        try:
+            process_updates(batch)
+
+        except Exception:
+            logger.exception('Error processing updates in worker %d', index)
+
+    shutdown()
+    report()
+
+
+class WorkerPool(object):
+    """Pool of forked worker processes.
+
+    The updates sent to a worker are remembered until the worker reports
+    them done. Workers found dead are forked again, and the updates they
+    had not handled are sent to their replacements.
+
+    Workers are forked while the catalog is quiesced (see `quiesce`), so
+    that they never inherit it half modified or its locks held by another
+    thread. Everything else holding threads or locks, such as the sender
+    and the handler executor, is created anew by `setup`, and the locks of
+    the metrics are replaced.
+
+    Attributes:
+
+    count (int): Number of workers.
+    setup (callable): Function preparing a worker process, see
+        `_worker_main()`.
+    is_local (callable): Function telling whether the updates with a routing
+        key must be handled by the primary.
+    republish_delay (float): Seconds to wait for further changes of the
+        catalog before forking new workers.
+    on_done (callable): Function receiving the ID of each update the
+        workers are done with, if any.
+    quiesce (callable): Function returning a context manager that keeps the
+        state inherited by the workers from changing while forking.
+    _workers (list): Tuples of process and queue of each worker.
+    _retiring (list): Processes of the workers replaced that have not
+        exited yet.
+    _owners (dict): Tuples of process and update of the updates sent to the
+        workers and not done yet, indexed by update ID.
+    _reports (Queue): Reports of the workers, see `_worker_main()`.
+    _collector (Thread): Thread adding the changes of the metrics of the
+        workers to those of the primary, passing on the updates done and
+        replacing dead workers.
+    _stopping (bool): Whether the pool is being stopped.
+    _timer (Timer): Pending republication of the catalog, if any.
+    _lock (Lock): Lock protecting the workers.
+    """
+
+    def __init__(self, count, setup, is_local, republish_delay=2,
+                 on_done=None, quiesce=contextlib.nullcontext):
+        self.count = count
+        self.setup = setup
+        self.is_local = is_local
+        self.republish_delay = republish_delay
+        self.on_done = on_done
+        self.quiesce = quiesce
+        self._context = multiprocessing.get_context('fork')
+        self._workers = []
+        self._retiring = []
+        self._owners = {}
+        self._reports = self._context.Queue()
+        self._collector = None
+        self._stopping = False
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _fork(self, indexes):
+        """Fork new workers from the current state of the process.
+
+        Args:
+            indexes (list[int]): Indexes of the workers.
+
+        Returns:
+            List of tuples of process and queue.
+        """
+        workers = []
+
+        # Keep the garbage collector from touching (and therefore copying)
+        # the objects inherited by the workers
+        gc.freeze()
+
+        try:
+            with self.quiesce():
+                for index in indexes:
+                    updates = self._context.Queue()
+                    process = self._context.Process(
+                        target=_worker_main,
+                        args=(updates, self._reports, self.setup, index),
+                        name='NekowatWorker-%d' % index,
+                        daemon=True
+                    )
+                    process.start()
+                    workers.append((process, updates))
+
+        finally:
+            gc.unfreeze()
+
+        return workers
+
+    def start(self):
+        """Start the workers."""
+        with self._lock:
+            self._stopping = False
+            self._workers = self._fork(range(self.count))
+
+        self._collector = threading.Thread(
+            target=self._collect,
+            name='WorkerReports',
+            daemon=True
+        )
+        self._collector.start()
+
+    def _collect(self):
+        """Handle the reports of the workers and check them until stopped."""
+        checked = time.monotonic()
+
+        while True:
+            try:
+                report = self._reports.get(timeout=REPORT_INTERVAL)
+
+            except queue.Empty:
+                report = ()
+
+            if report is None:
+                return
+
+            if report:
+                self._handle(report)
+
+            if time.monotonic() - checked >= REPORT_INTERVAL:
+                checked = time.monotonic()
+
+                if not self._check():
+                    return
+
+    def _handle(self, report):
+        """Handle a report of a worker."""
+        kind, value = report
+
+        if kind == 'metrics':
+            REGISTRY.merge(value)
+            return
+
+        with self._lock:
+            owner = self._owners.pop(value, None)
+
+        # Updates sent again after their worker died may be reported twice
+        if owner is not None and self.on_done:
+            self.on_done(value)
+
+    def _check(self):
+        """Replace dead workers and send their pending updates again.
+
+        Returns:
+            False if the pool was stopped while checking, True otherwise.
+        """
+        with self._lock:
+            dead = [
+                index for index, (process, _) in enumerate(self._workers)
+                if not process.is_alive()
+            ]
+            exited = [p for p in self._retiring if not p.is_alive()]
+
+        if not dead and not exited:
+            return True
+
+        # Updates reported by the workers before exiting are not lost
+        while True:
+            try:
+                report = self._reports.get_nowait()
+
+            except queue.Empty:
+                break
+
+            if report is None:
+                return False
+
+            self._handle(report)
+
+        with self._lock:
+            if self._stopping:
+                return True
+
+            for process in exited:
+                process.join()
+                self._retiring.remove(process)
+
+            replaced = [self._workers[index][0] for index in dead]
+
+            for index, worker in zip(dead, self._fork(dead)):
+                logger.error(
+                    'Worker %d exited with code %s, restarting',
+                    index,
+                    self._workers[index][0].exitcode
+                )
+                self._workers[index][0].join()
+                self._workers[index] = worker
+
+            gone = set(replaced + exited)
+            lost = sorted(
+                (update for process, update in self._owners.values()
+                 if process in gone),
+                key=lambda u: u.update_id
+            )
+
+            if lost:
+                logger.error('Sending %d updates again', len(lost))
+                self._send(lost)
+
+        return True
+
+    def route(self, updates):
+        """Send updates to the workers.
+
+        Returns:
+            List of updates that must be handled by the primary.
+        """
+        local = []
+        remote = []
+
+        for update in updates:
+            key = routing_key(update)
+
+            if key is None or self.is_local(key):
+                local.append(update)
+
+            else:
+                remote.append(update)
+
+        if remote:
+            with self._lock:
+                self._send(remote)
+
+        return local
+
+    def _send(self, updates):
+        """Queue updates in their workers.
+
+        Must be called with the lock held.
+        """
+        batches = {}
+
+        for update in updates:
+            batches.setdefault(
+                routing_key(update) % self.count,
+                []
+            ).append(update)
+
+        for index, batch in batches.items():
+            process, queue = self._workers[index]
+
+            for update in batch:
+                self._owners[update.update_id] = (process, update)
+
+            queue.put(batch)
+
+    def republish(self):
+        """Replace the workers so that they see the changes of the catalog.
+
+        Several changes in a row result in a single republication.
+        """
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+
+            self._timer = threading.Timer(self.republish_delay, self._replace)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _replace(self):
+        """Fork new workers and retire the old ones.
+
+        Old workers exit once they have handled their pending updates.
+        """
+        with self._lock:
+            self._timer = None
+
+            if self._stopping:
+                return
+
+            old = self._workers
+            self._workers = self._fork(range(self.count))
+
+            for process, updates in old:
+                updates.put(None)
+                self._retiring.append(process)
+
+        logger.info('Catalog republished to %d workers', self.count)
+
+    def stop(self):
+        """Stop every worker once it has handled its pending updates."""
+        with self._lock:
+            self._stopping = True
+
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+            workers = self._workers
+            retiring = self._retiring
+            self._workers = []
+            self._retiring = []
+
+        for _, updates in workers:
+            updates.put(None)
+
+        for process in [p for p, _ in workers] + retiring:
+            process.join()
+
+        # Workers report their metrics before exiting
+        if self._collector is not None:
+            self._reports.put(None)
+            self._collector.join()
+            self._collector = None
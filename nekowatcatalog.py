@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Catalog management tool.
+
+Usage:
+
+    python3 nekowatcatalog.py migrate TINYDB_FILE SQLITE_FILE
+    python3 nekowatcatalog.py import [--config CONF] [--dry-run] FILE
+    python3 nekowatcatalog.py export [--config CONF] FILE
+    python3 nekowatcatalog.py snapshot [--config CONF] [--report]
+
+Import and export work on the database of the bot configuration (by default
+the one in the environment variable 'NEKOWAT_CONF'). Files may be JSONL, with
+one object per line:
+
+    {"name": "...", "file_ids": ["..."], "expressions": ["..."]}
+
+or CSV with the columns `name`, `file_ids`, `expressions` and optionally
+`weight`, where lists are comma separated. Use '-' for stdin or stdout.
+
+The snapshot command rebuilds the catalog snapshot of the configuration (see
+nekowatbot.snapshot). With `--report`, the time and resident memory needed to
+load the catalog and its index are measured, in separate processes, both from
+the primary database and from the snapshot.
+"""
+
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import time
+
+from nekowatbot.index import WatIndex
+from nekowatbot.metrics import resident_memory
+from nekowatbot.storage import (
+    BACKENDS, SQLiteStorage, SnapshotStorage, TinyDBStorage, migrate,
+    open_storage
+)
+
+
+# Number of WATs inserted per transaction
+BATCH_SIZE = 5000
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 1
+
+CSV_FIELDS = ['name', 'file_ids', 'expressions', 'weight']
+
+
+class Progress(object):
+    """Periodic progress and throughput report, written to stderr.
+
+    Attributes:
+
+    verb (str): What is being done with the WATs, e.g. 'Imported'.
+    count (int): Number of WATs processed so far.
+    start (float): Time when the operation started.
+    _last (float): Time of the last report.
+    """
+
+    def __init__(self, verb):
+        self.verb = verb
+        self.count = 0
+        self.start = time.monotonic()
+        self._last = self.start
+
+    def add(self, count=1):
+        self.count += count
+        now = time.monotonic()
+
+        if now - self._last >= PROGRESS_INTERVAL:
+            self._last = now
+            self.report()
+
+    def report(self):
+        elapsed = time.monotonic() - self.start
+
+        print(
+            '%s %d WATs in %.1fs (%d/s)' % (
+                self.verb,
+                self.count,
+                elapsed,
+                self.count / elapsed if elapsed else 0
+            ),
+            file=sys.stderr
+        )
+
+
+def read_db_conf(args):
+    """Read the database settings of the bot configuration."""
+    config_path = args.config or os.getenv('NEKOWAT_CONF', '')
+
+    if not config_path or not os.path.isfile(config_path):
+        sys.exit('Could not find configuration file')
+
+    with open(config_path) as f:
+        conf = json.load(f)['db']
+
+    if not isinstance(conf, dict):
+        conf = {'backend': 'tinydb', 'path': conf}
+
+    return conf
+
+
+def open_catalog(args, importing=False):
+    """Open the database of the bot configuration."""
+    conf = read_db_conf(args)
+
+    if importing and conf.get('backend', 'tinydb') == 'tinydb':
+        # Write the file once at the end rather than after every batch
+        conf = dict(conf, write_behind=True)
+
+    return open_storage(conf)
+
+
+def file_format(args):
+    """Format of the file of the arguments, from its extension if needed."""
+    if args.format:
+        return args.format
+
+    if args.file.lower().endswith('.csv'):
+        return 'csv'
+
+    return 'jsonl'
+
+
+def open_file(path, mode):
+    """Open a file, or stdin/stdout for '-'."""
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+
+    return open(path, mode, newline='', encoding='utf-8')
+
+
+def split_list(value):
+    """Split a comma separated CSV cell."""
+    return [v for v in (value or '').split(',') if v.strip()]
+
+
+def read_records(f, fmt):
+    """Iterate over the records of an import file.
+
+    Yields:
+        Tuples of line (or row) number and record dict. The record is None
+        if the line could not be parsed.
+    """
+    if fmt == 'csv':
+        for number, row in enumerate(csv.DictReader(f), 2):
+            record = {
+                'name': row.get('name'),
+                'file_ids': split_list(row.get('file_ids')),
+                'expressions': split_list(row.get('expressions'))
+            }
+
+            if row.get('weight'):
+                try:
+                    record['weight'] = float(row['weight'])
+
+                except ValueError:
+                    record['weight'] = row['weight']
+
+            yield number, record
+
+        return
+
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+
+        try:
+            yield number, json.loads(line)
+
+        except ValueError:
+            yield number, None
+
+
+def validate(record):
+    """Check an import record and build the document to insert.
+
+    Expressions are normalized the same way the bot does.
+
+    Returns:
+        Tuple of document and error message. The document is None if the
+        record is not valid.
+    """
+    if not isinstance(record, dict):
+        return None, 'not a valid record'
+
+    name = record.get('name')
+    file_ids = record.get('file_ids')
+    expressions = record.get('expressions', [])
+    weight = record.get('weight', 1)
+
+    if not isinstance(name, str) or not name.strip():
+        return None, 'missing name'
+
+    if (not isinstance(file_ids, list) or not file_ids or
+            not all(isinstance(f, str) and f for f in file_ids)):
+        return None, 'file_ids must be a non-empty list of file IDs'
+
+    if (not isinstance(expressions, list) or
+            not all(isinstance(e, str) for e in expressions)):
+        return None, 'expressions must be a list of strings'
+
+    if (isinstance(weight, bool) or not isinstance(weight, (int, float)) or
+            weight < 0):
+        return None, 'weight must be a non-negative number'
+
+    doc = {
+        'name': name,
+        'file_ids': file_ids,
+        'expressions': [
+            e.lower().strip() for e in expressions if e.strip()
+        ]
+    }
+
+    if weight != 1:
+        doc['weight'] = weight
+
+    return doc, None
+
+
+def cmd_migrate(args):
+    """One-shot migration of a TinyDB file to a SQLite database."""
+    if not os.path.isfile(args.source):
+        sys.exit('Could not find TinyDB file')
+
+    source = TinyDBStorage(args.source)
+    target = SQLiteStorage(args.target)
+
+    print('Migrated %d WATs' % migrate(source, target))
+
+    source.close()
+    target.close()
+
+
+def cmd_import(args):
+    """Insert the WATs of a file in batches.
+
+    WATs with the name of an existing WAT (or of a previous WAT of the file)
+    are skipped, as are invalid records.
+    """
+    db = open_catalog(args, importing=not args.dry_run)
+    names = set(doc['name'] for doc in db.all())
+    progress = Progress('Validated' if args.dry_run else 'Imported')
+    duplicates = 0
+    invalid = 0
+    batch = []
+
+    with open_file(args.file, 'r') as f:
+        for number, record in read_records(f, file_format(args)):
+            doc, error = validate(record)
+
+            if error:
+                invalid += 1
+                print('Line %d: %s' % (number, error), file=sys.stderr)
+                continue
+
+            if doc['name'] in names:
+                duplicates += 1
+                continue
+
+            names.add(doc['name'])
+            batch.append(doc)
+
+            if len(batch) >= args.batch_size:
+                if not args.dry_run:
+                    db.insert_many(batch)
+
+                progress.add(len(batch))
+                batch = []
+
+    if batch and not args.dry_run:
+        db.insert_many(batch)
+
+    progress.add(len(batch))
+
+    if not args.dry_run:
+        db.flush()
+
+    db.close()
+    progress.report()
+
+    print(
+        '%s %d WATs, skipped %d duplicates and %d invalid records' % (
+            'Would import' if args.dry_run else 'Imported',
+            progress.count,
+            duplicates,
+            invalid
+        )
+    )
+
+    if invalid and args.strict:
+        sys.exit(1)
+
+
+def cmd_export(args):
+    """Write every WAT to a file, one at a time."""
+    db = open_catalog(args)
+    progress = Progress('Exported')
+    fmt = file_format(args)
+
+    with open_file(args.file, 'w') as f:
+        if fmt == 'csv':
+            writer = csv.DictWriter(f, CSV_FIELDS)
+            writer.writeheader()
+
+        for doc in db.all():
+            if fmt == 'csv':
+                writer.writerow({
+                    'name': doc['name'],
+                    'file_ids': ','.join(doc['file_ids']),
+                    'expressions': ','.join(doc['expressions']),
+                    'weight': doc.get('weight', '')
+                })
+
+            else:
+                record = {
+                    'name': doc['name'],
+                    'file_ids': doc['file_ids'],
+                    'expressions': doc['expressions']
+                }
+
+                if doc.get('weight', 1) != 1:
+                    record['weight'] = doc['weight']
+
+                f.write(json.dumps(record) + '\n')
+
+            progress.add()
+
+    db.close()
+    progress.report()
+
+
+def measure_load(args):
+    """Load the catalog and its index, and print what it took as JSON.
+
+    Runs in a separate process for each source, so that the resident memory
+    only accounts for that source.
+    """
+    conf = read_db_conf(args)
+    start = time.monotonic()
+    index = WatIndex()
+
+    if args.measure == 'snapshot':
+        db = open_storage(conf)
+        index.load(db.snapshot)
+
+    else:
+        options = dict(conf)
+        backend = options.pop('backend', 'tinydb')
+        path = options.pop('path')
+        options.pop('snapshot', None)
+        options.pop('rebuild_delay', None)
+
+        db = BACKENDS[backend](path, **options)
+        index.build(db.all())
+
+    print(json.dumps({
+        'wats': len(index),
+        'seconds': time.monotonic() - start,
+        'rss_mb': resident_memory() / 2.0 ** 20
+    }))
+
+
+def cmd_snapshot(args):
+    """Rebuild the catalog snapshot, optionally reporting load times."""
+    if args.measure:
+        measure_load(args)
+        return
+
+    db = open_catalog(args)
+
+    if not isinstance(db, SnapshotStorage):
+        sys.exit('No snapshot configured for the database')
+
+    start = time.monotonic()
+    count = db.rebuild()
+    db.close()
+
+    print('Wrote snapshot of %d WATs in %.1fs (%.1f MB)' % (
+        count,
+        time.monotonic() - start,
+        os.path.getsize(db.snapshot_path) / 2.0 ** 20
+    ))
+
+    if not args.report:
+        return
+
+    command = [sys.executable, os.path.abspath(__file__), 'snapshot']
+
+    if args.config:
+        command += ['--config', args.config]
+
+    for source in ('primary', 'snapshot'):
+        output = subprocess.check_output(command + ['--measure', source])
+        result = json.loads(output.decode('utf-8').splitlines()[-1])
+
+        print('%-8s %d WATs loaded in %.2fs, %.1f MB resident' % (
+            source,
+            result['wats'],
+            result['seconds'],
+            result['rss_mb']
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the WAT catalog')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    migrate_parser = subparsers.add_parser(
+        'migrate',
+        help='Copy a TinyDB database into a new SQLite database'
+    )
+    migrate_parser.add_argument('source', help='TinyDB file')
+    migrate_parser.add_argument('target', help='SQLite file')
+    migrate_parser.set_defaults(func=cmd_migrate)
+
+    import_parser = subparsers.add_parser(
+        'import',
+        help='Add the WATs of a JSONL or CSV file to the catalog'
+    )
+    import_parser.add_argument('file', help='File to import, or - for stdin')
+    import_parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only validate the file and report what would be imported'
+    )
+    import_parser.add_argument(
+        '--strict',
+        action='store_true',
+        help='Exit with an error status if there are invalid records'
+    )
+    import_parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=BATCH_SIZE,
+        help='WATs inserted per transaction'
+    )
+    import_parser.set_defaults(func=cmd_import)
+
+    export_parser = subparsers.add_parser(
+        'export',
+        help='Write the catalog to a JSONL or CSV file'
+    )
+    export_parser.add_argument('file', help='File to write, or - for stdout')
+    export_parser.set_defaults(func=cmd_export)
+
+    snapshot_parser = subparsers.add_parser(
+        'snapshot',
+        help='Rebuild the catalog snapshot'
+    )
+    snapshot_parser.add_argument(
+        '--report',
+        action='store_true',
+        help='Compare the load time and memory of the database and snapshot'
+    )
+    snapshot_parser.add_argument(
+        '--measure',
+        choices=['primary', 'snapshot'],
+        help=argparse.SUPPRESS
+    )
+    snapshot_parser.set_defaults(func=cmd_snapshot)
+
+    for subparser in (import_parser, export_parser, snapshot_parser):
+        subparser.add_argument(
+            '--config',
+            help='Configuration file of the bot (defaults to $NEKOWAT_CONF)'
+        )
+
+    for subparser in (import_parser, export_parser):
+        subparser.add_argument(
+            '--format',
+            choices=['jsonl', 'csv'],
+            help='Format of the file (guessed from its extension by default)'
+        )
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,661 @@
+# -*- coding: utf-8 -*-
+#
+# nekowatbot
+# https://github.com/rmed/nekowatbot
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Fake Telegram Bot API server for local load testing.
+
+Implements the methods used by the bot (getUpdates, sendMessage, sendPhoto,
+answerInlineQuery, ...) in memory, with configurable latency and injected
+rate limit errors. Updates are generated at a fixed rate (or replayed from a
+JSONL file) and delivered through `getUpdates` or, once `setWebhook` has been
+called, POSTed to the webhook URL.
+
+Point the bot at the server with the `api_url` setting of the `tg` section:
+
+    "api_url": "http://127.0.0.1:8081"
+
+Usage:
+
+    python3 nekowatfakeapi.py [--port 8081] [--rate 1000] [--latency 0.05]
+        [--error-rate 0.01] [--enforce-limits] [--script updates.jsonl]
+
+Counters of the requests received are available on `/stats`.
+"""
+
+import argparse
+import collections
+import email.parser
+import email.policy
+import http.server
+import itertools
+import json
+import math
+import random
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from nekowatbot.sender import RateLimiter
+from nekowatbot.webhook import SECRET_HEADER
+
+
+# Methods that send something to a chat, subject to rate limits
+SEND_METHODS = (
+    'sendMessage', 'sendPhoto', 'editMessageText', 'editMessageReplyMarkup'
+)
+
+# Answers to queries, which are not rate limited but may get injected errors
+ANSWER_METHODS = ('answerInlineQuery', 'answerCallbackQuery')
+
+BOT_USER = {
+    'id': 1,
+    'is_bot': True,
+    'first_name': 'Nekowat',
+    'username': 'nekowatbot'
+}
+
+
+class FakeBotAPI(object):
+    """In-memory state of the fake Bot API.
+
+    Attributes:
+
+    latency (float): Seconds each request takes.
+    jitter (float): Maximum random seconds added to the latency.
+    error_rate (float): Probability of answering a send request with a 429
+        error.
+    retry_after (int): Seconds indicated in injected 429 errors.
+    limiter (RateLimiter): If set, real rate limits are enforced and
+        exceeding them results in 429 errors.
+    max_pending (int): Maximum number of undelivered updates. The oldest
+        ones are discarded when exceeded.
+    stats (Counter): Number of requests by method, and of errors returned.
+    webhook (dict): Parameters of the webhook, if set.
+    _updates (deque): Undelivered updates.
+    _cond (Condition): Condition protecting the state.
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, retry_after=1,
+                 enforce_limits=False, max_pending=100000):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.limiter = RateLimiter() if enforce_limits else None
+        self.max_pending = max_pending
+        self.stats = collections.Counter()
+        self.webhook = None
+        self._updates = collections.deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._limiter_lock = threading.Lock()
+
+    def add_update(self, update):
+        """Queue an update for delivery, assigning it an ID."""
+        update = dict(update, update_id=next(self._update_ids))
+
+        with self._cond:
+            self._updates.append(update)
+
+            if len(self._updates) > self.max_pending:
+                self._updates.popleft()
+                self.stats['updates_discarded'] += 1
+
+            self._cond.notify_all()
+
+    def pop_updates(self, limit, timeout):
+        """Take updates for webhook delivery, waiting up to `timeout`."""
+        with self._cond:
+            if not self._updates:
+                self._cond.wait(timeout)
+
+            updates = []
+
+            while self._updates and len(updates) < limit:
+                updates.append(self._updates.popleft())
+
+            return updates
+
+    def call(self, method, params):
+        """Handle a call to an API method.
+
+        Returns:
+            Tuple of HTTP status and response dict.
+        """
+        self.stats[method] += 1
+
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if method in SEND_METHODS or method in ANSWER_METHODS:
+            retry_after = self._rate_limit(params, method in SEND_METHODS)
+
+            if retry_after:
+                self.stats['429'] += 1
+
+                return 429, {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': 'Too Many Requests: retry after %d'
+                                   % retry_after,
+                    'parameters': {'retry_after': retry_after}
+                }
+
+        handler = getattr(self, 'api_' + method, None)
+
+        if handler is None:
+            self.stats['404'] += 1
+            return 404, {
+                'ok': False,
+                'error_code': 404,
+                'description': 'Not Found'
+            }
+
+        try:
+            result = handler(params)
+
+        except (KeyError, ValueError) as e:
+            self.stats['400'] += 1
+            return 400, {
+                'ok': False,
+                'error_code': 400,
+                'description': 'Bad Request: %s' % e
+            }
+
+        if isinstance(result, tuple):
+            return result
+
+        return 200, {'ok': True, 'result': result}
+
+    def _rate_limit(self, params, limited=True):
+        """Seconds the client should wait, or 0 if the request is allowed.
+
+        Args:
+            limited (bool): Whether the real rate limits apply to the
+                request, or only the injected errors.
+        """
+        if self.error_rate and random.random() < self.error_rate:
+            return self.retry_after
+
+        if not self.limiter or not limited:
+            return 0
+
+        chat_id = params.get('chat_id')
+
+        with self._limiter_lock:
+            wait = self.limiter.acquire(int(chat_id) if chat_id else None)
+
+        return int(math.ceil(wait))
+
+    def _message(self, params, **fields):
+        """Build the message sent by a send method."""
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': next(self._message_ids),
+            'from': BOT_USER,
+            'chat': {
+                'id': chat_id,
+                'type': 'group' if chat_id < 0 else 'private'
+            },
+            'date': int(time.time())
+        }
+        message.update(fields)
+
+        return message
+
+    def api_getMe(self, params):
+        return BOT_USER
+
+    def api_getUpdates(self, params):
+        if self.webhook:
+            return 409, {
+                'ok': False,
+                'error_code': 409,
+                'description': 'Conflict: can\'t use getUpdates method '
+                               'while webhook is active'
+            }
+
+        offset = int(params.get('offset') or 0)
+        limit = min(int(params.get('limit') or 100), 100)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            while True:
+                # Updates before the offset are confirmed and forgotten
+                if offset > 0:
+                    while (self._updates and
+                           self._updates[0]['update_id'] < offset):
+                        self._updates.popleft()
+
+                elif offset < 0:
+                    while len(self._updates) > -offset:
+                        self._updates.popleft()
+
+                remaining = deadline - time.monotonic()
+
+                if self._updates or remaining <= 0:
+                    return list(itertools.islice(self._updates, limit))
+
+                self._cond.wait(remaining)
+
+    def api_setWebhook(self, params):
+        url = params.get('url')
+
+        with self._cond:
+            if url:
+                self.webhook = {
+                    'url': url,
+                    'secret_token': params.get('secret_token'),
+                    'max_connections': int(params.get('max_connections')
+                                           or 40)
+                }
+
+            else:
+                self.webhook = None
+
+            self._cond.notify_all()
+
+        return True
+
+    def api_deleteWebhook(self, params):
+        return self.api_setWebhook({})
+
+    def api_sendMessage(self, params):
+        return self._message(params, text=params['text'])
+
+    def api_sendPhoto(self, params):
+        photo = params['photo']
+
+        return self._message(params, photo=[{
+            'file_id': photo if isinstance(photo, str) else 'uploaded',
+            'width': 512,
+            'height': 512
+        }])
+
+    def api_answerInlineQuery(self, params):
+        results = json.loads(params['results'])
+
+        if len(results) > 50:
+            raise ValueError('too many results')
+
+        return True
+
+    def api_answerCallbackQuery(self, params):
+        return True
+
+    def api_editMessageText(self, params):
+        return self._message(
+            params,
+            message_id=int(params['message_id']),
+            text=params['text']
+        )
+
+    def api_editMessageReplyMarkup(self, params):
+        return self._message(params, message_id=int(params['message_id']))
+
+
+class UpdateGenerator(object):
+    """Feeds updates to the fake API at a fixed rate.
+
+    Without a script, updates are a mix of inline queries and `/wat`
+    commands with random expressions, from a pool of users.
+
+    Attributes:
+
+    api (FakeBotAPI): API receiving the updates.
+    rate (float): Updates per second.
+    inline_ratio (float): Fraction of inline queries among the updates.
+    expressions (list[str]): Expressions used in the updates.
+    users (int): Number of distinct users sending updates.
+    script (list[dict]): Updates to replay (in a loop) instead.
+    total (int): Number of updates to generate, or None for no limit.
+    """
+
+    def __init__(self, api, rate, inline_ratio=0.5, expressions=None,
+                 users=1000, script=None, total=None):
+        self.api = api
+        self.rate = rate
+        self.inline_ratio = inline_ratio
+        self.expressions = expressions or ['wat', 'cat', 'neko', 'hello']
+        self.users = users
+        self.script = script
+        self.total = total
+        self._stop = threading.Event()
+
+    def _random_update(self, seq):
+        user_id = 1000 + random.randrange(self.users)
+        user = {'id': user_id, 'is_bot': False, 'first_name': 'user%d'
+                % user_id}
+        expression = random.choice(self.expressions)
+
+        if random.random() < self.inline_ratio:
+            return {'inline_query': {
+                'id': str(seq),
+                'from': user,
+                'query': expression[:random.randint(1, len(expression))],
+                'offset': ''
+            }}
+
+        return {'message': {
+            'message_id': seq,
+            'from': user,
+            'chat': {'id': user_id, 'type': 'private'},
+            'date': int(time.time()),
+            'text': '/wat %s' % expression,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 4}]
+        }}
+
+    def _updates(self):
+        if self.script:
+            for update in itertools.cycle(self.script):
+                yield update
+
+        for seq in itertools.count(1):
+            yield self._random_update(seq)
+
+    def run(self):
+        """Generate updates until stopped or `total` is reached."""
+        start = time.monotonic()
+        updates = self._updates()
+
+        for sent in itertools.count():
+            if self._stop.is_set() or sent == self.total:
+                return
+
+            # Catch up in bursts rather than sleeping between every update
+            delay = start + sent / self.rate - time.monotonic()
+
+            if delay > 0:
+                self._stop.wait(delay)
+
+            self.api.add_update(next(updates))
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+
+class WebhookDeliverer(object):
+    """POSTs updates to the webhook set through `setWebhook`.
+
+    Updates are sent one per request by as many threads as the
+    `max_connections` of the webhook allows (up to `connections`).
+    """
+
+    def __init__(self, api, connections=40):
+        self.api = api
+        self.connections = connections
+
+    def _deliver(self, slot):
+        while True:
+            webhook = self.api.webhook
+
+            if not webhook or slot >= webhook['max_connections']:
+                time.sleep(0.5)
+                continue
+
+            for update in self.api.pop_updates(1, 1):
+                self._post(webhook, update)
+
+    def _post(self, webhook, update):
+        request = urllib.request.Request(
+            webhook['url'],
+            data=json.dumps(update).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}
+        )
+
+        if webhook['secret_token']:
+            request.add_header(SECRET_HEADER, webhook['secret_token'])
+
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+            self.api.stats['webhook_delivered'] += 1
+
+        except Exception:
+            # Telegram retries failed deliveries later
+            self.api.stats['webhook_failed'] += 1
+            self.api.add_update(
+                dict((k, v) for k, v in update.items() if k != 'update_id')
+            )
+            time.sleep(1)
+
+    def start(self):
+        for slot in range(self.connections):
+            threading.Thread(
+                target=self._deliver,
+                args=(slot,),
+                daemon=True
+            ).start()
+
+
+def parse_params(handler, body):
+    """Parse the parameters of a request (query string and body)."""
+    url = urllib.parse.urlsplit(handler.path)
+    params = dict(urllib.parse.parse_qsl(url.query))
+    content_type = handler.headers.get('Content-Type', '')
+
+    if not body:
+        return params
+
+    if content_type.startswith('application/json'):
+        params.update(json.loads(body.decode('utf-8')))
+
+    elif content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n'
+            + body
+        )
+
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+
+            if part.get_filename():
+                params[name] = part.get_payload(decode=True)
+
+            else:
+                params[name] = part.get_content()
+
+    else:
+        params.update(urllib.parse.parse_qsl(body.decode('utf-8')))
+
+    return params
+
+
+def make_server(api, listen='127.0.0.1', port=8081):
+    """Build the HTTP server of the fake API."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def _respond(self, status, data):
+            body = json.dumps(data).encode('utf-8')
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            path = urllib.parse.urlsplit(self.path).path.strip('/').split('/')
+
+            if path == ['stats']:
+                self._respond(200, dict(api.stats))
+                return
+
+            if len(path) != 2 or not path[0].startswith('bot'):
+                self._respond(404, {
+                    'ok': False,
+                    'error_code': 404,
+                    'description': 'Not Found'
+                })
+                return
+
+            try:
+                params = parse_params(self, body)
+
+            except ValueError:
+                self._respond(400, {
+                    'ok': False,
+                    'error_code': 400,
+                    'description': 'Bad Request: invalid parameters'
+                })
+                return
+
+            self._respond(*api.call(path[1], params))
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((listen, port), Handler)
+    server.daemon_threads = True
+
+    return server
+
+
+def load_script(path):
+    """Load the updates of a JSONL file. Their `update_id` is ignored."""
+    with open(path) as f:
+        return [
+            dict((k, v) for k, v in json.loads(line).items()
+                 if k != 'update_id')
+            for line in f if line.strip()
+        ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fake Telegram Bot API server'
+    )
+    parser.add_argument('--listen', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=100,
+        help='Updates generated per second (0 to disable)'
+    )
+    parser.add_argument(
+        '--total',
+        type=int,
+        help='Stop generating updates after this many'
+    )
+    parser.add_argument(
+        '--inline-ratio',
+        type=float,
+        default=0.5,
+        help='Fraction of inline queries among generated updates'
+    )
+    parser.add_argument(
+        '--expressions',
+        default='wat,cat,neko,hello',
+        help='Comma separated expressions used in generated updates'
+    )
+    parser.add_argument(
+        '--users',
+        type=int,
+        default=1000,
+        help='Number of users sending generated updates'
+    )
+    parser.add_argument(
+        '--script',
+        help='JSONL file of updates to replay instead of generating them'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0,
+        help='Seconds each request takes'
+    )
+    parser.add_argument(
+        '--jitter',
+        type=float,
+        default=0,
+        help='Maximum random seconds added to the latency'
+    )
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0,
+        help='Probability of answering a send request with a 429 error'
+    )
+    parser.add_argument(
+        '--retry-after',
+        type=int,
+        default=1,
+        help='Seconds to wait indicated in injected 429 errors'
+    )
+    parser.add_argument(
+        '--enforce-limits',
+        action='store_true',
+        help='Answer with 429 errors when exceeding Telegram\'s rate limits'
+    )
+
+    args = parser.parse_args()
+
+    api = FakeBotAPI(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        enforce_limits=args.enforce_limits
+    )
+
+    if args.rate > 0:
+        UpdateGenerator(
+            api,
+            args.rate,
+            inline_ratio=args.inline_ratio,
+            expressions=args.expressions.split(','),
+            users=args.users,
+            script=load_script(args.script) if args.script else None,
+            total=args.total
+        ).start()
+
+    WebhookDeliverer(api).start()
+
+    server = make_server(api, args.listen, args.port)
+    print('Fake Bot API listening on http://%s:%d' % (args.listen, args.port))
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    print(json.dumps(dict(api.stats), indent=2))